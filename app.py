@@ -1,16 +1,34 @@
-from flask import Flask, send_file, jsonify, request, render_template_string
+from flask import Flask, send_file, jsonify, request, render_template_string, Response, stream_with_context
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, InsertOne, ReturnDocument
+from pymongo.errors import OperationFailure
 from unidecode import unidecode
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from bson.objectid import ObjectId
+from bson import json_util
 import threading
+import socket
 import time
+from collections import OrderedDict
+from bisect import bisect_right
 # Importar SendGrid
-import sendgrid
 from sendgrid.helpers.mail import Mail
+import http.client
+import hashlib
+import gzip
+import json
+import base64
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
 import os
-import pandas as pd
+import re
+import numpy as np
+import xlrd
+import zipfile
+from xml.sax.saxutils import escape as escape_xml
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from openpyxl.utils import get_column_letter
 from io import BytesIO
 import calendar
 import pytz
@@ -39,6 +57,10 @@ multas = db["Multas"]  # Colección para multas
 devoluciones = db["Devoluciones"]  # Colección para devoluciones
 sitio = db["Sitio"]  # Colección para registros de entrada al sitio
 ajedrez = db["Ajedrez"]  # Colección para contadores de ajedrez
+contadores = db["Contadores"]  # Agregados materializados (libros en estantería, etc.)
+correos = db["Correos"]  # Bandeja de salida de correos (ver despachador_correos)
+tareas = db["Tareas"]  # Estado y bloqueo de las tareas programadas (ver planificador)
+sitio_diario = db["SitioDiario"]  # Entradas al sitio por día, tipo y hora (ver contar_entrada_sitio)
 
 # Configuración de correo usando SendGrid
 MODO_PRUEBA = os.getenv('MODO_PRUEBA', 'true').lower() == 'true'  # Cambia a 'false' para producción
@@ -46,10 +68,136 @@ CORREO_PRUEBA = os.getenv('CORREO_PRUEBA', '')  # Opcional: si está configurado
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY', '')
 EMAIL_FROM = os.getenv('EMAIL_FROM', 'bibliotecacecyt19@ipn.com.mx')
 
+# --- Índices de MongoDB ---
+# Declaración única de los índices que necesitan las consultas de la aplicación.
+# asegurar_indices() los crea de forma idempotente al iniciar (o con
+# python indices.py) y verificar_indices() usa explain() para reportar las
+# consultas que todavía recorren la colección completa (COLLSCAN).
+INDICES = [
+    ("Inventario", [("busqueda_ngramas", 1)], {}),
+    ("Inventario", [("ISBN", 1)], {}),
+    ("Inventario", [("TÍTULO", 1)], {}),
+    ("Inventario", [("created_at", 1)], {"sparse": True}),
+    ("Inventario", [("busqueda_principal", 1), ("_id", 1)], {}),
+    ("Inventario", [("filtros_inventario", 1)], {}),
+    ("Inventario", [("isbn_normalizado", 1)], {}),
+    ("Alumnos", [("busqueda_ngramas", 1)], {}),
+    ("Alumnos", [("Boleta", 1)], {}),
+    ("Alumnos", [("boleta", 1)], {"sparse": True}),
+    ("Alumnos", [("id_canonico", 1)], {}),
+    ("Alumnos", [("busqueda_principal", 1), ("_id", 1)], {}),
+    ("Alumnos", [("filtros_alumno", 1), ("busqueda_principal", 1), ("_id", 1)], {}),
+    ("Docentes", [("busqueda_ngramas", 1)], {}),
+    ("Docentes", [("id_canonico", 1)], {}),
+    ("Docentes", [("No Empleado", 1)], {}),
+    ("Docentes", [("NoEmpleado", 1)], {"sparse": True}),
+    ("Docentes", [("no_empleado", 1)], {"sparse": True}),
+    ("Docentes", [("noEmpleado", 1)], {"sparse": True}),
+    ("Prestamos", [("estado", 1), ("fecha_devolucion", 1)], {}),
+    ("Prestamos", [("created_at", -1)], {}),
+    ("Prestamos", [("fecha_inicio", 1)], {}),
+    ("Devoluciones", [("prestamo_id", 1)], {}),
+    ("Multas", [("prestamo_id", 1), ("estado", 1)], {}),
+    ("Multas", [("estado", 1), ("created_at", -1)], {}),
+    ("Sitio", [("tipo", 1), ("fecha", 1), ("reiniciado", 1)], {}),
+    ("Sitio", [("fecha_completa", -1)], {}),
+    ("Sitio", [("expira_at", 1)], {"expireAfterSeconds": 0}),
+    ("Sitio", [("actualizado_at", 1)], {"sparse": True}),
+    ("Ajedrez", [("id", 1), ("estado", 1)], {}),
+    ("Ajedrez", [("estado", 1), ("tiempo_inicio", -1)], {}),
+    ("Ajedrez", [("tiempo_fin", 1)], {"partialFilterExpression": {"estado": "activo"}}),
+    ("Correos", [("clave", 1)], {"unique": True}),
+    ("Correos", [("estado", 1), ("proximo_intento", 1)], {}),
+    ("Correos", [("claves", 1)], {"sparse": True}),
+]
+
+# Consultas representativas de cada endpoint: (colección, filtro, orden)
+CONSULTAS_CRITICAS = [
+    ("Inventario", {"busqueda_ngramas": {"$all": ["a"]}}, None),
+    ("Inventario", {"ISBN": {"$in": ["0"]}}, None),
+    ("Inventario", {"isbn_normalizado": "0", "DISPONIBLES": {"$gt": 0}}, None),
+    ("Inventario", {}, [("busqueda_principal", 1), ("_id", 1)]),
+    ("Inventario", {"filtros_inventario": {"$regex": "^titulo:a"}}, None),
+    ("Alumnos", {"Boleta": "0"}, None),
+    ("Alumnos", {"busqueda_ngramas": {"$all": ["a"]}}, None),
+    ("Alumnos", {"filtros_alumno": {"$all": ["grupo:a"]}}, [("busqueda_principal", 1), ("_id", 1)]),
+    ("Docentes", {"No Empleado": "0"}, None),
+    ("Alumnos", {"id_canonico": "0"}, None),
+    ("Docentes", {"id_canonico": "0"}, None),
+    ("Prestamos", {"estado": "Activo"}, [("fecha_devolucion", 1)]),
+    ("Prestamos", {"created_at": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("Prestamos", {"fecha_inicio": {"$gte": "2000-01-01", "$lt": "2000-02-01"}}, None),
+    ("Devoluciones", {"prestamo_id": "0"}, None),
+    ("Multas", {"prestamo_id": "0", "estado": "Pendiente"}, None),
+    ("Multas", {"estado": "Pendiente"}, [("created_at", -1)]),
+    ("Sitio", {"tipo": "alumno", "fecha": "2000-01-01", "reiniciado": {"$ne": True}}, None),
+    ("Sitio", {"fecha_completa": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("Sitio", {"actualizado_at": {"$gte": datetime(2000, 1, 1)}}, [("actualizado_at", 1)]),
+    ("Ajedrez", {"id": "0", "estado": "activo"}, None),
+    ("Ajedrez", {"estado": "activo"}, [("tiempo_inicio", -1)]),
+    ("Ajedrez", {"estado": "activo", "tiempo_fin": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("Correos", {"estado": "pendiente", "proximo_intento": {"$lte": datetime(2000, 1, 1)}}, None),
+]
+
+def asegurar_indices():
+    """Crea los índices declarados en INDICES (no hace nada si ya existen)"""
+    creados = []
+    for nombre, claves, opciones in INDICES:
+        try:
+            creados.append((nombre, db[nombre].create_index(claves, **opciones)))
+        except Exception as e:
+            print(f"[INDICES] Error creando índice {claves} en {nombre}: {e}")
+    print(f"[INDICES] {len(creados)} índices verificados")
+    return creados
+
+def _etapas_plan(plan):
+    """Recorre un plan de explain() y devuelve todas sus etapas"""
+    if not isinstance(plan, dict):
+        return []
+    etapas = [plan.get("stage")] if plan.get("stage") else []
+    for clave in ("inputStage", "queryPlan"):
+        etapas += _etapas_plan(plan.get(clave))
+    for sub in plan.get("inputStages", []):
+        etapas += _etapas_plan(sub)
+    return etapas
+
+def verificar_indices():
+    """Ejecuta explain() sobre CONSULTAS_CRITICAS y lista las que usan COLLSCAN"""
+    resultados = []
+    for nombre, filtro, orden in CONSULTAS_CRITICAS:
+        cursor = db[nombre].find(filtro)
+        if orden:
+            cursor = cursor.sort(orden)
+        try:
+            plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+            etapas = _etapas_plan(plan)
+            resultados.append({
+                "coleccion": nombre,
+                "filtro": str(filtro),
+                "orden": str(orden or ''),
+                "etapas": etapas,
+                "collscan": "COLLSCAN" in etapas
+            })
+        except Exception as e:
+            resultados.append({"coleccion": nombre, "filtro": str(filtro), "error": str(e), "collscan": None})
+    return resultados
+
+@app.route('/api/salud/indices', methods=['GET'])
+def api_salud_indices():
+    """Health check: consultas críticas que todavía hacen COLLSCAN"""
+    resultados = verificar_indices()
+    con_collscan = [r for r in resultados if r["collscan"]]
+    return jsonify({
+        "ok": not con_collscan and all(r["collscan"] is not None for r in resultados),
+        "collscan": con_collscan,
+        "consultas": resultados
+    }), (200 if not con_collscan else 503)
+
 def obtener_disponibles(doc):
+    """Lee las existencias de la estructura heredada U -> EXIST (la usan la migración y
+    el contador de existencia_volumenes)"""
     u = doc.get("U")
     if not isinstance(u, dict):
-        print("NO ENCONTRADO DISPONIBLES (U no es dict)")
         return ""
     # Busca la clave 'EXIST' de cualquier forma posible
     exist = None
@@ -57,115 +205,423 @@ def obtener_disponibles(doc):
         if k.strip().upper() == "EXIST":
             exist = u[k]
             break
-    print("EXIST:", exist, type(exist))
     if isinstance(exist, dict):
-        print("CLAVES EXIST:", list(exist.keys()))
-        print("VALORES EXIST:", list(exist.values()))
         # Busca la clave vacía
         if "" in exist and isinstance(exist[""], int):
-            print("ENCONTRADO DISPONIBLES:", exist[""])
             return exist[""]
         # Busca cualquier valor numérico
         for v in exist.values():
             if isinstance(v, int):
-                print("ENCONTRADO DISPONIBLES (otro):", v)
                 return v
             if isinstance(v, str) and v.isdigit():
-                print("ENCONTRADO DISPONIBLES (str):", v)
                 return int(v)
     if isinstance(exist, int):
-        print("ENCONTRADO DISPONIBLES (directo):", exist)
         return exist
     if isinstance(exist, str) and exist.isdigit():
-        print("ENCONTRADO DISPONIBLES (directo str):", exist)
         return int(exist)
-    print("NO ENCONTRADO DISPONIBLES")
     return ""
 
-@app.route('/api/inventario', methods=['GET'])
-def api_inventario():
-    page = int(request.args.get('page', 1))
-    page_size = int(request.args.get('page_size', 50))
-
-    titulo = request.args.get('titulo', '').strip()
-    autor = request.args.get('autor', '').strip()
-    editorial = request.args.get('editorial', '').strip()
-    edicion_q = request.args.get('edicion', '').strip()
-    estante = request.args.get('estante', '').strip()
-
-    and_clauses = []
-    def or_fields(name_variants, value):
-        return [{f: {"$regex": value, "$options": "i"}} for f in name_variants]
-
-    if titulo:
-        and_clauses.append({"$or": or_fields(["TÍTULO","Titulo","TITULO","titulo"], titulo)})
-    if autor:
-        and_clauses.append({"$or": or_fields(["AUTOR","Autor","autor"], autor)})
-    if editorial:
-        and_clauses.append({"$or": or_fields(["EDITORIAL","Editorial","editorial"], editorial)})
-    if edicion_q:
-        and_clauses.append({"$or": or_fields(["EDICIÓN","Edicion","EDICION","edicion"], edicion_q)})
-    if estante:
-        and_clauses.append({"$or": or_fields(["ESTANTE","Estante","estante"], estante)})
-
-    query = {"$and": and_clauses} if and_clauses else {}
-
-    # helper: busca campo por varias variantes, normalizando claves (quita acentos/espacios) y buscando en subdocumentos
-    def find_field(document, candidates):
-        if not isinstance(document, dict):
-            return ''
-        # búsqueda directa por nombres exactos
+# --- Esquema canónico de Inventario ---
+# Todos los lectores leen estos campos directamente. Los documentos importados
+# con otras variantes de nombre se convierten con migrar_inventario.py.
+CAMPOS_CANONICOS_INVENTARIO = ("TÍTULO", "AUTOR", "EDITORIAL", "ISBN", "EDICIÓN", "ESTANTE", "DISPONIBLES")
+PROYECCION_INVENTARIO = {"_id": 0, "TÍTULO": 1, "AUTOR": 1, "EDITORIAL": 1, "ISBN": 1,
+                         "EDICIÓN": 1, "ESTANTE": 1, "DISPONIBLES": 1}
+VARIANTES_INVENTARIO = {
+    "TÍTULO": ["TÍTULO", "TITULO", "Titulo", "titulo", "Título", "title"],
+    "AUTOR": ["AUTOR", "Autor", "autor", "author"],
+    "EDITORIAL": ["EDITORIAL", "Editorial", "editorial", "publisher"],
+    "ISBN": ["ISBN", "Isbn", "isbn"],
+    "EDICIÓN": ["EDICIÓN", "EDICION", "Edicion", "edicion", "Edición"],
+    "ESTANTE": ["ESTANTE", "Estante", "estante"],
+    "DISPONIBLES": ["DISPONIBLES", "Disponibles", "disponibles", "disponible", "DISPONIBLE", "Disponible"]
+}
+
+def buscar_campo(document, candidates):
+    """Busca un campo por varias variantes, normalizando claves (quita acentos/espacios)
+    y buscando en subdocumentos"""
+    if not isinstance(document, dict):
+        return ''
+    # búsqueda directa por nombres exactos
+    for c in candidates:
+        if c in document and document[c] not in (None, ''):
+            return document[c]
+    # búsqueda por normalización de claves
+    for k, v in document.items():
+        kn = unidecode(str(k)).upper().replace(" ", "")
         for c in candidates:
-            if c in document and document[c] not in (None, ''):
-                return document[c]
-        # búsqueda por normalización de claves
-        for k, v in document.items():
-            kn = unidecode(str(k)).upper().replace(" ", "")
-            for c in candidates:
-                cn = unidecode(str(c)).upper().replace(" ", "")
-                if kn == cn or cn in kn or kn in cn:
-                    if v not in (None, ''):
-                        return v
-        # buscar recursivamente en subdocumentos
-        for v in document.values():
-            if isinstance(v, dict):
-                r = find_field(v, candidates)
-                if r not in (None, ''):
-                    return r
+            cn = unidecode(str(c)).upper().replace(" ", "")
+            if cn and cn in kn:
+                if v not in (None, ''):
+                    return v
+    # buscar recursivamente en subdocumentos
+    for v in document.values():
+        if isinstance(v, dict):
+            r = buscar_campo(v, candidates)
+            if r not in (None, ''):
+                return r
+    return ''
+
+def canonizar_libro(doc):
+    """Convierte un documento de Inventario con cualquier variante de campos al esquema canónico.
+    Devuelve (campos canónicos, disponibles_encontrado)."""
+    ed = buscar_campo(doc, VARIANTES_INVENTARIO["EDICIÓN"])
+    if isinstance(ed, dict):
+        ed = ed.get("valor") or ed.get("value") or ed.get("") or ''
+
+    disp = buscar_campo(doc, VARIANTES_INVENTARIO["DISPONIBLES"])
+    if disp in (None, ''):
+        disp = obtener_disponibles(doc)
+    disp_n = extract_number(disp)
+
+    canonico = {}
+    for campo in ("TÍTULO", "AUTOR", "EDITORIAL", "ISBN", "ESTANTE"):
+        v = buscar_campo(doc, VARIANTES_INVENTARIO[campo])
+        canonico[campo] = str(v).strip() if v not in (None, '') else ''
+    canonico["EDICIÓN"] = str(ed).strip() if ed not in (None, '') else ''
+    canonico["DISPONIBLES"] = max(0, disp_n) if disp_n is not None else 0
+    return canonico, disp_n is not None
+
+def migrar_inventario(aplicar=False, lote=500, ejemplos=5):
+    """Reescribe Inventario al esquema canónico con escrituras por lotes.
+    Con aplicar=False sólo genera el reporte (dry-run) sin modificar nada."""
+    alias = {v for variantes in VARIANTES_INVENTARIO.values() for v in variantes} - set(CAMPOS_CANONICOS_INVENTARIO)
+    reporte = {
+        "total": 0,
+        "ya_canonicos": 0,
+        "a_migrar": 0,
+        "sin_disponibles": 0,
+        "escritos": 0,
+        "claves_eliminadas": {},
+        "ejemplos": []
+    }
+    operaciones = []
+    for doc in inventario.find({}):
+        reporte["total"] += 1
+        canonico, con_disponibles = canonizar_libro(doc)
+        if not con_disponibles:
+            reporte["sin_disponibles"] += 1
+        canonico.update(campos_busqueda("libro", canonico))
+        set_ops = {k: v for k, v in canonico.items() if doc.get(k) != v}
+        unset_ops = {k: "" for k in doc if k in alias}
+        if not set_ops and not unset_ops:
+            reporte["ya_canonicos"] += 1
+            continue
+        reporte["a_migrar"] += 1
+        for k in unset_ops:
+            reporte["claves_eliminadas"][k] = reporte["claves_eliminadas"].get(k, 0) + 1
+        if len(reporte["ejemplos"]) < ejemplos:
+            reporte["ejemplos"].append({
+                "_id": str(doc["_id"]),
+                "antes": {k: doc.get(k) for k in list(set_ops) + list(unset_ops)
+                          if k in doc and not k.startswith("busqueda_")},
+                "despues": {k: v for k, v in set_ops.items() if not k.startswith("busqueda_")},
+                "eliminar": sorted(unset_ops)
+            })
+        if aplicar:
+            cambios = {"$set": set_ops}
+            if unset_ops:
+                cambios["$unset"] = unset_ops
+            operaciones.append(UpdateOne({"_id": doc["_id"]}, cambios))
+            if len(operaciones) >= lote:
+                reporte["escritos"] += inventario.bulk_write(operaciones, ordered=False).modified_count
+                operaciones = []
+    if aplicar and operaciones:
+        reporte["escritos"] += inventario.bulk_write(operaciones, ordered=False).modified_count
+    if aplicar:
+        invalidar_cache_busqueda()
+        invalidar_reporte_mensual()
+        reporte["libros_estanteria"] = reconciliar_libros_estanteria()
+        reporte["existencia_volumenes"] = reconciliar_existencia_volumenes()
+    return reporte
+
+# --- Transacciones ---
+# Las operaciones que escriben en varias colecciones (préstamos, devoluciones,
+# inventario) se agrupan en una transacción de MongoDB. Atlas siempre es un
+# replica set; en un servidor standalone (desarrollo) las transacciones no
+# existen y la función se ejecuta sin sesión, con las mismas escrituras.
+_transacciones_disponibles = [None]  # None = aún no se sabe
+
+def en_transaccion(funcion):
+    """Ejecuta funcion(session) dentro de una transacción y devuelve su resultado.
+    with_transaction reintenta la función completa ante errores transitorios, así
+    que no debe tener efectos fuera de la base de datos."""
+    if _transacciones_disponibles[0] is not False:
+        try:
+            with client.start_session() as session:
+                resultado = session.with_transaction(funcion)
+            _transacciones_disponibles[0] = True
+            return resultado
+        except NotImplementedError:
+            pass
+        except OperationFailure as e:
+            # 20 = IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+            if e.code != 20 or _transacciones_disponibles[0]:
+                raise
+        _transacciones_disponibles[0] = False
+        print("[TRANSACCIONES] El servidor no admite transacciones; se escribe sin sesión")
+    return funcion(None)
+
+# --- Contador materializado de libros en estantería ---
+# Contadores/{_id: "libros_estanteria"} guarda la suma de DISPONIBLES (> 0). Cada
+# cambio de inventario lo ajusta con $inc; reconciliar_libros_estanteria() lo
+# reconstruye desde cero y reporta la diferencia.
+CONTADOR_LIBROS_ESTANTERIA = "libros_estanteria"
+
+def calcular_libros_estanteria():
+    """Suma de DISPONIBLES (> 0) en todo el inventario, calculada por MongoDB"""
+    resultado = list(inventario.aggregate([
+        {"$match": {"DISPONIBLES": {"$gt": 0}}},
+        {"$group": {"_id": None, "total": {"$sum": "$DISPONIBLES"}}}
+    ]))
+    return resultado[0]["total"] if resultado else 0
+
+def ajustar_libros_estanteria(anterior, nuevo, session=None):
+    """Aplica al contador el cambio de DISPONIBLES de un libro (anterior -> nuevo)"""
+    delta = max(0, nuevo or 0) - max(0, anterior or 0)
+    if delta:
+        contadores.update_one({"_id": CONTADOR_LIBROS_ESTANTERIA}, {"$inc": {"total": delta}},
+                              upsert=True, session=session)
+
+def reconciliar_libros_estanteria():
+    """Reconstruye el contador desde el inventario y reporta la deriva encontrada"""
+    anterior = contadores.find_one({"_id": CONTADOR_LIBROS_ESTANTERIA})
+    calculado = calcular_libros_estanteria()
+    contadores.update_one(
+        {"_id": CONTADOR_LIBROS_ESTANTERIA},
+        {"$set": {"total": calculado, "reconciliado_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    anterior_total = anterior.get("total") if anterior else None
+    diferencia = calculado - anterior_total if anterior_total is not None else None
+    if diferencia:
+        print(f"[CONTADORES] libros_estanteria corregido: {anterior_total} -> {calculado} (diferencia {diferencia})")
+    return {"anterior": anterior_total, "calculado": calculado, "diferencia": diferencia}
+
+CONTADOR_ALUMNOS = "alumnos"
+
+def reconciliar_total_alumnos():
+    """Reconstruye Contadores/{_id: "alumnos"} con un conteo real"""
+    anterior = contadores.find_one({"_id": CONTADOR_ALUMNOS})
+    calculado = alumnos.count_documents({})
+    contadores.update_one({"_id": CONTADOR_ALUMNOS},
+                          {"$set": {"total": calculado, "reconciliado_at": datetime.now(timezone.utc)}}, upsert=True)
+    anterior_total = anterior.get("total") if anterior else None
+    diferencia = calculado - anterior_total if anterior_total is not None else None
+    if diferencia:
+        print(f"[CONTADORES] alumnos corregido: {anterior_total} -> {calculado} (diferencia {diferencia})")
+    return {"anterior": anterior_total, "calculado": calculado, "diferencia": diferencia}
+
+def contar_alumnos():
+    """Lectura O(1) del total de alumnos; si aún no existe se construye una vez"""
+    doc = contadores.find_one({"_id": CONTADOR_ALUMNOS}, {"total": 1})
+    if doc is None:
+        return reconciliar_total_alumnos()["calculado"]
+    return doc.get("total", 0)
+
+def contar_libros_estanteria():
+    """Lectura O(1) del contador; si aún no existe se construye una vez"""
+    doc = contadores.find_one({"_id": CONTADOR_LIBROS_ESTANTERIA}, {"total": 1})
+    if doc is None:
+        return reconciliar_libros_estanteria()["calculado"]
+    return doc.get("total", 0)
+
+# Contadores/{_id: "existencia_volumenes"} guarda la suma de U -> EXIST: los
+# volúmenes que tiene la biblioteca (EXISTENCIA TOTAL del reporte mensual), que
+# no cambian con préstamos y devoluciones como DISPONIBLES. La aplicación nunca
+# escribe U, así que el total sólo cambia con importaciones de inventario; se
+# reconstruye después de migrar_inventario y en la tarea nocturna "contadores".
+CONTADOR_EXISTENCIA_VOLUMENES = "existencia_volumenes"
+
+def calcular_existencia_volumenes():
+    """Suma de U -> EXIST en todo el inventario (la estructura varía por documento,
+    así que se lee sólo el campo U y se suma aquí)"""
+    total = 0
+    for doc in inventario.find({"U": {"$exists": True}}, {"U": 1}):
+        existencia = extract_number(obtener_disponibles(doc))
+        if existencia and existencia > 0:
+            total += existencia
+    return total
+
+def reconciliar_existencia_volumenes():
+    """Reconstruye Contadores/{_id: "existencia_volumenes"} y reporta la deriva encontrada"""
+    anterior = contadores.find_one({"_id": CONTADOR_EXISTENCIA_VOLUMENES})
+    calculado = calcular_existencia_volumenes()
+    contadores.update_one({"_id": CONTADOR_EXISTENCIA_VOLUMENES},
+                          {"$set": {"total": calculado, "reconciliado_at": datetime.now(timezone.utc)}}, upsert=True)
+    anterior_total = anterior.get("total") if anterior else None
+    diferencia = calculado - anterior_total if anterior_total is not None else None
+    if diferencia:
+        print(f"[CONTADORES] existencia_volumenes corregido: {anterior_total} -> {calculado} (diferencia {diferencia})")
+    return {"anterior": anterior_total, "calculado": calculado, "diferencia": diferencia}
+
+def contar_existencia_volumenes():
+    """Lectura O(1) del total de volúmenes; si aún no existe se construye una vez"""
+    doc = contadores.find_one({"_id": CONTADOR_EXISTENCIA_VOLUMENES}, {"total": 1})
+    if doc is None:
+        return reconciliar_existencia_volumenes()["calculado"]
+    return doc.get("total", 0)
+
+def normalizar_isbn(valor):
+    """Forma canónica de un ISBN: sólo dígitos y X, en mayúsculas ('978-607 1' -> '9786071')"""
+    if valor in (None, ''):
         return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return ''.join(c for c in str(valor).upper() if c.isdigit() or c == 'X')
+
+def consultas_libro_inventario(isbn, titulo):
+    """Filtros con los que se localiza un libro, en orden de preferencia: ISBN
+    normalizado (indexado), ISBN tal como se capturó (registros sin reindexar) y título"""
+    consultas = []
+    if isbn:
+        isbn_norm = normalizar_isbn(isbn)
+        if isbn_norm:
+            consultas.append({"isbn_normalizado": isbn_norm})
+        isbn_clean = str(isbn).replace('-', '').replace(' ', '').strip()
+        consultas.append({"ISBN": {"$in": list({str(isbn), isbn_clean})}})
+    if titulo:
+        consultas.append({"TÍTULO": titulo})
+    return consultas
+
+def buscar_libro_inventario(isbn, titulo, session=None):
+    """Localiza un libro por ISBN (con o sin guiones) y, si no aparece, por título.
+    Se queda con la primera consulta que encuentre algo, tenga o no ejemplares."""
+    for consulta in consultas_libro_inventario(isbn, titulo):
+        encontrado = inventario.find_one(consulta, {"DISPONIBLES": 1}, session=session)
+        if encontrado:
+            return encontrado
+    return None
 
-    skip = (page - 1) * page_size
-    cursor = inventario.find(query, {"_id": 0}).skip(skip).limit(page_size)
+# --- Listado paginado de Inventario ---
+# Paginación por cursor (keyset) sobre (busqueda_principal, _id), que tiene índice:
+# cada página continúa donde terminó la anterior sin skip(). Los filtros por campo
+# son coincidencias de prefijo sobre filtros_inventario, un arreglo multikey con
+# "campo:<texto normalizado desde cada palabra>" (p. ej. "titulo:potter y la
+# piedra"), así que "potter" encuentra "Harry Potter y la piedra" usando el índice.
+INVENTARIO_PAGE_SIZE = 50
+INVENTARIO_PAGE_SIZE_MAX = 200
+INVENTARIO_TOTAL_TTL = 60  # segundos que se reutiliza un total filtrado
+FILTROS_INVENTARIO = {"titulo": "TÍTULO", "autor": "AUTOR", "editorial": "EDITORIAL",
+                      "edicion": "EDICIÓN", "estante": "ESTANTE"}
+FILTRO_PALABRAS_MAX = 20  # palabras de cada campo desde las que se puede empezar a buscar
+
+_totales_filtrados = OrderedDict()
+_totales_filtrados_lock = threading.Lock()
+
+def texto_filtro(valor):
+    """Texto normalizado con sólo letras y dígitos separados por un espacio"""
+    return ' '.join(t for t in re.split(r'[^0-9a-z]+', normalizar_texto(valor)) if t)
+
+def claves_filtro_inventario(doc):
+    """Valores de filtros_inventario para un libro"""
+    claves = set()
+    for param, campo in FILTROS_INVENTARIO.items():
+        palabras = texto_filtro(primer_valor(doc, VARIANTES_INVENTARIO[campo])).split()
+        for i in range(min(len(palabras), FILTRO_PALABRAS_MAX)):
+            claves.add(f"{param}:{' '.join(palabras[i:])}")
+    return sorted(claves)
+
+def _codificar_cursor(valores):
+    return base64.urlsafe_b64encode(json.dumps(valores).encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decodificar_cursor(cursor):
+    """(valor, id) de un cursor recibido; ValueError si no es válido o no tiene esa forma"""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("cursor inválido")
+    if (not isinstance(valores, list) or len(valores) != 2 or not isinstance(valores[0], (str, type(None)))
+            or not isinstance(valores[1], str) or not valores[1]):
+        raise ValueError("cursor inválido")
+    return valores[0], valores[1]
+
+def _condicion_despues_de(campo, valor, id_str):
+    """Documentos que van después de (valor, _id) en el orden (campo, _id)"""
+    try:
+        _id = ObjectId(id_str)
+    except Exception:
+        _id = id_str
+    if valor is None:
+        # los documentos sin el campo ordenan primero; luego vienen todos los que sí lo tienen
+        return {"$or": [{campo: None, "_id": {"$gt": _id}}, {campo: {"$type": "string"}}]}
+    return {"$or": [{campo: {"$gt": valor}}, {campo: valor, "_id": {"$gt": _id}}]}
+
+def total_filtrado(coleccion, query, clave):
+    """Conteo de un listado con filtros, guardado INVENTARIO_TOTAL_TTL segundos o hasta
+    el siguiente invalidar_cache_busqueda()"""
+    ahora = time.time()
+    version = _cache_busqueda_version[0]
+    clave = (coleccion.name, clave)
+    with _totales_filtrados_lock:
+        guardado = _totales_filtrados.get(clave)
+        if guardado and guardado[0] == version and guardado[1] > ahora:
+            return guardado[2]
+    total = coleccion.count_documents(query)
+    with _totales_filtrados_lock:
+        _totales_filtrados[clave] = (version, ahora + INVENTARIO_TOTAL_TTL, total)
+        while len(_totales_filtrados) > BUSQUEDA_CACHE_MAX:
+            _totales_filtrados.popitem(last=False)
+    return total
+
+def fila_inventario(doc):
+    return {
+        "ISBN": doc.get("ISBN") or '',
+        "Titulo": doc.get("TÍTULO") or '',
+        "Autor": doc.get("AUTOR") or '',
+        "Editorial": doc.get("EDITORIAL") or '',
+        "Edicion": doc.get("EDICIÓN") or '-',
+        "Estante": doc.get("ESTANTE") or '',
+        "Disponibles": doc.get("DISPONIBLES") or 0
+    }
 
-    items = []
-    for doc in cursor:
-        # EDICIÓN: buscar muchas variantes y en subobjetos
-        ed = find_field(doc, ["EDICIÓN","EDICION","Edicion","edicion","Edición"])
-        if isinstance(ed, dict):
-            ed = ed.get("valor") or ed.get("value") or ed.get("") or ''
-        ed = str(ed) if ed not in (None, '') else ''
-
-        # DISPONIBLES: buscar variantes y fallback a obtener_disponibles
-        disp = find_field(doc, ["DISPONIBLES","Disponibles","disponible","DISPONIBLE"])
-        if disp in (None, ''):
-            disp = obtener_disponibles(doc)
+@app.route('/api/inventario', methods=['GET'])
+def api_inventario():
+    """Listado del inventario. Con ?cursor= (el next_cursor de la página anterior)
+    la página se lee por keyset; page sin cursor se mantiene por compatibilidad."""
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = min(max(1, request.args.get('page_size', INVENTARIO_PAGE_SIZE, type=int)), INVENTARIO_PAGE_SIZE_MAX)
+    cursor_param = request.args.get('cursor', '').strip()
+
+    condiciones = []
+    filtros = []
+    for param in FILTROS_INVENTARIO:
+        valor = texto_filtro(request.args.get(param, ''))
+        if valor:
+            filtros.append((param, valor))
+            condiciones.append({"filtros_inventario": {"$regex": "^" + re.escape(f"{param}:{valor}")}})
+    query = {"$and": condiciones} if len(condiciones) > 1 else (condiciones[0] if condiciones else {})
+
+    consulta = query
+    if cursor_param:
         try:
-            disp = int(disp)
-        except Exception:
-            disp = 0
+            principal, id_str = _decodificar_cursor(cursor_param)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        consulta = {"$and": [c for c in (query, _condicion_despues_de("busqueda_principal", principal, id_str)) if c]}
+
+    proyeccion = dict(PROYECCION_INVENTARIO, _id=1, busqueda_principal=1)
+    cursor = inventario.find(consulta, proyeccion).sort([("busqueda_principal", 1), ("_id", 1)])
+    if not cursor_param and page > 1:
+        cursor = cursor.skip((page - 1) * page_size)
+    cursor = cursor.limit(page_size + 1)  # uno de más para saber si hay otra página
+
+    def generar():
+        yield '{"inventario": ['
+        ultimo = None
+        for n, doc in enumerate(cursor):
+            if n == page_size:
+                break
+            yield (', ' if n else '') + json.dumps(fila_inventario(doc), ensure_ascii=False, default=str)
+            ultimo = doc
+        hay_mas = ultimo is not None and n == page_size
+        siguiente = _codificar_cursor([ultimo.get("busqueda_principal"), str(ultimo["_id"])]) if hay_mas else None
+        total = total_filtrado(inventario, query, tuple(filtros)) if query else inventario.estimated_document_count()
+        yield '], ' + json.dumps({"total": total, "page": page, "page_size": page_size,
+                                  "next_cursor": siguiente})[1:]
 
-        items.append({
-            "ISBN": find_field(doc, ["ISBN","Isbn","isbn"]) or '',
-            "Titulo": find_field(doc, ["TÍTULO","TITULO","Titulo","titulo"]) or '',
-            "Autor": find_field(doc, ["AUTOR","Autor","autor"]) or '',
-            "Editorial": find_field(doc, ["EDITORIAL","Editorial","editorial"]) or '',
-            "Edicion": ed or '-',
-            "Estante": find_field(doc, ["ESTANTE","Estante","estante"]) or '',
-            "Disponibles": disp
-        })
+    return Response(stream_with_context(generar()), mimetype='application/json')
 
-    total = inventario.count_documents(query)
-    return jsonify({"inventario": items, "total": total, "page": page, "page_size": page_size})
 
 @app.route('/api/docentes')
 def get_docentes():
@@ -187,41 +643,10 @@ def buscar_alumno():
     if not boleta:
         return jsonify({"encontrado": False, "error": "Boleta requerida"}), 400
     
-    # Buscar en múltiples formatos de boleta (string y número)
-    or_clauses = [
-        {"Boleta": boleta},
-        {"boleta": boleta}
-    ]
-    
-    # Si la boleta es numérica, también buscar como número
-    if boleta.isdigit():
-        try:
-            boleta_int = int(boleta)
-            or_clauses.append({"Boleta": boleta_int})
-            or_clauses.append({"boleta": boleta_int})
-        except Exception:
-            pass
-    
-    query = {"$or": or_clauses}
-    
-    doc = alumnos.find_one(query, {"_id": 0})
-    if not doc:
+    alumno = resolver_identidad('alumno', boleta)
+    if not alumno:
         return jsonify({"encontrado": False})
-    
-    def pick(doc, keys):
-        for k in keys:
-            if k in doc and doc[k] not in (None, ''):
-                return doc[k]
-        return ''
-    
-    return jsonify({
-        "encontrado": True,
-        "Nombre": pick(doc, ["Nombre","nombre","Nombre Del Alumno:\n(Completo)"]),
-        "Boleta": pick(doc, ["Boleta","boleta"]),
-        "Correo": pick(doc, ["Correo","correo","Email","email"]),
-        "Grupo": pick(doc, ["Grupo","grupo"]),
-        "Carga": pick(doc, ["Carga","carga","Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"])
-    })
+    return jsonify(dict(alumno, encontrado=True))
 
 @app.route('/api/buscar_docente')
 def buscar_docente():
@@ -230,66 +655,56 @@ def buscar_docente():
     if not no_empleado:
         return jsonify({"encontrado": False, "error": "Número de empleado requerido"}), 400
     
-    # Buscar en múltiples formatos de número de empleado
-    or_clauses = [
-        {"No Empleado": no_empleado},
-        {"NoEmpleado": no_empleado},
-        {"no_empleado": no_empleado},
-        {"noEmpleado": no_empleado}
-    ]
-    
-    # Si el número de empleado es numérico, también buscar como número
-    if no_empleado.isdigit():
-        try:
-            no_empleado_int = int(no_empleado)
-            or_clauses.append({"No Empleado": no_empleado_int})
-            or_clauses.append({"NoEmpleado": no_empleado_int})
-        except Exception:
-            pass
-    
-    query = {"$or": or_clauses}
-    
-    doc = db["Docentes"].find_one(query, {"_id": 0})
-    if not doc:
+    docente = resolver_identidad('docente', no_empleado)
+    if not docente:
         return jsonify({"encontrado": False})
-    
-    return jsonify({
-        "encontrado": True,
-        "Nombre": doc.get("Nombre Completo", "") or doc.get("Nombre", "") or doc.get("nombre", ""),
-        "NoEmpleado": doc.get("No Empleado", "") or doc.get("NoEmpleado", "") or doc.get("no_empleado", "") or doc.get("noEmpleado", ""),
-        "Correo": doc.get("Correo", "") or doc.get("correo", ""),
-        "Turno": doc.get("Turno", "") or doc.get("turno", ""),
-        "Ocupacion": doc.get("Ocupación \n(Docente u otro)", "") or doc.get("Ocupacion", "") or doc.get("ocupacion", "") or doc.get("Cargo", "") or doc.get("cargo", "")
-    })
+    return jsonify(dict(docente, encontrado=True))
+
+ALUMNOS_PAGE_SIZE = 50
+ALUMNOS_PAGE_SIZE_MAX = 200
 
 @app.route('/api/alumnos')
 def get_alumnos():
-    # Recibe el parámetro de página (por defecto 1)
-    try:
-        page = int(request.args.get('page', 1))
-    except Exception:
-        page = 1
-    page_size = 50
-    skip = (page - 1) * page_size
-
-    def pick(doc, keys):
-        for k in keys:
-            if k in doc and doc[k] not in (None, ''):
-                return doc[k]
-        return ''
-
-    alumnos_cursor = alumnos.find({}, {"_id": 0}).skip(skip).limit(page_size)
-    data = []
-    for doc in alumnos_cursor:
-        data.append({
-            "Nombre": pick(doc, ["Nombre","nombre","Nombre Del Alumno:\n(Completo)"]),
-            "Boleta": pick(doc, ["Boleta","boleta"]),
-            "Correo": pick(doc, ["Correo","correo","Email","email"]),
-            "Grupo": pick(doc, ["Grupo","grupo"]),
-            "Carga": pick(doc, ["Carga","carga","Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"])
-        })
-    total = alumnos.count_documents({})
-    return jsonify({"alumnos": data, "total": total, "page": page, "page_size": page_size})
+    """Listado de alumnos por nombre, paginado por cursor (?cursor= con el next_cursor
+    anterior) y filtrable por ?grupo= y ?carga=. page sin cursor se mantiene por compatibilidad."""
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = min(max(1, request.args.get('page_size', ALUMNOS_PAGE_SIZE, type=int)), ALUMNOS_PAGE_SIZE_MAX)
+    cursor_param = request.args.get('cursor', '').strip()
+
+    filtros = []
+    for param in ("grupo", "carga"):
+        valor = texto_filtro(request.args.get(param, ''))
+        if valor:
+            filtros.append(f"{param}:{valor}")
+    query = {"filtros_alumno": {"$all": filtros}} if filtros else {}
+
+    consulta = query
+    if cursor_param:
+        try:
+            principal, id_str = _decodificar_cursor(cursor_param)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        consulta = {"$and": [c for c in (query, _condicion_despues_de("busqueda_principal", principal, id_str)) if c]}
+
+    alumnos_cursor = alumnos.find(consulta, PROYECCION_ALUMNOS).sort([("busqueda_principal", 1), ("_id", 1)])
+    if not cursor_param and page > 1:
+        alumnos_cursor = alumnos_cursor.skip((page - 1) * page_size)
+    docs = list(alumnos_cursor.limit(page_size + 1))  # uno de más para saber si hay otra página
+
+    siguiente = None
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        siguiente = _codificar_cursor([docs[-1].get("busqueda_principal"), str(docs[-1]["_id"])])
+    data = [{
+        "Nombre": primer_valor(doc, CAMPOS_NOMBRE_ALUMNO),
+        "Boleta": primer_valor(doc, CAMPOS_BOLETA),
+        "Correo": primer_valor(doc, CAMPOS_CORREO_ALUMNO),
+        "Grupo": primer_valor(doc, CAMPOS_GRUPO),
+        "Carga": primer_valor(doc, CAMPOS_CARGA)
+    } for doc in docs]
+    total = total_filtrado(alumnos, query, tuple(filtros)) if filtros else contar_alumnos()
+    return jsonify({"alumnos": data, "total": total, "page": page, "page_size": page_size,
+                    "next_cursor": siguiente})
 
 @app.route('/api/registrar_alumno', methods=['POST'])
 def registrar_alumno():
@@ -302,8 +717,14 @@ def registrar_alumno():
         "Grupo": datos.get("Grupo") or datos.get("grupo") or '',
         "Carga": datos.get("Carga") or datos.get("carga") or datos.get("Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)") or ''
     }
+    doc.update(campos_busqueda("alumno", doc))
     try:
         alumnos.insert_one(doc)
+        # sin contador todavía, un upsert lo dejaría en 1: se construye con el conteo real
+        if not contadores.update_one({"_id": CONTADOR_ALUMNOS}, {"$inc": {"total": 1}}).matched_count:
+            reconciliar_total_alumnos()
+        invalidar_cache_busqueda()
+        invalidar_identidad('alumno', doc["Boleta"])
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -323,8 +744,11 @@ def registrar_docente():
         "Turno": datos.get("Turno") or datos.get("turno") or '',
         "Ocupación \n(Docente u otro)": ocupacion
     }
+    doc.update(campos_busqueda("docente", doc))
     try:
         db["Docentes"].insert_one(doc)
+        invalidar_cache_busqueda()
+        invalidar_identidad('docente', doc["No Empleado"])
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -372,33 +796,8 @@ def get_dashboard():
     except Exception:
         prestamos_hoy = 0
 
-    # libros en estantería: sumar DISPONIBLES en inventario (con varios fallbacks)
-    libros_en_estanteria = 0
-    for doc in inventario.find({}):
-        val = None
-        # 1) claves directas preferidas
-        for k in ("DISPONIBLES","Disponibles","disponibles","DISPONIBLE","Disponible"):
-            if k in doc and doc.get(k) not in (None, ''):
-                val = extract_number(doc.get(k))
-                if val is not None:
-                    break
-        # 2) intentar normalizar otras claves (por si hay variaciones)
-        if val is None:
-            for k in doc.keys():
-                kn = unidecode(str(k)).upper().replace(" ", "")
-                if "DISPON" in kn or "EXIST" in kn:
-                    val = extract_number(doc.get(k))
-                    if val is not None:
-                        break
-        # 3) fallback a obtener_disponibles que maneja estructura U
-        if val is None:
-            try:
-                od = obtener_disponibles(doc)
-                val = extract_number(od)
-            except Exception:
-                val = None
-        if isinstance(val, int) and val > 0:
-            libros_en_estanteria += val
+    # libros en estantería: suma de DISPONIBLES en inventario
+    libros_en_estanteria = contar_libros_estanteria()
 
     # devoluciones atrasadas
     devoluciones_atrasadas = 0
@@ -415,7 +814,7 @@ def get_dashboard():
     except Exception:
         devoluciones_atrasadas = 0
 
-    nuevos_usuarios = db["Alumnos"].count_documents({})
+    nuevos_usuarios = contar_alumnos()
 
     return jsonify({
         "prestamos_hoy": prestamos_hoy,
@@ -468,10 +867,8 @@ def proximas_devoluciones():
 
 @app.route('/api/devoluciones', methods=['GET'])
 def api_devoluciones():
-    """Lista todas las devoluciones pendientes (préstamos activos y vencidos)"""
-    # Verificar y actualizar préstamos vencidos antes de listar
-    verificar_y_actualizar_prestamos_vencidos()
-    
+    """Lista todas las devoluciones pendientes (préstamos activos y vencidos).
+    Sólo lectura: los cambios de estado los hace la tarea programada "vencimientos"."""
     items = []
     tz_mexico = pytz.timezone('America/Mexico_City')
     hoy = datetime.now(tz_mexico).date()
@@ -515,224 +912,374 @@ def api_devoluciones():
     
     return jsonify({"devoluciones": items})
 
-@app.route('/api/buscar')
-def buscar():
-    q = request.args.get('q', '').strip()
-    if not q:
-        return jsonify({"libros": [], "alumnos": []})
+# --- Motor de búsqueda ---
+# Cada documento de Inventario, Alumnos y Docentes guarda una clave normalizada
+# (sin acentos, minúsculas) y la lista de prefijos de sus palabras. Las
+# búsquedas se resuelven con un índice multikey sobre "busqueda_ngramas" y el
+# ranking se calcula en MongoDB, de modo que el servidor web nunca recorre
+# colecciones completas. Títulos, autores y nombres se encuentran por el inicio
+# de sus palabras ("pot" encuentra "Potter", "otter" no); ISBN, boleta y número
+# de empleado guardan además todas sus subcadenas, así que un fragmento
+# intermedio los sigue encontrando como en la búsqueda anterior.
+BUSQUEDA_NGRAMA_MAX = 15  # longitud máxima de prefijo indexado
+BUSQUEDA_PAGE_SIZE = 50
+BUSQUEDA_PAGE_SIZE_MAX = 100
+BUSQUEDA_CACHE_TTL = 30  # segundos
+BUSQUEDA_CACHE_MAX = 256  # consultas distintas en memoria
+
+CAMPOS_TITULO = ["TÍTULO", "TITULO", "Titulo", "titulo", "Título", "title"]
+CAMPOS_ISBN = ["ISBN", "Isbn", "isbn"]
+CAMPOS_AUTOR = ["AUTOR", "Autor", "autor"]
+CAMPOS_EDITORIAL = ["EDITORIAL", "Editorial", "editorial"]
+CAMPOS_NOMBRE_ALUMNO = ["Nombre", "nombre", "Nombre Del Alumno:\n(Completo)", "Nombre Completo"]
+CAMPOS_BOLETA = ["Boleta", "boleta"]
+CAMPOS_CORREO_ALUMNO = ["Correo", "correo", "Email", "email"]
+CAMPOS_GRUPO = ["Grupo", "grupo"]
+CAMPOS_CARGA = ["Carga", "carga", "Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"]
+CAMPOS_NOMBRE_DOCENTE = ["Nombre Completo", "Nombre", "nombre"]
+CAMPOS_NO_EMPLEADO = ["No Empleado", "NoEmpleado", "no_empleado", "noEmpleado"]
+
+# campos que muestra el listado de alumnos (todas sus variantes) y su clave de orden
+PROYECCION_ALUMNOS = {k: 1 for k in CAMPOS_NOMBRE_ALUMNO + CAMPOS_BOLETA + CAMPOS_CORREO_ALUMNO +
+                      CAMPOS_GRUPO + CAMPOS_CARGA + ["busqueda_principal"]}
+
+CAMPOS_INTERNOS_BUSQUEDA = ("busqueda_clave", "busqueda_principal", "busqueda_ngramas",
+                            "filtros_inventario", "filtros_alumno", "id_canonico", "isbn_normalizado")
+
+def primer_valor(doc, keys):
+    """Devuelve el primer valor no vacío de doc entre las claves indicadas"""
+    for k in keys:
+        v = doc.get(k)
+        if v is not None and str(v).strip():
+            return v
+    return ''
+
+def normalizar_texto(valor):
+    """Normaliza texto para búsqueda: sin acentos, minúsculas y espacios simples"""
+    if valor is None:
+        return ''
+    return ' '.join(unidecode(str(valor)).lower().split())
+
+def tokens_busqueda(texto_norm):
+    """Separa un texto ya normalizado en palabras alfanuméricas (ISBN sin guiones)"""
+    texto_norm = re.sub(r'(?<=\d)[- ](?=\d)', '', texto_norm)
+    return [t for t in re.split(r'[^0-9a-z]+', texto_norm) if t]
+
+def generar_ngramas(texto_norm):
+    """Prefijos de cada palabra (1..BUSQUEDA_NGRAMA_MAX) para el índice multikey"""
+    ngramas = set()
+    for token in tokens_busqueda(texto_norm):
+        for i in range(1, min(len(token), BUSQUEDA_NGRAMA_MAX) + 1):
+            ngramas.add(token[:i])
+    return sorted(ngramas)
+
+def generar_subcadenas(texto_norm):
+    """Subcadenas de cada palabra (hasta BUSQUEDA_NGRAMA_MAX caracteres) de un
+    identificador, para encontrarlo por un fragmento intermedio"""
+    ngramas = set()
+    for token in tokens_busqueda(texto_norm):
+        for inicio in range(len(token)):
+            for fin in range(inicio + 1, min(len(token), inicio + BUSQUEDA_NGRAMA_MAX) + 1):
+                ngramas.add(token[inicio:fin])
+    return ngramas
+
+def campos_busqueda(tipo, doc):
+    """Calcula los campos de búsqueda que se guardan junto al documento.
+    tipo: 'libro', 'alumno' o 'docente'."""
+    if tipo == 'libro':
+        principal = primer_valor(doc, CAMPOS_TITULO)
+        otros = [primer_valor(doc, CAMPOS_ISBN), primer_valor(doc, CAMPOS_AUTOR),
+                 primer_valor(doc, CAMPOS_EDITORIAL)]
+    elif tipo == 'alumno':
+        principal = primer_valor(doc, CAMPOS_NOMBRE_ALUMNO)
+        otros = [primer_valor(doc, CAMPOS_BOLETA)]
+    else:
+        principal = primer_valor(doc, CAMPOS_NOMBRE_DOCENTE)
+        otros = [primer_valor(doc, CAMPOS_NO_EMPLEADO)]
+    principal_norm = normalizar_texto(principal)
+    clave = ' | '.join([principal_norm] + [normalizar_texto(o) for o in otros if o not in (None, '')])
+    campos = {
+        "busqueda_clave": clave,
+        "busqueda_principal": principal_norm,
+        "busqueda_ngramas": sorted(set(generar_ngramas(clave)) | generar_subcadenas(normalizar_texto(otros[0])))
+    }
+    if tipo == 'libro':
+        campos["filtros_inventario"] = claves_filtro_inventario(doc)
+        campos["isbn_normalizado"] = normalizar_isbn(otros[0])
+    if tipo in ('alumno', 'docente'):
+        campos["id_canonico"] = normalizar_id(otros[0])
+    if tipo == 'alumno':
+        campos["filtros_alumno"] = [f"{param}:{texto_filtro(primer_valor(doc, claves))}"
+                                    for param, claves in (("grupo", CAMPOS_GRUPO), ("carga", CAMPOS_CARGA))
+                                    if texto_filtro(primer_valor(doc, claves))]
+    return campos
+
+# --- Resolución de identidades (boleta / número de empleado) ---
+# Alumnos y Docentes guardan id_canonico (ver normalizar_id) junto a sus campos
+# de búsqueda, con índice, así que cada consulta por boleta o número de empleado
+# es una sola lectura indexada. Los resultados (también los "no encontrado") se
+# guardan en una caché LRU con caducidad; registrar_alumno, registrar_docente y
+# actualizar_alumno invalidan la entrada que cambian.
+IDENTIDAD_CACHE_MAX = 4096
+IDENTIDAD_CACHE_TTL = 300  # segundos
+IDENTIDAD_CACHE_TTL_NO_ENCONTRADO = 30
+CAMPOS_CORREO_DOCENTE = ["Correo", "correo"]
+CAMPOS_TURNO = ["Turno", "turno"]
+CAMPOS_OCUPACION = ["Ocupación \n(Docente u otro)", "Ocupacion", "ocupacion", "Cargo", "cargo"]
+
+_cache_identidades = OrderedDict()
+_cache_identidades_lock = threading.Lock()
+
+def normalizar_id(valor):
+    """Forma canónica de una boleta o número de empleado: texto sin espacios y en
+    mayúsculas; los numéricos (incluido 123.0 de Excel) sin ceros a la izquierda"""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = ''.join(str(valor).split()).upper()
+    if re.fullmatch(r'\d+(\.0+)?', texto):
+        return str(int(texto.split('.')[0]))
+    return texto
+
+def _coleccion_identidad(tipo):
+    return alumnos if tipo == 'alumno' else db["Docentes"]
+
+def _consulta_legada_identidad(tipo, valor):
+    """Consulta por todas las variantes de campo (documentos sin id_canonico)"""
+    claves = CAMPOS_BOLETA if tipo == 'alumno' else CAMPOS_NO_EMPLEADO
+    valores = [valor] + ([int(valor)] if valor.isdigit() else [])
+    return {"$or": [{k: v} for k in claves for v in valores]}
+
+def _resumen_identidad(tipo, doc):
+    if tipo == 'alumno':
+        return {
+            "Nombre": primer_valor(doc, CAMPOS_NOMBRE_ALUMNO),
+            "Boleta": primer_valor(doc, CAMPOS_BOLETA),
+            "Correo": primer_valor(doc, CAMPOS_CORREO_ALUMNO),
+            "Grupo": primer_valor(doc, CAMPOS_GRUPO),
+            "Carga": primer_valor(doc, CAMPOS_CARGA)
+        }
+    return {
+        "Nombre": primer_valor(doc, CAMPOS_NOMBRE_DOCENTE),
+        "NoEmpleado": primer_valor(doc, CAMPOS_NO_EMPLEADO),
+        "Correo": primer_valor(doc, CAMPOS_CORREO_DOCENTE),
+        "Turno": primer_valor(doc, CAMPOS_TURNO),
+        "Ocupacion": primer_valor(doc, CAMPOS_OCUPACION)
+    }
 
-    # Normaliza la búsqueda (sin acentos, minúsculas)
-    q_norm = unidecode(q).lower()
-
-    # Libros: busca por título, ISBN, autor o editorial (múltiples variantes)
-    libros = []
-    for doc in inventario.find({}, {"_id": 0}):
-        # Buscar en múltiples campos y variantes
-        titulo_variantes = [
-            doc.get("TÍTULO", ""),
-            doc.get("TITULO", ""),
-            doc.get("Titulo", ""),
-            doc.get("titulo", ""),
-            doc.get("Título", ""),
-            doc.get("title", "")
-        ]
-        titulo = ""
-        for t in titulo_variantes:
-            if t and str(t).strip():
-                titulo = str(t)
-                break
-        
-        isbn_variantes = [
-            doc.get("ISBN", ""),
-            doc.get("Isbn", ""),
-            doc.get("isbn", "")
-        ]
-        isbn = ""
-        for i in isbn_variantes:
-            if i and str(i).strip():
-                isbn = str(i)
-                break
-        
-        autor_variantes = [
-            doc.get("AUTOR", ""),
-            doc.get("Autor", ""),
-            doc.get("autor", "")
-        ]
-        autor = ""
-        for a in autor_variantes:
-            if a and str(a).strip():
-                autor = str(a)
-                break
-        
-        editorial_variantes = [
-            doc.get("EDITORIAL", ""),
-            doc.get("Editorial", ""),
-            doc.get("editorial", "")
-        ]
-        editorial = ""
-        for e in editorial_variantes:
-            if e and str(e).strip():
-                editorial = str(e)
-                break
-        
-        titulo_norm = unidecode(titulo).lower()
-        isbn_norm = unidecode(isbn).lower()
-        autor_norm = unidecode(autor).lower()
-        editorial_norm = unidecode(editorial).lower()
-        
-        if (q_norm in titulo_norm or q_norm in isbn_norm or 
-            q_norm in autor_norm or q_norm in editorial_norm):
-            libros.append(doc)
-
-    # Alumnos: busca por nombre o boleta (soporta ambos formatos de campo nombre)
-    alumnos = []
-    for doc in db["Alumnos"].find({}, {"_id": 0}):
-        # Buscar nombre en múltiples campos posibles
-        nombre_variantes = [
-            doc.get("Nombre", ""),
-            doc.get("nombre", ""),
-            doc.get("Nombre Del Alumno:\n(Completo)", ""),
-            doc.get("Nombre Completo", "")
+def resolver_identidad(tipo, valor):
+    """Datos de un alumno (tipo 'alumno', por boleta) o docente (por número de
+    empleado), o None si no existe. Responde desde la caché cuando puede."""
+    canonico = normalizar_id(valor)
+    if not canonico:
+        return None
+    clave = (tipo, canonico)
+    ahora = time.time()
+    with _cache_identidades_lock:
+        guardado = _cache_identidades.get(clave)
+        if guardado and guardado[0] > ahora:
+            _cache_identidades.move_to_end(clave)
+            return guardado[1]
+    if tipo == 'alumno':
+        claves = CAMPOS_NOMBRE_ALUMNO + CAMPOS_BOLETA + CAMPOS_CORREO_ALUMNO + CAMPOS_GRUPO + CAMPOS_CARGA
+    else:
+        claves = CAMPOS_NOMBRE_DOCENTE + CAMPOS_NO_EMPLEADO + CAMPOS_CORREO_DOCENTE + CAMPOS_TURNO + CAMPOS_OCUPACION
+    proyeccion = dict.fromkeys(claves, 1)
+    proyeccion["_id"] = 0
+    coleccion = _coleccion_identidad(tipo)
+    doc = coleccion.find_one({"id_canonico": canonico}, proyeccion)
+    if doc is None:
+        # documentos anteriores a indexar_busqueda.py
+        doc = coleccion.find_one(_consulta_legada_identidad(tipo, str(valor).strip()), proyeccion)
+    resumen = _resumen_identidad(tipo, doc) if doc else None
+    caducidad = IDENTIDAD_CACHE_TTL if resumen else IDENTIDAD_CACHE_TTL_NO_ENCONTRADO
+    with _cache_identidades_lock:
+        _cache_identidades[clave] = (ahora + caducidad, resumen)
+        _cache_identidades.move_to_end(clave)
+        while len(_cache_identidades) > IDENTIDAD_CACHE_MAX:
+            _cache_identidades.popitem(last=False)
+    return resumen
+
+def invalidar_identidad(tipo, valor):
+    """Descarta de la caché la identidad indicada (después de darla de alta o cambiarla)"""
+    with _cache_identidades_lock:
+        _cache_identidades.pop((tipo, normalizar_id(valor)), None)
+
+def _rango_busqueda(q_norm, principal, clave):
+    """Ranking: 0 = coincidencia exacta, 1 = empieza igual, 2 = contiene la frase, 3 = sólo palabras"""
+    if principal == q_norm:
+        return 0
+    if principal.startswith(q_norm):
+        return 1
+    if q_norm in clave:
+        return 2
+    return 3
+
+class IndiceBusquedaMongo:
+    """Búsqueda paginada y rankeada resuelta por MongoDB sobre busqueda_ngramas"""
+
+    def __init__(self, coleccion, tipo):
+        self.coleccion = coleccion
+        self.tipo = tipo
+
+    def indexar(self, filtro, doc):
+        self.coleccion.update_one(filtro, {"$set": campos_busqueda(self.tipo, doc)})
+
+    def buscar(self, q_norm, skip, limit):
+        tokens = [t[:BUSQUEDA_NGRAMA_MAX] for t in tokens_busqueda(q_norm)]
+        if not tokens:
+            return 0, []
+        proyeccion = {"_id": 0, "_rango": 0}
+        for campo in CAMPOS_INTERNOS_BUSQUEDA:
+            proyeccion[campo] = 0
+        pipeline = [
+            {"$match": {"busqueda_ngramas": {"$all": tokens}}},
+            {"$addFields": {"_rango": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$busqueda_principal", q_norm]}, "then": 0},
+                    {"case": {"$eq": [{"$indexOfCP": ["$busqueda_principal", q_norm]}, 0]}, "then": 1},
+                    {"case": {"$gte": [{"$indexOfCP": ["$busqueda_clave", q_norm]}, 0]}, "then": 2}
+                ],
+                "default": 3
+            }}}},
+            {"$sort": {"_rango": 1, "busqueda_principal": 1}},
+            {"$facet": {
+                "total": [{"$count": "n"}],
+                "items": [{"$skip": skip}, {"$limit": limit}, {"$project": proyeccion}]
+            }}
         ]
-        nombre = ""
-        for n in nombre_variantes:
-            if n and str(n).strip():
-                nombre = str(n)
-                break
-        
-        nombre_norm = unidecode(nombre).lower()
-        boleta = str(doc.get("Boleta", "")).lower()
-        if q_norm in nombre_norm or q_norm in boleta:
-            alumnos.append(doc)
+        resultado = next(self.coleccion.aggregate(pipeline), {"total": [], "items": []})
+        total = resultado["total"][0]["n"] if resultado["total"] else 0
+        return total, resultado["items"]
+
+class IndiceBusquedaMemoria:
+    """Sustituto local en memoria con la misma interfaz y el mismo ranking, para
+    pruebas sin MongoDB (mongomock no implementa $indexOfCP del pipeline)"""
+
+    def __init__(self, tipo):
+        self.tipo = tipo
+        self.documentos = {}
+        self.invertido = {}
+
+    def indexar(self, filtro, doc):
+        clave_doc = repr(sorted(filtro.items()))
+        self.eliminar(clave_doc)
+        campos = campos_busqueda(self.tipo, doc)
+        visibles = {k: v for k, v in doc.items() if k != "_id" and k not in CAMPOS_INTERNOS_BUSQUEDA}
+        self.documentos[clave_doc] = (campos, visibles)
+        for ngrama in campos["busqueda_ngramas"]:
+            self.invertido.setdefault(ngrama, set()).add(clave_doc)
+
+    def eliminar(self, clave_doc):
+        previo = self.documentos.pop(clave_doc, None)
+        if previo:
+            for ngrama in previo[0]["busqueda_ngramas"]:
+                self.invertido.get(ngrama, set()).discard(clave_doc)
+
+    def buscar(self, q_norm, skip, limit):
+        tokens = [t[:BUSQUEDA_NGRAMA_MAX] for t in tokens_busqueda(q_norm)]
+        if not tokens:
+            return 0, []
+        candidatos = set.intersection(*(self.invertido.get(t, set()) for t in tokens))
+        ordenados = sorted(
+            (self.documentos[c] for c in candidatos),
+            key=lambda par: (_rango_busqueda(q_norm, par[0]["busqueda_principal"], par[0]["busqueda_clave"]),
+                             par[0]["busqueda_principal"])
+        )
+        return len(ordenados), [dict(doc) for _, doc in ordenados[skip:skip + limit]]
+
+# Registro de motores de búsqueda: cualquier objeto con buscar(q_norm, skip, limit)
+# que devuelva (total, items). Las pruebas lo sustituyen por IndiceBusquedaMemoria.
+indices_busqueda = {
+    "libros": IndiceBusquedaMongo(inventario, "libro"),
+    "alumnos": IndiceBusquedaMongo(alumnos, "alumno"),
+    "docentes": IndiceBusquedaMongo(db["Docentes"], "docente")
+}
+
+_cache_busqueda = OrderedDict()
+_cache_busqueda_lock = threading.Lock()
+_cache_busqueda_version = [0]
+
+def invalidar_cache_busqueda():
+    """Descarta resultados en caché; llamar después de cualquier alta o cambio"""
+    with _cache_busqueda_lock:
+        _cache_busqueda_version[0] += 1
+        _cache_busqueda.clear()
+
+def buscar_catalogo(q, tipos, page=1, page_size=BUSQUEDA_PAGE_SIZE):
+    """Busca q en los índices indicados y devuelve {tipo: {"total": n, "items": [...]}}.
+    Los resultados se guardan en caché unos segundos para consultas repetidas."""
+    q_norm = normalizar_texto(q)
+    page = max(1, page)
+    page_size = max(1, min(page_size, BUSQUEDA_PAGE_SIZE_MAX))
+    clave = (q_norm, tuple(tipos), page, page_size)
+    ahora = time.monotonic()
+    with _cache_busqueda_lock:
+        version = _cache_busqueda_version[0]
+        en_cache = _cache_busqueda.get(clave)
+        if en_cache and ahora - en_cache[0] < BUSQUEDA_CACHE_TTL:
+            _cache_busqueda.move_to_end(clave)
+            return en_cache[1]
 
-    return jsonify({"libros": libros, "alumnos": alumnos})
+    skip = (page - 1) * page_size
+    resultado = {}
+    for tipo in tipos:
+        total, items = indices_busqueda[tipo].buscar(q_norm, skip, page_size)
+        resultado[tipo] = {"total": total, "items": items}
+
+    with _cache_busqueda_lock:
+        if version == _cache_busqueda_version[0]:
+            _cache_busqueda[clave] = (ahora, resultado)
+            while len(_cache_busqueda) > BUSQUEDA_CACHE_MAX:
+                _cache_busqueda.popitem(last=False)
+    return resultado
+
+def reindexar_busqueda(coleccion, tipo, lote=500):
+    """Recalcula los campos de búsqueda de toda una colección con escrituras por lotes.
+    Se usa una sola vez tras actualizar (ver indexar_busqueda.py) o después de importar datos."""
+    proyeccion = {k: 1 for k in CAMPOS_TITULO + CAMPOS_ISBN + CAMPOS_AUTOR + CAMPOS_EDITORIAL +
+                  CAMPOS_NOMBRE_ALUMNO + CAMPOS_BOLETA + CAMPOS_NOMBRE_DOCENTE + CAMPOS_NO_EMPLEADO +
+                  CAMPOS_GRUPO + CAMPOS_CARGA + [k for variantes in VARIANTES_INVENTARIO.values() for k in variantes]}
+    operaciones = []
+    total = 0
+    for doc in coleccion.find({}, proyeccion):
+        operaciones.append(UpdateOne({"_id": doc["_id"]}, {"$set": campos_busqueda(tipo, doc)}))
+        if len(operaciones) >= lote:
+            coleccion.bulk_write(operaciones, ordered=False)
+            total += len(operaciones)
+            operaciones = []
+    if operaciones:
+        coleccion.bulk_write(operaciones, ordered=False)
+        total += len(operaciones)
+    invalidar_cache_busqueda()
+    return total
 
-@app.route('/buscar')
-def buscar_html():
+@app.route('/api/buscar')
+def buscar():
     q = request.args.get('q', '').strip()
     if not q:
-        return send_file('Interfaz.html')
+        return jsonify({"libros": [], "alumnos": []})
 
-    campo_nombre = "Nombre Del Alumno:\n(Completo)"
-    campo_carga = "Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"
-    campo_ocupacion = "Ocupación \n(Docente u otro)"
-    q_norm = unidecode(q).lower()
-
-    libros_similares = []
-    libros_encontrados = []
-    for doc in inventario.find({}, {"_id": 0}):
-        # Buscar en múltiples campos y variantes
-        titulo_variantes = [
-            doc.get("TÍTULO", ""),
-            doc.get("TITULO", ""),
-            doc.get("Titulo", ""),
-            doc.get("titulo", ""),
-            doc.get("Título", ""),
-            doc.get("title", "")
-        ]
-        titulo = ""
-        for t in titulo_variantes:
-            if t and str(t).strip():
-                titulo = str(t)
-                break
-        
-        isbn_variantes = [
-            doc.get("ISBN", ""),
-            doc.get("Isbn", ""),
-            doc.get("isbn", "")
-        ]
-        isbn = ""
-        for i in isbn_variantes:
-            if i and str(i).strip():
-                isbn = str(i)
-                break
-        
-        autor_variantes = [
-            doc.get("AUTOR", ""),
-            doc.get("Autor", ""),
-            doc.get("autor", "")
-        ]
-        autor = ""
-        for a in autor_variantes:
-            if a and str(a).strip():
-                autor = str(a)
-                break
-        
-        editorial_variantes = [
-            doc.get("EDITORIAL", ""),
-            doc.get("Editorial", ""),
-            doc.get("editorial", "")
-        ]
-        editorial = ""
-        for e in editorial_variantes:
-            if e and str(e).strip():
-                editorial = str(e)
-                break
-        
-        titulo_norm = unidecode(titulo).lower()
-        isbn_norm = unidecode(isbn).lower()
-        autor_norm = unidecode(autor).lower()
-        editorial_norm = unidecode(editorial).lower()
-        
-        if (q_norm in titulo_norm or q_norm in isbn_norm or 
-            q_norm in autor_norm or q_norm in editorial_norm):
-            libros_encontrados.append(doc)
-        elif q_norm in titulo_norm:
-            libros_similares.append(doc)
-
-    alumnos = []
-    for doc in db["Alumnos"].find({}, {"_id": 0}):
-        # Buscar nombre en múltiples campos posibles
-        nombre_variantes = [
-            doc.get("Nombre", ""),
-            doc.get("nombre", ""),
-            doc.get("Nombre Del Alumno:\n(Completo)", ""),
-            doc.get("Nombre Completo", "")
-        ]
-        nombre = ""
-        for n in nombre_variantes:
-            if n and str(n).strip():
-                nombre = str(n)
-                break
-        
-        nombre_norm = unidecode(nombre).lower()
-        boleta = str(doc.get("Boleta", "")).lower()
-        if q_norm in nombre_norm or q_norm in boleta:
-            alumnos.append(doc)
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', BUSQUEDA_PAGE_SIZE, type=int)
+    resultado = buscar_catalogo(q, ("libros", "alumnos"), page, page_size)
 
-    docentes = []
-    for doc in db["Docentes"].find({}, {"_id": 0}):
-        # Buscar nombre en múltiples campos posibles
-        nombre_variantes = [
-            doc.get("Nombre Completo", ""),
-            doc.get("Nombre", ""),
-            doc.get("nombre", ""),
-            doc.get("Nombre Completo", "")
-        ]
-        nombre = ""
-        for n in nombre_variantes:
-            if n and str(n).strip():
-                nombre = str(n)
-                break
-        
-        no_empleado_variantes = [
-            doc.get("No Empleado", ""),
-            doc.get("NoEmpleado", ""),
-            doc.get("no_empleado", ""),
-            doc.get("noEmpleado", "")
-        ]
-        no_empleado = ""
-        for ne in no_empleado_variantes:
-            if ne and str(ne).strip():
-                no_empleado = str(ne)
-                break
-        
-        nombre_norm = unidecode(nombre).lower()
-        no_empleado_norm = str(no_empleado).lower()
-        if q_norm in nombre_norm or q_norm in no_empleado_norm:
-            docentes.append(doc)
+    return jsonify({
+        "libros": resultado["libros"]["items"],
+        "alumnos": resultado["alumnos"]["items"],
+        "total_libros": resultado["libros"]["total"],
+        "total_alumnos": resultado["alumnos"]["total"],
+        "page": max(1, page),
+        "page_size": max(1, min(page_size, BUSQUEDA_PAGE_SIZE_MAX))
+    })
 
-    html = '''
+CAMPO_CARGA = "Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"
+CAMPO_OCUPACION = "Ocupación \n(Docente u otro)"
+
+# Plantilla de /buscar compilada una sola vez; las filas se generan y envían
+# al navegador conforme se renderizan (ver buscar_html).
+plantilla_resultados_busqueda = app.jinja_env.from_string('''
     <html>
     <head>
         <title>Resultados de búsqueda</title>
@@ -784,11 +1331,8 @@ def buscar_html():
         </div>
         <div class="institucional-divider"></div>
         <div style="max-width:1000px;margin:30px auto;">
-    '''
-
-    if libros_encontrados:
-        html += '''
-        <h4>Libros encontrados</h4>
+    {% if total_libros %}
+        <h4>Libros encontrados ({{ total_libros }})</h4>
         <div class="tabla-centro">
             <table class="tabla-busqueda">
                 <thead>
@@ -801,47 +1345,15 @@ def buscar_html():
                     </tr>
                 </thead>
                 <tbody>
-        '''
-        for libro in libros_encontrados:
-            # Obtener valores desde múltiples variantes de campos
-            titulo_libro = (
-                libro.get('TÍTULO', '') or 
-                libro.get('TITULO', '') or 
-                libro.get('Titulo', '') or 
-                libro.get('titulo', '') or 
-                libro.get('Título', '') or
-                libro.get('title', '') or
-                ''
-            )
-            autor_libro = (
-                libro.get('AUTOR', '') or 
-                libro.get('Autor', '') or 
-                libro.get('autor', '') or
-                ''
-            )
-            editorial_libro = (
-                libro.get('EDITORIAL', '') or 
-                libro.get('Editorial', '') or 
-                libro.get('editorial', '') or
-                ''
-            )
-            estante_libro = (
-                libro.get('ESTANTE', '') or 
-                libro.get('Estante', '') or 
-                libro.get('estante', '') or
-                ''
-            )
-            disponibles = obtener_disponibles(libro)
-            html += f"<tr><td>{titulo_libro}</td><td>{autor_libro}</td><td>{editorial_libro}</td><td>{estante_libro}</td><td>{disponibles}</td></tr>"
-        html += '''
+        {% for libro in libros %}
+                    <tr><td>{{ libro.titulo }}</td><td>{{ libro.autor }}</td><td>{{ libro.editorial }}</td><td>{{ libro.estante }}</td><td>{{ libro.disponibles }}</td></tr>
+        {% endfor %}
                 </tbody>
             </table>
         </div>
-        '''
-
-    if alumnos:
-        html += '''
-        <h4>Alumnos encontrados</h4>
+    {% endif %}
+    {% if total_alumnos %}
+        <h4>Alumnos encontrados ({{ total_alumnos }})</h4>
         <div class="tabla-centro">
             <table class="tabla-busqueda">
                 <thead>
@@ -855,44 +1367,26 @@ def buscar_html():
                     </tr>
                 </thead>
                 <tbody>
-        '''
-        for alumno in alumnos:
-            # Obtener nombre desde múltiples campos posibles
-            nombre_alumno = (
-                alumno.get("Nombre", "") or 
-                alumno.get("nombre", "") or 
-                alumno.get("Nombre Del Alumno:\n(Completo)", "") or
-                alumno.get("Nombre Completo", "") or
-                ""
-            )
-            # Obtener carga desde múltiples campos posibles
-            carga_alumno = (
-                alumno.get("Carga", "") or 
-                alumno.get("carga", "") or 
-                alumno.get("Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)", "") or
-                ""
-            )
-            
-            html += f'''
+        {% for alumno in alumnos %}
             <tr>
-                <td>{nombre_alumno.upper() if nombre_alumno else ''}</td>
-                <td>{alumno.get('Boleta', '')}</td>
-                <td>{alumno.get('Grupo', '')}</td>
-                <td>{carga_alumno.upper() if carga_alumno else ''}</td>
+                <td>{{ alumno.nombre|upper }}</td>
+                <td>{{ alumno.boleta }}</td>
+                <td>{{ alumno.grupo }}</td>
+                <td>{{ alumno.carga|upper }}</td>
                 <td>
                     <form action="/registrar_entrada" method="post" style="margin:0;">
-                        <input type="hidden" name="nombre" value="{nombre_alumno}">
-                        <input type="hidden" name="boleta" value="{alumno.get('Boleta', '')}">
-                        <input type="hidden" name="grupo" value="{alumno.get('Grupo', '')}">
-                        <input type="hidden" name="carga" value="{carga_alumno}">
+                        <input type="hidden" name="nombre" value="{{ alumno.nombre }}">
+                        <input type="hidden" name="boleta" value="{{ alumno.boleta }}">
+                        <input type="hidden" name="grupo" value="{{ alumno.grupo }}">
+                        <input type="hidden" name="carga" value="{{ alumno.carga }}">
                         <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 14px;border-radius:5px;font-weight:bold;cursor:pointer;">Registrar entrada</button>
                     </form>
                 </td>
                 <td>
                     <form action="/registrar_observacion" method="post" style="margin:0;">
                         <input type="hidden" name="tipo" value="alumno">
-                        <input type="hidden" name="nombre" value="{nombre_alumno}">
-                        <input type="hidden" name="boleta" value="{alumno.get('Boleta', '')}">
+                        <input type="hidden" name="nombre" value="{{ alumno.nombre }}">
+                        <input type="hidden" name="boleta" value="{{ alumno.boleta }}">
                         <div style="display:flex;flex-direction:column;align-items:center;justify-content:center;margin-top:12px;">
                             <input type="text" name="observacion" placeholder="Observaciones" style="width:120px;margin-bottom:8px;">
                             <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 18px;border-radius:5px;font-weight:bold;cursor:pointer;">Guardar</button>
@@ -900,16 +1394,13 @@ def buscar_html():
                     </form>
                 </td>
             </tr>
-            '''
-        html += '''
+        {% endfor %}
                 </tbody>
             </table>
         </div>
-        '''
-
-    if docentes:
-        html += '''
-        <h4>Docentes encontrados</h4>
+    {% endif %}
+    {% if total_docentes %}
+        <h4>Docentes encontrados ({{ total_docentes }})</h4>
         <div class="tabla-centro">
             <table class="tabla-busqueda">
                 <thead>
@@ -923,72 +1414,187 @@ def buscar_html():
                     </tr>
                 </thead>
                 <tbody>
-        '''
-        for docente in docentes:
-            # Obtener valores desde múltiples variantes de campos
-            nombre_docente = (
-                docente.get('Nombre Completo', '') or 
-                docente.get('Nombre', '') or 
-                docente.get('nombre', '') or
-                ''
-            )
-            no_empleado_docente = (
-                docente.get('No Empleado', '') or 
-                docente.get('NoEmpleado', '') or 
-                docente.get('no_empleado', '') or
-                docente.get('noEmpleado', '') or
-                ''
-            )
-            turno_docente = (
-                docente.get('Turno', '') or 
-                docente.get('turno', '') or
-                ''
-            )
-            ocupacion_docente = (
-                docente.get(campo_ocupacion, '') or 
-                docente.get('Ocupacion', '') or 
-                docente.get('ocupacion', '') or
-                docente.get('Cargo', '') or
-                docente.get('cargo', '') or
-                ''
-            )
-            html += (
-                f"<tr>"
-                f"<td>{nombre_docente.upper() if nombre_docente else ''}</td>"
-                f"<td>{no_empleado_docente}</td>"
-                f"<td>{turno_docente}</td>"
-                f"<td>{ocupacion_docente}</td>"
-            )
-            html += f'''<td>
-                <form action="/registrar_entrada_docente" method="post" style="margin:0;">
-                    <input type="hidden" name="nombre" value="{nombre_docente}">
-                    <input type="hidden" name="no_empleado" value="{no_empleado_docente}">
-                    <input type="hidden" name="turno" value="{turno_docente}">
-                    <input type="hidden" name="ocupacion" value="{ocupacion_docente}">
-                    <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 14px;border-radius:5px;font-weight:bold;cursor:pointer;">Registrar entrada</button>
-                </form>
-            </td>
-            <td>
-                <form action="/registrar_observacion" method="post" style="margin:0;">
-                    <input type="hidden" name="tipo" value="docente">
-                    <input type="hidden" name="nombre" value="{nombre_docente}">
-                    <input type="hidden" name="no_empleado" value="{no_empleado_docente}">
-                    <div style="display:flex;flex-direction:column;align-items:center;justify-content:center;margin-top:12px;">
-                        <input type="text" name="observacion" placeholder="Observaciones" style="width:120px;margin-bottom:8px;">
-                        <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 18px;border-radius:5px;font-weight:bold;cursor:pointer;">Guardar</button>
-                    </div>
-                </form>
-            </td></tr>'''
-        html += '''
+        {% for docente in docentes %}
+            <tr>
+                <td>{{ docente.nombre|upper }}</td>
+                <td>{{ docente.no_empleado }}</td>
+                <td>{{ docente.turno }}</td>
+                <td>{{ docente.ocupacion }}</td>
+                <td>
+                    <form action="/registrar_entrada_docente" method="post" style="margin:0;">
+                        <input type="hidden" name="nombre" value="{{ docente.nombre }}">
+                        <input type="hidden" name="no_empleado" value="{{ docente.no_empleado }}">
+                        <input type="hidden" name="turno" value="{{ docente.turno }}">
+                        <input type="hidden" name="ocupacion" value="{{ docente.ocupacion }}">
+                        <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 14px;border-radius:5px;font-weight:bold;cursor:pointer;">Registrar entrada</button>
+                    </form>
+                </td>
+                <td>
+                    <form action="/registrar_observacion" method="post" style="margin:0;">
+                        <input type="hidden" name="tipo" value="docente">
+                        <input type="hidden" name="nombre" value="{{ docente.nombre }}">
+                        <input type="hidden" name="no_empleado" value="{{ docente.no_empleado }}">
+                        <div style="display:flex;flex-direction:column;align-items:center;justify-content:center;margin-top:12px;">
+                            <input type="text" name="observacion" placeholder="Observaciones" style="width:120px;margin-bottom:8px;">
+                            <button type="submit" style="background:#6d1846;color:#fff;border:none;padding:6px 18px;border-radius:5px;font-weight:bold;cursor:pointer;">Guardar</button>
+                        </div>
+                    </form>
+                </td>
+            </tr>
+        {% endfor %}
                 </tbody>
             </table>
         </div>
-        '''
+    {% endif %}
+    {% if not (total_libros or total_alumnos or total_docentes) %}
+        <div class="sin-resultados">Sin resultados.</div>
+    {% endif %}
+    {% if page > 1 or hay_mas %}
+        <div class="volver">
+        {% if page > 1 %}<a href="/buscar?q={{ q|urlencode }}&page={{ page - 1 }}">Anterior</a>{% endif %}
+        {% if hay_mas %}<a href="/buscar?q={{ q|urlencode }}&page={{ page + 1 }}">Siguiente</a>{% endif %}
+        </div>
+    {% endif %}
+    </div><div class="volver"><a href="/">Volver al inicio</a></div></body></html>
+''')
+
+def fila_libro(libro):
+    return {
+        "titulo": libro.get("TÍTULO", ''),
+        "autor": libro.get("AUTOR", ''),
+        "editorial": libro.get("EDITORIAL", ''),
+        "estante": libro.get("ESTANTE", ''),
+        "disponibles": libro.get("DISPONIBLES", '')
+    }
+
+def fila_alumno(alumno):
+    return {
+        "nombre": str(primer_valor(alumno, CAMPOS_NOMBRE_ALUMNO)),
+        "boleta": alumno.get('Boleta', ''),
+        "grupo": alumno.get('Grupo', ''),
+        "carga": str(primer_valor(alumno, ["Carga", "carga", CAMPO_CARGA]))
+    }
+
+def fila_docente(docente):
+    return {
+        "nombre": str(primer_valor(docente, CAMPOS_NOMBRE_DOCENTE)),
+        "no_empleado": primer_valor(docente, CAMPOS_NO_EMPLEADO),
+        "turno": primer_valor(docente, ["Turno", "turno"]),
+        "ocupacion": primer_valor(docente, [CAMPO_OCUPACION, "Ocupacion", "ocupacion", "Cargo", "cargo"])
+    }
+
+@app.route('/buscar')
+def buscar_html():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return send_file('Interfaz.html')
 
-    if not (libros_encontrados or alumnos or docentes):
-        html += '<div class="sin-resultados">Sin resultados.</div>'
-    html += '</div><div class="volver"><a href="/">Volver al inicio</a></div></body></html>'
-    return render_template_string(html)
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = BUSQUEDA_PAGE_SIZE_MAX
+    resultado = buscar_catalogo(q, ("libros", "alumnos", "docentes"), page, page_size)
+    hay_mas = any(r["total"] > page * page_size for r in resultado.values())
+
+    contexto = {
+        "q": q,
+        "page": page,
+        "hay_mas": hay_mas,
+        "total_libros": resultado["libros"]["total"],
+        "total_alumnos": resultado["alumnos"]["total"],
+        "total_docentes": resultado["docentes"]["total"],
+        # generadores: cada fila se formatea justo antes de enviarse
+        "libros": (fila_libro(d) for d in resultado["libros"]["items"]),
+        "alumnos": (fila_alumno(d) for d in resultado["alumnos"]["items"]),
+        "docentes": (fila_docente(d) for d in resultado["docentes"]["items"])
+    }
+    return Response(stream_with_context(plantilla_resultados_busqueda.generate(**contexto)),
+                    mimetype='text/html')
+
+# --- Contador diario de entradas al sitio ---
+# SitioDiario/{_id: "AAAA-MM-DD"} acumula las entradas del día: "entradas" por
+# tipo, "horas" por tipo y hora local ("07", "08", ...) para las gráficas de
+# ocupación y "en_contador", lo que muestra el contador del mostrador desde el
+# último reinicio. Cada entrada lo ajusta con un $inc, así contador_dia es una
+# sola lectura por _id. reconstruir_sitio_diario() lo recalcula desde Sitio.
+TIPOS_ENTRADA_SITIO = ("alumno", "docente")
+SITIO_RETENCION_DIAS = int(os.getenv('SITIO_RETENCION_DIAS', '30'))
+DIRECTORIO_ARCHIVO_SITIO = os.getenv('DIRECTORIO_ARCHIVO_SITIO', 'archivo_sitio')
+PROYECCION_SITIO = {"tipo": 1, "nombre": 1, "boleta": 1, "no_empleado": 1, "grupo": 1, "ocupacion": 1,
+                    "turno": 1, "fecha": 1, "hora_entrada": 1, "observaciones": 1}
+
+def contar_entrada_sitio(tipo, fecha):
+    """Suma una entrada (fecha con zona de México) al contador de su día"""
+    if tipo not in TIPOS_ENTRADA_SITIO:
+        return
+    sitio_diario.update_one(
+        {"_id": fecha.strftime('%Y-%m-%d')},
+        {"$inc": {f"entradas.{tipo}": 1, f"horas.{tipo}.{fecha.hour:02d}": 1, f"en_contador.{tipo}": 1}},
+        upsert=True
+    )
+
+def a_hora_mexico(valor):
+    """datetime de MongoDB (naive = UTC) en hora de México"""
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor.astimezone(pytz.timezone('America/Mexico_City'))
+
+def reconstruir_sitio_diario(fecha_str):
+    """Recalcula el contador de un día desde los registros de Sitio"""
+    contador = {"entradas": {t: 0 for t in TIPOS_ENTRADA_SITIO},
+                "en_contador": {t: 0 for t in TIPOS_ENTRADA_SITIO},
+                "horas": {t: {} for t in TIPOS_ENTRADA_SITIO}}
+    for doc in sitio.find({"fecha": fecha_str, "tipo": {"$in": list(TIPOS_ENTRADA_SITIO)}},
+                          {"tipo": 1, "hora_entrada": 1, "fecha_completa": 1, "reiniciado": 1}):
+        tipo = doc["tipo"]
+        hora = (doc.get("hora_entrada") or "")[:2]
+        if not hora.isdigit() and isinstance(doc.get("fecha_completa"), datetime):
+            hora = f"{a_hora_mexico(doc['fecha_completa']).hour:02d}"
+        contador["entradas"][tipo] += 1
+        if not doc.get("reiniciado"):
+            contador["en_contador"][tipo] += 1
+        if hora.isdigit():
+            contador["horas"][tipo][hora] = contador["horas"][tipo].get(hora, 0) + 1
+    sitio_diario.update_one({"_id": fecha_str}, {"$set": contador}, upsert=True)
+    return contador
+
+def contador_sitio_dia(fecha_str):
+    """Documento del contador de un día (sólo lectura; {} si aún no hay entradas).
+    Los días anteriores al contador los reconstruye python migrar_sitio.py."""
+    return sitio_diario.find_one({"_id": fecha_str}) or {}
+
+@app.route('/api/sitio/histograma', methods=['GET'])
+def api_sitio_histograma():
+    """Entradas por hora para gráficas de ocupación. ?desde=AAAA-MM-DD&hasta=AAAA-MM-DD
+    (por omisión, hoy); cuando abarca varios días suma las horas de todos ellos.
+    Como SitioDiario no caduca, sirve también para días ya archivados."""
+    hoy = datetime.now(pytz.timezone('America/Mexico_City')).strftime('%Y-%m-%d')
+    desde = request.args.get('desde') or request.args.get('fecha') or hoy
+    hasta = request.args.get('hasta') or desde
+    try:
+        datetime.strptime(desde, '%Y-%m-%d')
+        datetime.strptime(hasta, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"success": False, "error": "Fechas en formato AAAA-MM-DD"}), 400
+    if desde == hasta:
+        # un día sin entradas todavía no tiene documento: contador_sitio_dia devuelve {}
+        dias = [dia for dia in (contador_sitio_dia(desde),) if dia]
+    else:
+        dias = list(sitio_diario.find({"_id": {"$gte": desde, "$lte": hasta}}, {"archivos": 0}))
+    horas = {h: {t: 0 for t in TIPOS_ENTRADA_SITIO} for h in range(24)}
+    totales = {t: 0 for t in TIPOS_ENTRADA_SITIO}
+    for dia in dias:
+        for tipo in TIPOS_ENTRADA_SITIO:
+            totales[tipo] += (dia.get("entradas") or {}).get(tipo, 0)
+            for hora, n in ((dia.get("horas") or {}).get(tipo) or {}).items():
+                horas[int(hora)][tipo] += n
+    return jsonify({
+        "desde": desde,
+        "hasta": hasta,
+        "dias": len(dias),
+        "totales": totales,
+        "horas": [dict(hora=h, **horas[h]) for h in range(24)],
+        "por_dia": [dict(fecha=dia["_id"], **{t: (dia.get("entradas") or {}).get(t, 0) for t in TIPOS_ENTRADA_SITIO})
+                    for dia in sorted(dias, key=lambda d: d["_id"])]
+    })
 
 @app.route('/registrar_entrada', methods=['POST'])
 def registrar_entrada():
@@ -1028,11 +1634,14 @@ def registrar_entrada():
         "hora_entrada": hora_entrada,
         "observaciones": [],
         "created_at": fecha,
+        "actualizado_at": fecha,  # cursor de /api/sitio/cambios
         "eliminado": False,  # Campo para marcar si está eliminado de la tabla (botón eliminar)
         "reiniciado": False  # Campo para marcar si fue reiniciado (botón reiniciar contador)
     }
     
     sitio.insert_one(registro)
+    contar_entrada_sitio(registro["tipo"], fecha)
+    avisar_cambio_sitio()
     return render_template_string('''
         <html>
         <head>
@@ -1076,11 +1685,14 @@ def registrar_entrada_docente():
         "hora_entrada": hora_entrada,
         "observaciones": [],
         "created_at": fecha,
+        "actualizado_at": fecha,  # cursor de /api/sitio/cambios
         "eliminado": False,  # Campo para marcar si está eliminado de la tabla (botón eliminar)
         "reiniciado": False  # Campo para marcar si fue reiniciado (botón reiniciar contador)
     }
     
     sitio.insert_one(registro)
+    contar_entrada_sitio(registro["tipo"], fecha)
+    avisar_cambio_sitio()
     return render_template_string('''
         <html>
         <head>
@@ -1139,15 +1751,18 @@ def registrar_observacion():
     else:
         query = {"tipo": "docente", "no_empleado": no_empleado}
     
-    # Buscar el registro más reciente (del día de hoy o el más reciente)
+    # Buscar el registro más reciente (del día de hoy o el más reciente); los
+    # archivados (con expira_at) ya están en el archivo y el TTL los borrará
+    query["expira_at"] = {"$exists": False}
     registro = sitio.find_one(query, sort=[("fecha_completa", -1)])
     
-    if registro:
-        # Agregar la observación al array de observaciones
-        sitio.update_one(
-            {"_id": registro["_id"]},
-            {"$push": {"observaciones": observacion}}
-        )
+    # Agregar la observación al array de observaciones, salvo que el registro se
+    # haya archivado entre la búsqueda y la escritura
+    if registro and sitio.update_one(
+        {"_id": registro["_id"], "expira_at": {"$exists": False}},
+        {"$push": {"observaciones": observacion}, "$set": {"actualizado_at": fecha_obs}}
+    ).matched_count:
+        avisar_cambio_sitio()
         mensaje = "Observación agregada correctamente al registro de entrada"
     else:
         # Si no hay registro, crear uno nuevo con la observación
@@ -1158,7 +1773,8 @@ def registrar_observacion():
             "fecha": fecha_str,
             "fecha_completa": fecha_obs,
             "hora_entrada": fecha_obs.strftime('%H:%M:%S'),
-            "observaciones": [observacion]
+            "observaciones": [observacion],
+            "actualizado_at": fecha_obs
         }
         if tipo == 'alumno':
             nuevo_registro["boleta"] = boleta
@@ -1166,6 +1782,8 @@ def registrar_observacion():
             nuevo_registro["no_empleado"] = no_empleado
         
         sitio.insert_one(nuevo_registro)
+        contar_entrada_sitio(tipo, fecha_obs)
+        avisar_cambio_sitio()
         mensaje = "Registro creado y observación agregada correctamente"
     
     return render_template_string('''
@@ -1210,22 +1828,26 @@ def registrar_libro():
     estante = getv(datos, 'ESTANTE','Estante','estante')
     disp_raw = getv(datos, 'DISPONIBLES','Disponibles','disponible','DISPONIBLES')
     try:
-        disponibles = int(disp_raw) if disp_raw != '' else None
+        disponibles = max(0, int(disp_raw)) if disp_raw != '' else 0
     except:
-        disponibles = None
+        disponibles = 0
+    # esquema canónico de Inventario (ver CAMPOS_CANONICOS_INVENTARIO)
     libro = {
-        "TÍTULO": titulo,
-        "AUTOR": autor,
-        "EDITORIAL": editorial,
-        "ISBN": isbn,
-        
-        "EDICIÓN": edicion,
-        "ESTANTE": estante,
-        # almacenar null si no hay valor numérico
-        "DISPONIBLES": disponibles
+        "TÍTULO": str(titulo).strip(),
+        "AUTOR": str(autor).strip(),
+        "EDITORIAL": str(editorial).strip(),
+        "ISBN": str(isbn).strip(),
+        "EDICIÓN": str(edicion).strip(),
+        "ESTANTE": str(estante).strip(),
+        "DISPONIBLES": disponibles,
+        "created_at": datetime.now(timezone.utc)  # adquisiciones del reporte mensual
     }
+    libro.update(campos_busqueda("libro", libro))
     try:
         inventario.insert_one(libro)
+        ajustar_libros_estanteria(0, disponibles)
+        invalidar_reporte_mensual(libro["created_at"])
+        invalidar_cache_busqueda()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1248,54 +1870,155 @@ def actualizar_alumno():
     if not set_ops:
         return jsonify({"success": False, "error": "Nada que actualizar"}), 400
 
-    # intentar actualizar por campo Boleta (ajusta si guardas como número)
+    # buscar por campo Boleta (texto) y, si no aparece, por su variante numérica
     query = {"Boleta": boleta}
-    result = alumnos.update_one(query, {"$set": set_ops})
-
-    # si no encontrado, intentar variante numérica
-    if result.matched_count == 0:
+    actual = alumnos.find_one(query, PROYECCION_ALUMNOS)
+    if actual is None:
         try:
-            query_num = {"Boleta": int(boleta)}
-            result = alumnos.update_one(query_num, {"$set": set_ops})
+            query = {"Boleta": int(boleta)}
+            actual = alumnos.find_one(query, PROYECCION_ALUMNOS)
         except Exception:
             pass
+    if actual is None:
+        return jsonify({"success": False, "error": "Alumno no encontrado"}), 404
+
+    # mantener claves de búsqueda y filtros al día si cambia nombre, grupo o carga
+    if {'Nombre', 'Grupo', 'Carga'} & set(set_ops):
+        set_ops.update(campos_busqueda("alumno", dict(actual, **set_ops)))
 
+    result = alumnos.update_one({"_id": actual["_id"]}, {"$set": set_ops})
     if result.matched_count == 0:
         return jsonify({"success": False, "error": "Alumno no encontrado"}), 404
 
+    invalidar_cache_busqueda()
+    invalidar_identidad('alumno', boleta)
     return jsonify({"success": True})
 
+# --- Calendario de días hábiles ---
+# Días inhábiles = fines de semana + días de descanso obligatorio (LFT art. 74)
+# + calendario escolar del IPN (archivo calendario_ipn.txt). Las funciones
+# calculan en tiempo constante: aritmética de semanas y bisect sobre la lista
+# ordenada de días inhábiles entre semana.
+CALENDARIO_IPN = os.getenv('CALENDARIO_IPN', 'calendario_ipn.txt')
+
+def _n_lunes(año, mes, n):
+    """Fecha del n-ésimo lunes del mes"""
+    primero = date(año, mes, 1)
+    return primero + timedelta(days=(7 - primero.weekday()) % 7 + 7 * (n - 1))
+
+def dias_descanso_obligatorio(año):
+    """Días de descanso obligatorio en México para un año"""
+    dias = [
+        date(año, 1, 1),
+        _n_lunes(año, 2, 1),   # Día de la Constitución
+        _n_lunes(año, 3, 3),   # Natalicio de Benito Juárez
+        date(año, 5, 1),
+        date(año, 9, 16),
+        _n_lunes(año, 11, 3),  # Revolución Mexicana
+        date(año, 12, 25),
+    ]
+    if (año - 2024) % 6 == 0:
+        dias.append(date(año, 10, 1))  # Transmisión del Poder Ejecutivo Federal
+    return dias
+
+def cargar_calendario_ipn(ruta=CALENDARIO_IPN):
+    """Lee días inhábiles del IPN: una fecha AAAA-MM-DD o un rango AAAA-MM-DD..AAAA-MM-DD por línea"""
+    dias = []
+    if not os.path.exists(ruta):
+        return dias
+    with open(ruta, 'r', encoding='utf-8') as f:
+        for linea in f:
+            linea = linea.split('#', 1)[0].strip()
+            if not linea:
+                continue
+            try:
+                if '..' in linea:
+                    inicio, fin = (datetime.strptime(p.strip(), "%Y-%m-%d").date() for p in linea.split('..', 1))
+                    dias += [inicio + timedelta(days=i) for i in range((fin - inicio).days + 1)]
+                else:
+                    dias.append(datetime.strptime(linea, "%Y-%m-%d").date())
+            except ValueError:
+                print(f"[CALENDARIO] Línea inválida en {ruta}: {linea}")
+    return dias
+
+def construir_dias_inhabiles(desde=2020, hasta=None):
+    """Lista ordenada (sin duplicados) de días inhábiles que caen entre semana"""
+    hasta = hasta or datetime.now().year + 5
+    dias = set(cargar_calendario_ipn())
+    for año in range(desde, hasta + 1):
+        dias.update(dias_descanso_obligatorio(año))
+    return sorted(d for d in dias if d.weekday() < 5)
+
+DIAS_INHABILES = construir_dias_inhabiles()
+DIAS_INHABILES_NP = np.array(DIAS_INHABILES, dtype='datetime64[D]')
+
+def _como_fecha(valor):
+    if isinstance(valor, str):
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    if isinstance(valor, datetime):
+        return valor.date()
+    return valor
+
+def _inhabiles_en(desde_excl, hasta_incl):
+    """Número de días inhábiles entre semana en el intervalo (desde_excl, hasta_incl]"""
+    return bisect_right(DIAS_INHABILES, hasta_incl) - bisect_right(DIAS_INHABILES, desde_excl)
+
+def _sumar_dias_laborables(d, days):
+    """Suma días de lunes a viernes (sin considerar feriados) en tiempo constante"""
+    wd = d.weekday()
+    if wd > 4:
+        # sumar desde sábado/domingo equivale a sumar desde el viernes anterior
+        d = d - timedelta(days=wd - 4)
+        wd = 4
+    semanas, resto = divmod(days, 5)
+    extra = 2 if wd + resto > 4 else 0
+    return d + timedelta(days=semanas * 7 + resto + extra)
+
 def add_business_days(start_date, days):
     # start_date: datetime or date; devuelve datetime
     if isinstance(start_date, datetime):
         d = start_date
     else:
         d = datetime.combine(start_date, datetime.min.time())
-    added = 0
-    while added < days:
-        d = d + timedelta(days=1)
-        if d.weekday() < 5:  # 0..4 => Mon..Fri
-            added += 1
-    return d
+    if days <= 0:
+        return d
+    fin = _sumar_dias_laborables(d, days)
+    # cada día inhábil dentro del intervalo recorre el vencimiento un día hábil
+    pendientes = _inhabiles_en(d.date(), fin.date())
+    while pendientes:
+        nuevo_fin = _sumar_dias_laborables(fin, pendientes)
+        pendientes = _inhabiles_en(fin.date(), nuevo_fin.date())
+        fin = nuevo_fin
+    return fin
 
 def count_business_days_between(start_date, end_date):
-    """Cuenta días hábiles entre dos fechas (excluyendo fines de semana)"""
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
-    if isinstance(start_date, datetime):
-        start_date = start_date.date()
-    if isinstance(end_date, datetime):
-        end_date = end_date.date()
-    
-    current = start_date
-    count = 0
-    while current < end_date:
-        if current.weekday() < 5:  # Lunes a Viernes
-            count += 1
-        current += timedelta(days=1)
-    return count
+    """Cuenta días hábiles en [start_date, end_date) excluyendo fines de semana y días inhábiles"""
+    start_date = _como_fecha(start_date)
+    end_date = _como_fecha(end_date)
+    if start_date >= end_date:
+        return 0
+    semanas, resto = divmod((end_date - start_date).days, 7)
+    wd = start_date.weekday()
+    count = semanas * 5 + sum(1 for i in range(resto) if (wd + i) % 7 < 5)
+    inicio_excl = start_date - timedelta(days=1)
+    fin_incl = end_date - timedelta(days=1)
+    return count - _inhabiles_en(inicio_excl, fin_incl)
+
+def contar_dias_habiles_lote(inicios, fines):
+    """Versión vectorizada (NumPy busday_count) para trabajos por lote: arreglos de fechas"""
+    inicios = np.asarray(inicios, dtype='datetime64[D]')
+    fines = np.asarray(fines, dtype='datetime64[D]')
+    return np.where(inicios < fines,
+                    np.busday_count(inicios, fines, holidays=DIAS_INHABILES_NP),
+                    0)
+
+def calcular_dias_retraso_lote(fechas_devolucion, hoy=None):
+    """Días hábiles de retraso para muchas fechas 'AAAA-MM-DD' a la vez"""
+    if hoy is None:
+        hoy = datetime.now(pytz.timezone('America/Mexico_City')).date()
+    if not len(fechas_devolucion):
+        return []
+    return contar_dias_habiles_lote(fechas_devolucion, np.datetime64(hoy, 'D')).tolist()
 
 def calcular_dias_retraso(fecha_devolucion):
     """Calcula días hábiles de retraso desde la fecha de devolución hasta hoy"""
@@ -1318,8 +2041,73 @@ def calcular_multa(dias_retraso):
     """Calcula el monto de la multa: $7.50 por día hábil de retraso"""
     return round(dias_retraso * 7.50, 2)
 
-def enviar_correo(destinatario, asunto, cuerpo):
-    """Envía un correo electrónico al destinatario usando SendGrid"""
+# --- Bandeja de salida de correos ---
+# enviar_correo() sólo encola el mensaje en la colección Correos (con una clave
+# de idempotencia por destinatario) y regresa de inmediato. despachador_correos()
+# corre en segundo plano, reclama lotes de forma atómica (seguro con varios
+# workers), los envía con un pool de hilos acotado que reutiliza conexiones HTTP
+# y reintenta con backoff exponencial los errores temporales.
+CORREO_HILOS = int(os.getenv('CORREO_HILOS', '4'))
+CORREO_MAX_INTENTOS = int(os.getenv('CORREO_MAX_INTENTOS', '5'))
+CORREO_BACKOFF_BASE = 30  # segundos; se duplica en cada reintento
+CORREO_BACKOFF_MAX = 3600
+CORREO_BLOQUEO = 300  # segundos que un correo queda reclamado por un despachador
+CORREO_INTERVALO = 5  # segundos entre revisiones de la bandeja
+SENDGRID_API_URL = os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com')
+
+_hay_correos = threading.Event()
+
+class ClienteSendGrid:
+    """Cliente mínimo de la API v3 de SendGrid con una conexión persistente por hilo"""
+
+    def __init__(self, api_key, base_url=SENDGRID_API_URL):
+        url = urlsplit(base_url)
+        self.api_key = api_key
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.prefijo = url.path.rstrip('/')
+        self._local = threading.local()
+
+    def _conexion(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            clase = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = clase(self.host, self.port, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def enviar(self, payload):
+        """POST /v3/mail/send; devuelve (status, cuerpo de la respuesta)"""
+        cuerpo = json.dumps(payload).encode('utf-8')
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive"
+        }
+        for intento in range(2):
+            conn = self._conexion()
+            try:
+                conn.request('POST', self.prefijo + '/v3/mail/send', body=cuerpo, headers=headers)
+                respuesta = conn.getresponse()
+                return respuesta.status, respuesta.read().decode('utf-8', 'replace')
+            except (http.client.HTTPException, OSError):
+                # la conexión reutilizada pudo cerrarse del lado del servidor: abrir otra una vez
+                conn.close()
+                self._local.conn = None
+                if intento:
+                    raise
+
+_cliente_sendgrid = [None]
+
+def obtener_cliente_sendgrid():
+    if _cliente_sendgrid[0] is None:
+        _cliente_sendgrid[0] = ClienteSendGrid(SENDGRID_API_KEY, SENDGRID_API_URL)
+    return _cliente_sendgrid[0]
+
+def enviar_correo(destinatario, asunto, cuerpo, clave=None):
+    """Encola un correo para enviarse con SendGrid. clave identifica el envío: un segundo
+    intento con la misma clave no genera otro correo. Devuelve True si quedó en la bandeja."""
     # Validar que el destinatario tenga correo
     if not destinatario or not destinatario.strip():
         return False
@@ -1346,332 +2134,440 @@ def enviar_correo(destinatario, asunto, cuerpo):
         print(f"[EMAIL]    Ver CONFIGURAR_CORREOS.md para más detalles")
         return False
     
+    destinatario = destinatario.strip()
+    if not clave:
+        clave = hashlib.sha1(f"{destinatario}\n{asunto}\n{cuerpo}".encode('utf-8')).hexdigest()
+    ahora = datetime.now(timezone.utc)
     try:
-        sg = sendgrid.SendGridAPIClient(api_key=SENDGRID_API_KEY)
-        mail = Mail(
-            from_email=EMAIL_FROM,
-            to_emails=destinatario.strip(),
-            subject=asunto,
-            plain_text_content=cuerpo
+        correos.update_one(
+            {"clave": f"{clave}:{destinatario}"},
+            {"$setOnInsert": {
+                "destinatario": destinatario,
+                "asunto": asunto,
+                "cuerpo": cuerpo,
+                "estado": "pendiente",
+                "intentos": 0,
+                "proximo_intento": ahora,
+                "created_at": ahora
+            }},
+            upsert=True
         )
-        response = sg.send(mail)
-        print(f"[EMAIL] ✅ Correo enviado exitosamente a {destinatario}: {asunto} (Status: {response.status_code})")
-        return True
     except Exception as e:
-        print(f"[EMAIL] ❌ Error enviando correo a {destinatario}: {e}")
-        print(f"[EMAIL] Verifica tu API key de SendGrid en el archivo .env")
+        print(f"[EMAIL] ❌ No se pudo encolar correo para {destinatario}: {e}")
         return False
+    _hay_correos.set()
+    return True
+
+SENDGRID_MAX_PERSONALIZACIONES = 1000  # límite de la API por petición
+
+def encolar_lote(asunto, cuerpo, destinatarios):
+    """Encola correos con la misma plantilla como peticiones por lote de SendGrid
+    (hasta 1000 personalizaciones cada una). asunto y cuerpo pueden llevar marcadores
+    -nombre- que se sustituyen por destinatario. destinatarios: lista de
+    (correo, {marcador: valor}, [claves de idempotencia]). Los destinatarios cuyas
+    claves ya están en la bandeja se omiten. Devuelve cuántos se encolaron."""
+    if not SENDGRID_API_KEY or not SENDGRID_API_KEY.strip():
+        print(f"[EMAIL] ⚠️ SendGrid no configurado. Ver CONFIGURAR_CORREOS.md para más detalles")
+        return 0
+    todas = [c for _, _, claves in destinatarios for c in claves]
+    ya_encoladas = set()
+    for i in range(0, len(todas), SENDGRID_MAX_PERSONALIZACIONES):
+        for doc in correos.find({"claves": {"$in": todas[i:i + SENDGRID_MAX_PERSONALIZACIONES]}}, {"claves": 1}):
+            ya_encoladas.update(doc.get("claves", []))
+
+    redirigir = MODO_PRUEBA and CORREO_PRUEBA and CORREO_PRUEBA.strip()
+    if redirigir:
+        asunto = f"[PRUEBA] {asunto}"
+    personalizaciones = []
+    for correo, sustituciones, claves in destinatarios:
+        if not correo or not correo.strip() or (claves and set(claves) <= ya_encoladas):
+            continue
+        sustituciones = {k: str(v) for k, v in sustituciones.items()}
+        sustituciones["-aviso_prueba-"] = f"[MODO PRUEBA - Correo original: {correo.strip()}]\n\n" if redirigir else ""
+        destino = CORREO_PRUEBA.strip() if redirigir else correo.strip()
+        personalizaciones.append(({"to": [{"email": destino}], "substitutions": sustituciones}, claves))
+
+    ahora = datetime.now(timezone.utc)
+    encolados, peticiones = 0, 0
+    for i in range(0, len(personalizaciones), SENDGRID_MAX_PERSONALIZACIONES):
+        bloque = personalizaciones[i:i + SENDGRID_MAX_PERSONALIZACIONES]
+        claves = [c for _, cs in bloque for c in cs]
+        # upsert por clave, como enviar_correo: si el mismo bloque ya se encoló
+        # (lote repetido) se omite sin interrumpir los bloques restantes
+        resultado = correos.update_one(
+            {"clave": "lote:" + hashlib.sha1("\n".join(sorted(claves)).encode('utf-8')).hexdigest()},
+            {"$setOnInsert": {
+                "claves": claves,
+                "destinatario": f"{len(bloque)} destinatarios",
+                "asunto": asunto,
+                "cuerpo": "-aviso_prueba-" + cuerpo,
+                "personalizaciones": [p for p, _ in bloque],
+                "estado": "pendiente",
+                "intentos": 0,
+                "proximo_intento": ahora,
+                "created_at": ahora
+            }},
+            upsert=True
+        )
+        if resultado.upserted_id is not None:
+            encolados += len(bloque)
+            peticiones += 1
+    if encolados:
+        print(f"[EMAIL] {encolados} correos encolados en {peticiones} peticiones: {asunto}")
+        _hay_correos.set()
+    return encolados
+
+def payload_correo(doc):
+    """Cuerpo JSON de /v3/mail/send para un documento de la bandeja"""
+    if doc.get("personalizaciones"):
+        return {
+            "personalizations": doc["personalizaciones"],
+            "from": {"email": EMAIL_FROM},
+            "subject": doc["asunto"],
+            "content": [{"type": "text/plain", "value": doc["cuerpo"]}]
+        }
+    return Mail(
+        from_email=EMAIL_FROM,
+        to_emails=doc["destinatario"],
+        subject=doc["asunto"],
+        plain_text_content=doc["cuerpo"]
+    ).get()
+
+def reclamar_correos(limite):
+    """Marca atómicamente hasta `limite` correos listos como 'enviando' y los devuelve"""
+    reclamados = []
+    for _ in range(limite):
+        ahora = datetime.now(timezone.utc)
+        doc = correos.find_one_and_update(
+            {"$or": [
+                {"estado": "pendiente", "proximo_intento": {"$lte": ahora}},
+                {"estado": "enviando", "bloqueado_hasta": {"$lt": ahora}}
+            ]},
+            {"$set": {"estado": "enviando", "bloqueado_hasta": ahora + timedelta(seconds=CORREO_BLOQUEO)},
+             "$inc": {"intentos": 1}},
+            sort=[("proximo_intento", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            break
+        reclamados.append(doc)
+    return reclamados
+
+def entregar_correo(doc):
+    """Envía un correo reclamado y registra el resultado (enviado, reintento o error)"""
+    ahora = datetime.now(timezone.utc)
+    try:
+        status, respuesta = obtener_cliente_sendgrid().enviar(payload_correo(doc))
+    except Exception as e:
+        status, respuesta = None, str(e)
+    if status is not None and 200 <= status < 300:
+        correos.update_one({"_id": doc["_id"]}, {"$set": {"estado": "enviado", "enviado_at": ahora, "status": status},
+                                                 "$unset": {"bloqueado_hasta": ""}})
+        print(f"[EMAIL] ✅ Correo enviado exitosamente a {doc['destinatario']}: {doc['asunto']} (Status: {status})")
+        return True
+    reintentable = status is None or status == 429 or status >= 500
+    if reintentable and doc.get("intentos", 1) < CORREO_MAX_INTENTOS:
+        espera = min(CORREO_BACKOFF_BASE * 2 ** (doc.get("intentos", 1) - 1), CORREO_BACKOFF_MAX)
+        cambios = {"estado": "pendiente", "proximo_intento": ahora + timedelta(seconds=espera)}
+        print(f"[EMAIL] ⚠️ Error temporal enviando a {doc['destinatario']} ({status}); reintento en {espera}s")
+    else:
+        cambios = {"estado": "error"}
+        print(f"[EMAIL] ❌ Error enviando correo a {doc['destinatario']}: {status} {respuesta}")
+    cambios.update({"ultimo_error": f"{status}: {respuesta}"[:500], "status": status})
+    correos.update_one({"_id": doc["_id"]}, {"$set": cambios, "$unset": {"bloqueado_hasta": ""}})
+    return False
+
+def despachar_correos_pendientes(pool):
+    """Envía todo lo que esté listo en la bandeja; devuelve cuántos correos se procesaron"""
+    procesados = 0
+    while True:
+        lote = reclamar_correos(CORREO_HILOS * 2)
+        if not lote:
+            return procesados
+        list(pool.map(entregar_correo, lote))
+        procesados += len(lote)
+
+def despachador_correos():
+    """Hilo de fondo que vacía la bandeja de salida con un pool de CORREO_HILOS hilos"""
+    with ThreadPoolExecutor(max_workers=CORREO_HILOS, thread_name_prefix='correo') as pool:
+        while True:
+            try:
+                despachar_correos_pendientes(pool)
+            except Exception as e:
+                print(f"[EMAIL] Error en despachador: {e}")
+            _hay_correos.wait(CORREO_INTERVALO)
+            _hay_correos.clear()
+
+VENCIMIENTOS_INTERVALO = int(os.getenv('VENCIMIENTOS_INTERVALO', '900'))  # segundos entre revisiones
+
+def filtro_prestamos_vencidos():
+    """Préstamos no devueltos cuya fecha de devolución ya pasó (hora de México), con
+    el mismo criterio que los listados: no depende de que la tarea "vencimientos"
+    ya haya cambiado su estado"""
+    hoy_str = datetime.now(pytz.timezone('America/Mexico_City')).strftime('%Y-%m-%d')
+    return {"estado": {"$ne": "Devuelto"},
+            "$or": [{"estado": "Vencido"}, {"fecha_devolucion": {"$lt": hoy_str, "$ne": ""}}]}
 
 def verificar_y_actualizar_prestamos_vencidos():
-    """Verifica préstamos activos y los marca como vencidos, creando multas si es necesario"""
+    """Marca como vencidos los préstamos activos cuya fecha de devolución ya pasó y crea
+    o actualiza sus multas. Sólo lee los préstamos vencidos (índice estado + fecha_devolucion)
+    y escribe todo con operaciones por lote, así que el número de viajes a la base de datos
+    no crece con la cantidad de préstamos."""
     tz_mexico = pytz.timezone('America/Mexico_City')
-    hoy = datetime.now(tz_mexico).date()
-    prestamos_activos = prestamos.find({"estado": "Activo"})
-    
-    for prestamo in prestamos_activos:
-        fecha_dev_str = prestamo.get("fecha_devolucion", "")
-        if not fecha_dev_str:
-            continue
-        
+    ahora = datetime.now(tz_mexico)
+    hoy_str = ahora.strftime('%Y-%m-%d')
+    vencidos = []
+    for prestamo in prestamos.find({"estado": "Activo", "fecha_devolucion": {"$lt": hoy_str, "$ne": ""}}):
         try:
-            fecha_dev = datetime.strptime(fecha_dev_str, "%Y-%m-%d").date()
-            dias_retraso = calcular_dias_retraso(fecha_dev)
-            
-            if dias_retraso > 0:
-                # Marcar como vencido
-                prestamos.update_one(
-                    {"_id": prestamo["_id"]},
-                    {"$set": {"estado": "Vencido"}}
-                )
-                
-                # Actualizar estado en devoluciones
-                devoluciones.update_many(
-                    {"prestamo_id": str(prestamo["_id"])},
-                    {"$set": {"estado": "Vencido"}}
-                )
-                
-                # Verificar si ya existe multa para este préstamo
-                multa_existente = multas.find_one({
-                    "prestamo_id": str(prestamo["_id"]),
-                    "estado": "Pendiente"
-                })
-                
-                if not multa_existente:
-                    # Crear nueva multa
-                    monto = calcular_multa(dias_retraso)
-                    multa_doc = {
-                        "prestamo_id": str(prestamo["_id"]),
-                        "tipo": prestamo.get("tipo", "alumno"),
-                        "id": prestamo.get("id", ""),
-                        "nombre": prestamo.get("nombre", ""),
-                        "correo": prestamo.get("correo", ""),
-                        "libro": prestamo.get("libro", {}),
-                        "fecha_devolucion": fecha_dev_str,
-                        "dias_retraso": dias_retraso,
-                        "monto": monto,
-                        "estado": "Pendiente",
-                        "created_at": datetime.now(tz_mexico)
-                    }
-                    multas.insert_one(multa_doc)
-                else:
-                    # Actualizar multa existente con nuevos días de retraso
-                    monto = calcular_multa(dias_retraso)
-                    multas.update_one(
-                        {"_id": multa_existente["_id"]},
-                        {"$set": {
-                            "dias_retraso": dias_retraso,
-                            "monto": monto,
-                            "updated_at": datetime.now(tz_mexico)
-                        }}
-                    )
+            dias_retraso = calcular_dias_retraso(prestamo["fecha_devolucion"])
         except Exception as e:
             print(f"Error verificando préstamo {prestamo.get('_id')}: {e}")
-
-def enviar_recordatorios_diarios():
-    """Envía recordatorios diarios por correo a usuarios con préstamos activos"""
-    tz_mexico = pytz.timezone('America/Mexico_City')
-    hoy = datetime.now(tz_mexico).date()
-    prestamos_activos = prestamos.find({"estado": "Activo"})
-    
-    for prestamo in prestamos_activos:
-        correo = prestamo.get("correo", "")
-        if not correo:
             continue
-        
-        fecha_dev_str = prestamo.get("fecha_devolucion", "")
-        if not fecha_dev_str:
-            continue
-        
-        try:
-            fecha_dev = datetime.strptime(fecha_dev_str, "%Y-%m-%d").date()
-            dias_restantes = count_business_days_between(hoy, fecha_dev)
-            nombre = prestamo.get("nombre", "")
-            libro_titulo = prestamo.get("libro", {}).get("titulo", "el libro")
-            
-            asunto = ""
-            cuerpo = ""
-            
-            if dias_restantes == 0:
-                # Hoy es el día de devolución
-                asunto = "⚠️ Tu préstamo vence HOY"
-                cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo vence HOY.
-
-Libro: "{libro_titulo}"
-Fecha de vencimiento: {fecha_dev_str}
-
-Por favor, acude a la biblioteca HOY para realizar la devolución a tiempo y evitar multas.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-            elif dias_restantes == 1:
-                # Queda 1 día
-                asunto = "⏰ Tu préstamo vence en 1 día"
-                cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo vence en 1 día.
-
-Libro: "{libro_titulo}"
-Fecha de vencimiento: {fecha_dev_str}
-
-Por favor, acude a la biblioteca mañana para realizar la devolución a tiempo.
+        if dias_retraso > 0:
+            vencidos.append((prestamo, dias_retraso))
+    if not vencidos:
+        return 0
 
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-            elif dias_restantes == 2:
-                # Quedan 2 días
-                asunto = "📚 Tu préstamo vence en 2 días"
-                cuerpo = f"""Estimado/a {nombre},
+    ids = [p["_id"] for p, _ in vencidos]
+    ids_str = [str(i) for i in ids]
+    prestamos.update_many({"_id": {"$in": ids}}, {"$set": {"estado": "Vencido"}})
+    devoluciones.update_many({"prestamo_id": {"$in": ids_str}}, {"$set": {"estado": "Vencido"}})
 
-Tu préstamo vence en 2 días.
+    multas_existentes = {
+        m["prestamo_id"]: m["_id"]
+        for m in multas.find({"prestamo_id": {"$in": ids_str}, "estado": "Pendiente"}, {"prestamo_id": 1})
+    }
+    operaciones = []
+    for prestamo, dias_retraso in vencidos:
+        prestamo_id = str(prestamo["_id"])
+        monto = calcular_multa(dias_retraso)
+        if prestamo_id in multas_existentes:
+            # Actualizar multa existente con nuevos días de retraso
+            operaciones.append(UpdateOne(
+                {"_id": multas_existentes[prestamo_id]},
+                {"$set": {"dias_retraso": dias_retraso, "monto": monto, "updated_at": ahora}}
+            ))
+        else:
+            operaciones.append(InsertOne({
+                "prestamo_id": prestamo_id,
+                "tipo": prestamo.get("tipo", "alumno"),
+                "id": prestamo.get("id", ""),
+                "nombre": prestamo.get("nombre", ""),
+                "correo": prestamo.get("correo", ""),
+                "libro": prestamo.get("libro", {}),
+                "fecha_devolucion": prestamo.get("fecha_devolucion", ""),
+                "dias_retraso": dias_retraso,
+                "monto": monto,
+                "estado": "Pendiente",
+                "created_at": ahora
+            }))
+    multas.bulk_write(operaciones, ordered=False)
+    print(f"[VENCIMIENTOS] {len(vencidos)} préstamos marcados como vencidos")
+    return len(vencidos)
 
-Libro: "{libro_titulo}"
-Fecha de vencimiento: {fecha_dev_str}
+def recalcular_multas(lote=1000):
+    """Recalcula dias_retraso/monto de todas las multas pendientes en una pasada y
+    escribe sólo las que cambiaron, con bulk_write por lotes. Devuelve cuántas cambiaron."""
+    ahora = datetime.now(timezone.utc)
+    pendientes = list(multas.find({"estado": "Pendiente", "fecha_devolucion": {"$nin": ["", None]}},
+                                  {"fecha_devolucion": 1, "dias_retraso": 1, "monto": 1}))
+    try:
+        dias = calcular_dias_retraso_lote([m["fecha_devolucion"] for m in pendientes])
+    except ValueError:
+        # alguna fecha con formato inválido: calcular una por una
+        dias = [calcular_dias_retraso(m["fecha_devolucion"]) for m in pendientes]
+    operaciones = []
+    modificadas = 0
+    for multa, dias_retraso in zip(pendientes, dias):
+        monto = calcular_multa(dias_retraso)
+        if multa.get("dias_retraso") == dias_retraso and multa.get("monto") == monto:
+            continue
+        operaciones.append(UpdateOne(
+            {"_id": multa["_id"]},
+            {"$set": {"dias_retraso": dias_retraso, "monto": monto, "updated_at": ahora}}
+        ))
+        if len(operaciones) >= lote:
+            modificadas += multas.bulk_write(operaciones, ordered=False).modified_count
+            operaciones = []
+    if operaciones:
+        modificadas += multas.bulk_write(operaciones, ordered=False).modified_count
+    return modificadas
 
-Por favor, acude a la biblioteca para realizar la devolución a tiempo.
+FIRMA_CORREO = '''
 
 Saludos,
 Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-            elif dias_restantes == 3:
-                # Quedan 3 días
-                asunto = "📖 Tu préstamo vence en 3 días"
-                cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo vence en 3 días.
-
-Libro: "{libro_titulo}"
-Fecha de vencimiento: {fecha_dev_str}
+IPN'''
+
+# Recordatorios de préstamo por días hábiles restantes: (asunto, aviso, indicación)
+PLANTILLAS_RECORDATORIO = {
+    0: ("⚠️ Tu préstamo vence HOY", "Tu préstamo vence HOY.",
+        "Por favor, acude a la biblioteca HOY para realizar la devolución a tiempo y evitar multas."),
+    1: ("⏰ Tu préstamo vence en 1 día", "Tu préstamo vence en 1 día.",
+        "Por favor, acude a la biblioteca mañana para realizar la devolución a tiempo."),
+    2: ("📚 Tu préstamo vence en 2 días", "Tu préstamo vence en 2 días.",
+        "Por favor, acude a la biblioteca para realizar la devolución a tiempo."),
+    3: ("📖 Tu préstamo vence en 3 días", "Tu préstamo vence en 3 días.",
+        "Por favor, acude a la biblioteca para realizar la devolución a tiempo."),
+}
+
+# Recordatorios de multa por días de retraso (1, 2, 3 y "más de 3" = None)
+PLANTILLAS_MULTA = {
+    1: "💰 Préstamo vencido: Debes 1 día de multa",
+    2: "💰 Préstamo vencido: Debes 2 días de multa",
+    3: "💰 Préstamo vencido: Debes 3 días de multa",
+    None: "💰 Préstamo vencido: Debes -dias- días de multa",
+}
 
-Por favor, acude a la biblioteca para realizar la devolución a tiempo.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-            
-            if asunto and cuerpo:
-                enviar_correo(correo, asunto, cuerpo)
+def enviar_recordatorios_diarios():
+    """Envía recordatorios a usuarios con préstamos que vencen en 3 días hábiles o menos.
+    Un usuario con varios libros recibe un solo correo con todos ellos; los correos se
+    agrupan por plantilla y se encolan como peticiones por lote."""
+    tz_mexico = pytz.timezone('America/Mexico_City')
+    hoy = datetime.now(tz_mexico).date()
+    # nada con 4 o más días hábiles por delante puede recibir recordatorio
+    limite = add_business_days(hoy, 4).strftime('%Y-%m-%d')
+    por_usuario = {}
+    for prestamo in prestamos.find(
+            {"estado": "Activo", "correo": {"$nin": ["", None]}, "fecha_devolucion": {"$nin": ["", None], "$lt": limite}},
+            {"correo": 1, "nombre": 1, "libro": 1, "fecha_devolucion": 1}):
+        try:
+            fecha_dev_str = prestamo["fecha_devolucion"]
+            dias_restantes = count_business_days_between(hoy, fecha_dev_str)
         except Exception as e:
-            print(f"Error enviando recordatorio a {correo}: {e}")
-
-def enviar_recordatorios_multas():
-    """Envía recordatorios de multas pendientes con mensajes según días de retraso"""
-    multas_pendientes = multas.find({"estado": "Pendiente"})
-    
-    for multa in multas_pendientes:
-        correo = multa.get("correo", "")
-        if not correo:
+            print(f"Error preparando recordatorio del préstamo {prestamo.get('_id')}: {e}")
             continue
-        
-        # Recalcular días de retraso y monto actualizados
-        fecha_dev_str = multa.get("fecha_devolucion", "")
-        if fecha_dev_str:
-            try:
-                dias_retraso = calcular_dias_retraso(fecha_dev_str)
-                monto = calcular_multa(dias_retraso)
-                # Actualizar en la base de datos
-                multas.update_one(
-                    {"_id": multa["_id"]},
-                    {"$set": {
-                        "dias_retraso": dias_retraso,
-                        "monto": monto,
-                        "updated_at": datetime.now(timezone.utc)
-                    }}
-                )
-            except Exception:
-                dias_retraso = multa.get("dias_retraso", 0)
-                monto = multa.get("monto", 0)
-        else:
-            dias_retraso = multa.get("dias_retraso", 0)
-            monto = multa.get("monto", 0)
-        
-        nombre = multa.get("nombre", "")
-        libro_titulo = multa.get("libro", {}).get("titulo", "el libro")
-        
-        # Mensaje según días de retraso
-        if dias_retraso == 1:
-            asunto = "💰 Préstamo vencido: Debes 1 día de multa"
-            cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo está vencido. Debes 1 día de multa.
-
-Libro: "{libro_titulo}"
-Días de retraso: 1 día hábil
-Monto a pagar: ${monto:.2f} (${7.50:.2f} por día hábil de retraso)
-
-Por favor, acude a la biblioteca para pagar tu multa y devolver el libro.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-        elif dias_retraso == 2:
-            asunto = "💰 Préstamo vencido: Debes 2 días de multa"
-            cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo está vencido. Debes 2 días de multa.
-
-Libro: "{libro_titulo}"
-Días de retraso: 2 días hábiles
-Monto a pagar: ${monto:.2f} (${7.50:.2f} por día hábil de retraso)
-
-Por favor, acude a la biblioteca para pagar tu multa y devolver el libro.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-        elif dias_retraso == 3:
-            asunto = "💰 Préstamo vencido: Debes 3 días de multa"
-            cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo está vencido. Debes 3 días de multa.
-
-Libro: "{libro_titulo}"
-Días de retraso: 3 días hábiles
-Monto a pagar: ${monto:.2f} (${7.50:.2f} por día hábil de retraso)
-
-Por favor, acude a la biblioteca para pagar tu multa y devolver el libro.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-        else:
-            # Más de 3 días
-            asunto = f"💰 Préstamo vencido: Debes {dias_retraso} días de multa"
-            cuerpo = f"""Estimado/a {nombre},
-
-Tu préstamo está vencido. Debes {dias_retraso} días de multa.
-
-Libro: "{libro_titulo}"
-Días de retraso: {dias_retraso} días hábiles
-Monto a pagar: ${monto:.2f} (${7.50:.2f} por día hábil de retraso)
-
-Por favor, acude a la biblioteca para pagar tu multa y devolver el libro.
-
-Saludos,
-Biblioteca CECyT 19 "Leona Vicario"
-IPN"""
-        
-        enviar_correo(correo, asunto, cuerpo)
+        if dias_restantes > 3:
+            continue
+        correo = prestamo["correo"].strip()
+        usuario = por_usuario.setdefault(correo.lower(), {
+            "correo": correo, "nombre": prestamo.get("nombre", ""), "dias": dias_restantes, "libros": [], "claves": []
+        })
+        usuario["dias"] = min(usuario["dias"], dias_restantes)
+        libro_titulo = (prestamo.get("libro") or {}).get("titulo", "el libro")
+        usuario["libros"].append(f'Libro: "{libro_titulo}"\nFecha de vencimiento: {fecha_dev_str}')
+        usuario["claves"].append(f"recordatorio:{hoy}:{prestamo['_id']}")
+
+    grupos = {}
+    for usuario in por_usuario.values():
+        grupos.setdefault(usuario["dias"], []).append(usuario)
+    for dias, usuarios in sorted(grupos.items()):
+        asunto, aviso, indicacion = PLANTILLAS_RECORDATORIO[dias]
+        cuerpo = f"Estimado/a -nombre-,\n\n{aviso}\n\n-libros-\n\n{indicacion}" + FIRMA_CORREO
+        encolar_lote(asunto, cuerpo, [
+            (u["correo"], {"-nombre-": u["nombre"], "-libros-": "\n\n".join(u["libros"])}, u["claves"])
+            for u in usuarios
+        ])
 
-@app.route('/api/registrar_prestamo', methods=['POST'])
-def registrar_prestamo():
-    datos = request.get_json() or {}
-    tipo = datos.get('tipo', 'alumno')
-    identificador = datos.get('id') or datos.get('boleta') or datos.get('no_empleado') or ''
-    nombre = datos.get('nombre') or ''
-    grupo = datos.get('grupo') or datos.get('cargo') or ''
-    correo = datos.get('correo') or ''
+def enviar_recordatorios_multas():
+    """Envía recordatorios de multas pendientes con mensajes según días de retraso.
+    Un usuario con varias multas recibe un solo correo con el detalle y el total."""
+    # Actualizar días de retraso y montos de todas las multas en una sola pasada
+    recalcular_multas()
+    hoy = datetime.now(pytz.timezone('America/Mexico_City')).date()
+    por_usuario = {}
+    for multa in multas.find({"estado": "Pendiente", "correo": {"$nin": ["", None]}},
+                             {"correo": 1, "nombre": 1, "libro": 1, "dias_retraso": 1, "monto": 1}):
+        correo = multa["correo"].strip()
+        usuario = por_usuario.setdefault(correo.lower(), {
+            "correo": correo, "nombre": multa.get("nombre", ""), "dias": 0, "total": 0, "detalle": [], "claves": []
+        })
+        dias_retraso = multa.get("dias_retraso", 0)
+        monto = multa.get("monto", 0)
+        usuario["dias"] = max(usuario["dias"], dias_retraso)
+        usuario["total"] += monto
+        libro_titulo = (multa.get("libro") or {}).get("titulo", "el libro")
+        dias_texto = "1 día hábil" if dias_retraso == 1 else f"{dias_retraso} días hábiles"
+        usuario["detalle"].append(
+            f'Libro: "{libro_titulo}"\nDías de retraso: {dias_texto}\n'
+            f'Monto a pagar: ${monto:.2f} (${7.50:.2f} por día hábil de retraso)'
+        )
+        usuario["claves"].append(f"multa:{hoy}:{multa['_id']}")
+
+    grupos = {}
+    for usuario in por_usuario.values():
+        grupos.setdefault(usuario["dias"] if usuario["dias"] in (1, 2, 3) else None, []).append(usuario)
+    for bucket, usuarios in grupos.items():
+        cuerpo = ("Estimado/a -nombre-,\n\nTu préstamo está vencido. Debes -dias- días de multa.\n\n-detalle-"
+                  "\n\nPor favor, acude a la biblioteca para pagar tu multa y devolver el libro." + FIRMA_CORREO)
+        if bucket == 1:
+            cuerpo = cuerpo.replace("Debes -dias- días de multa", "Debes 1 día de multa")
+        destinatarios = []
+        for u in usuarios:
+            detalle = "\n\n".join(u["detalle"])
+            if len(u["detalle"]) > 1:
+                detalle += f"\n\nTotal a pagar: ${u['total']:.2f}"
+            destinatarios.append((u["correo"], {"-nombre-": u["nombre"], "-dias-": u["dias"], "-detalle-": detalle},
+                                  u["claves"]))
+        encolar_lote(PLANTILLAS_MULTA[bucket], cuerpo, destinatarios)
+
+def documento_prestamo(datos):
+    """Documento de Prestamos a partir de los datos enviados por la interfaz"""
     libro = datos.get('libro') or {}
-    titulo = libro.get('titulo') or datos.get('titulo') or ''
-    isbn = libro.get('isbn') or datos.get('ISBN') or ''
-
     # fecha inicio = hoy (hora local México), fecha devolucion = +3 dias hábiles
-    tz_mexico = pytz.timezone('America/Mexico_City')
-    hoy_dt = datetime.now(tz_mexico)
-    fecha_inicio = datos.get('fecha_inicio') or hoy_dt.strftime('%Y-%m-%d')
-    fecha_devolucion = datos.get('fecha_devolucion') or add_business_days(hoy_dt, 3).strftime('%Y-%m-%d')
-
-    doc = {
-        "tipo": tipo,
-        "id": identificador,
-        "nombre": nombre,
-        "grupo": grupo,
-        "correo": correo,
-        "libro": {"titulo": titulo, "isbn": isbn},
-        "fecha_inicio": fecha_inicio,
-        "fecha_devolucion": fecha_devolucion,
+    hoy_dt = datetime.now(ZONA_MEXICO)
+    return {
+        "tipo": datos.get('tipo', 'alumno'),
+        "id": datos.get('id') or datos.get('boleta') or datos.get('no_empleado') or '',
+        "nombre": datos.get('nombre') or '',
+        "grupo": datos.get('grupo') or datos.get('cargo') or '',
+        "correo": datos.get('correo') or '',
+        "libro": {"titulo": libro.get('titulo') or datos.get('titulo') or '',
+                  "isbn": libro.get('isbn') or datos.get('ISBN') or ''},
+        "fecha_inicio": datos.get('fecha_inicio') or hoy_dt.strftime('%Y-%m-%d'),
+        "fecha_devolucion": datos.get('fecha_devolucion') or add_business_days(hoy_dt, 3).strftime('%Y-%m-%d'),
         "estado": "Activo",
-        "created_at": datetime.now(tz_mexico)
+        "created_at": hoy_dt
     }
 
+def contar_prestamos_hoy():
+    """Préstamos registrados hoy (hora local México)"""
+    start = datetime.now(ZONA_MEXICO).replace(hour=0, minute=0, second=0, microsecond=0)
     try:
-        result = prestamos.insert_one(doc)
-        prestamo_inserted_id = result.inserted_id
-        
-        # Crear registro en devoluciones
-        devolucion_doc = {
-            "prestamo_id": str(prestamo_inserted_id),
-            "tipo": tipo,
-            "id": identificador,
-            "nombre": nombre,
-            "grupo": grupo,
-            "correo": correo,
-            "libro": {"titulo": titulo, "isbn": isbn},
-            "fecha_inicio": fecha_inicio,
-            "fecha_devolucion": fecha_devolucion,
-            "estado": "Activo",
-            "created_at": datetime.now(tz_mexico)
-        }
-        # Intentar insertar en devoluciones (puede fallar si la colección no existe, pero no es crítico)
-        try:
-            devoluciones.insert_one(devolucion_doc)
-        except Exception as e:
-            print(f"[DEVOLUCIONES] No se pudo crear registro en devoluciones: {e}")
-        
-        # Enviar correo de confirmación de préstamo
+        return prestamos.count_documents({"created_at": {"$gte": start, "$lt": start + timedelta(days=1)}})
+    except Exception:
+        return 0
+
+@app.route('/api/registrar_prestamo', methods=['POST'])
+def registrar_prestamo():
+    doc = documento_prestamo(request.get_json() or {})
+    nombre, correo = doc["nombre"], doc["correo"]
+    titulo, isbn = doc["libro"]["titulo"], doc["libro"]["isbn"]
+    fecha_inicio, fecha_devolucion = doc["fecha_inicio"], doc["fecha_devolucion"]
+
+    devolucion_doc = dict(doc, libro=dict(doc["libro"]))
+
+    def registrar(session):
+        # El libro se localiza una sola vez (el ISBN manda sobre el título: si la
+        # edición pedida no tiene ejemplares no se toma otra con el mismo título).
+        # Luego se aparta un ejemplar de ese _id: la condición DISPONIBLES > 0 y el
+        # $inc se evalúan juntos en el servidor, así dos préstamos simultáneos no
+        # pueden descontar el mismo ejemplar ni dejar el inventario en negativo.
+        apartado = None
+        libro = buscar_libro_inventario(isbn, titulo, session=session)
+        if libro:
+            apartado = inventario.find_one_and_update(
+                {"_id": libro["_id"], "DISPONIBLES": {"$gt": 0}}, {"$inc": {"DISPONIBLES": -1}},
+                projection={"DISPONIBLES": 1}, return_document=ReturnDocument.AFTER, session=session)
+            if apartado is None:
+                return None  # el libro está catalogado pero no quedan ejemplares
+
+        # _id generado aquí para que la devolución lo referencie sin otra lectura
+        prestamo_id = ObjectId()
+        prestamos.insert_one(dict(doc, _id=prestamo_id), session=session)
+        devoluciones.insert_one(dict(devolucion_doc, prestamo_id=str(prestamo_id)), session=session)
+        if apartado:
+            ajustar_libros_estanteria(apartado["DISPONIBLES"] + 1, apartado["DISPONIBLES"], session=session)
+        return prestamo_id, (apartado["DISPONIBLES"] if apartado else None)
+
+    try:
+        registrado = en_transaccion(registrar)
+        if registrado is None:
+            return jsonify({"success": False, "error": f'No hay ejemplares disponibles de "{titulo or isbn}"'}), 409
+        prestamo_inserted_id, nuevo_valor_disponibles = registrado
+        invalidar_reporte_mensual(fecha_inicio)
+
+        # Enviar correo de confirmación de préstamo (ya confirmada la transacción)
         if correo:
             asunto = "✅ Has adquirido un préstamo - Biblioteca CECyT 19"
             cuerpo = f"""Estimado/a {nombre},
@@ -1688,89 +2584,12 @@ Tu préstamo vence el {fecha_devolucion}. Recibirás recordatorios cuando falten
 Saludos,
 Biblioteca CECyT 19 "Leona Vicario"
 IPN"""
-            enviar_correo(correo, asunto, cuerpo)
-
-        # --- actualizar inventario: buscar por ISBN primero, luego por título ---
-        nuevo_valor_disponibles = None
-        if isbn or titulo:
-            or_clauses = []
-            if isbn:
-                or_clauses += [{"ISBN": isbn}, {"Isbn": isbn}, {"isbn": isbn}, {"ISBN": {"$regex": f"^{isbn}$"}}]
-            if titulo:
-                or_clauses += [
-                    {"TÍTULO": titulo}, {"TITULO": titulo}, {"Titulo": titulo}, {"titulo": titulo},
-                    {"title": titulo}
-                ]
-            if or_clauses:
-                found = inventario.find_one({"$or": or_clauses})
-                if found:
-                    # obtener valor actual de disponibles intentando varias claves
-                    cur = None
-                    for k in ("DISPONIBLES","Disponibles","disponible","DISPONIBLE"):
-                        if k in found and found.get(k) not in (None, ''):
-                            cur = extract_number(found.get(k))
-                            source_key = k
-                            break
-                    # fallback a estructura U
-                    if cur in (None, ''):
-                        cur = obtener_disponibles(found)
-                        source_key = None
-                    # intentar parsear a entero
-                    cur_n = None
-                    try:
-                        if isinstance(cur, (int, float)):
-                            cur_n = int(cur)
-                        elif isinstance(cur, str) and cur.strip().isdigit():
-                            cur_n = int(cur.strip())
-                    except Exception:
-                        cur_n = None
-
-                    if cur_n is not None:
-                        nuevo = max(0, cur_n - 1)
-                        nuevo_valor_disponibles = nuevo
-                        # actualizar campo canonical DISPONIBLES para que front y dashboard lo lean
-                        inventario.update_one({"_id": found["_id"]}, {"$set": {"DISPONIBLES": nuevo}})
-                    else:
-                        # si no se pudo leer número, aún escribe DISPONIBLES = 0 (seguro)
-                        inventario.update_one({"_id": found["_id"]}, {"$set": {"DISPONIBLES": 0}})
-                        nuevo_valor_disponibles = 0
-
+            enviar_correo(correo, asunto, cuerpo, clave=f"prestamo:{prestamo_inserted_id}")
 
-        tz_mexico = pytz.timezone('America/Mexico_City')
-        start = datetime.now(tz_mexico).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1)
-        try:
-            prestamos_hoy = prestamos.count_documents({"created_at": {"$gte": start, "$lt": end}})
-        except Exception:
-            prestamos_hoy = 0
+        prestamos_hoy = contar_prestamos_hoy()
 
         # libros en estantería (suma DISPONIBLES)
-        libros_en_estanteria = 0
-        for doc in inventario.find({}):
-            v = None
-            if "DISPONIBLES" in doc and doc.get("DISPONIBLES") not in (None, ""):
-                try:
-                    v = int(doc.get("DISPONIBLES"))
-                except Exception:
-                    v = None
-            if v is None:
-                for k in ("Disponibles","disponibles","DISPONIBLE","Disponible"):
-                    if k in doc and doc.get(k) not in (None, ""):
-                        try:
-                            v = int(doc.get(k)); break
-                        except Exception:
-                            v = None
-            if v is None:
-                try:
-                    tmp = obtener_disponibles(doc)
-                    if isinstance(tmp, int):
-                        v = tmp
-                    elif isinstance(tmp, str) and tmp.isdigit():
-                        v = int(tmp)
-                except Exception:
-                    v = None
-            if isinstance(v, int) and v > 0:
-                libros_en_estanteria += v
+        libros_en_estanteria = contar_libros_estanteria()
 
         return jsonify({
             "success": True,
@@ -1781,11 +2600,300 @@ IPN"""
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+# --- Devolución de préstamos ---
+# eliminar_prestamo, liberar_prestamo_vencido y liberar_multa comparten
+# devolver_prestamo(): borra el préstamo, su registro en Devoluciones (sólo el
+# de ese prestamo_id), marca pagada la multa y regresa el ejemplar con $inc,
+# todo en una transacción y con un número fijo de operaciones por devolución.
+def filtro_por_id(valor):
+    """Filtro por _id (ObjectId o, en registros antiguos, texto)"""
+    try:
+        return {"_id": ObjectId(valor)}
+    except Exception:
+        return {"_id": valor}
+
+def devolver_prestamo(filtros, multa=None, pagar_multa=False):
+    """Devuelve el primer préstamo que coincida con filtros (se prueban en orden).
+    multa: filtro de la multa que se marca como pagada; con pagar_multa=True se
+    paga la multa pendiente del préstamo encontrado, si la hay. Devuelve
+    {"prestamo", "disponibles", "multa_pagada"}; prestamo es None si ningún
+    filtro encontró un préstamo."""
+    def devolver(session):
+        prestamo = None
+        for filtro in filtros:
+            prestamo = prestamos.find_one_and_delete(filtro, {"fecha_inicio": 1, "libro": 1}, session=session)
+            if prestamo:
+                break
+
+        filtro_multa = multa
+        if filtro_multa is None and pagar_multa and prestamo:
+            filtro_multa = {"prestamo_id": str(prestamo["_id"]), "estado": "Pendiente"}
+        multa_pagada = False
+        if filtro_multa:
+            multa_pagada = multas.update_one(
+                filtro_multa,
+                {"$set": {"estado": "Pagada", "fecha_pago": datetime.now(ZONA_MEXICO)}},
+                session=session
+            ).modified_count > 0
+
+        disponibles = None
+        if prestamo:
+            devoluciones.delete_many({"prestamo_id": str(prestamo["_id"])}, session=session)
+            libro = prestamo.get("libro") or {}
+            for consulta in consultas_libro_inventario(libro.get("isbn"), libro.get("titulo")):
+                regresado = inventario.find_one_and_update(
+                    consulta, {"$inc": {"DISPONIBLES": 1}}, projection={"DISPONIBLES": 1},
+                    return_document=ReturnDocument.AFTER, session=session)
+                if regresado:
+                    disponibles = regresado["DISPONIBLES"]
+                    ajustar_libros_estanteria(disponibles - 1, disponibles, session=session)
+                    break
+        return {"prestamo": prestamo, "disponibles": disponibles, "multa_pagada": multa_pagada}
+
+    resultado = en_transaccion(devolver)
+    if resultado["prestamo"]:
+        invalidar_reporte_mensual(resultado["prestamo"].get("fecha_inicio"))
+    return resultado
+
+# --- Préstamos por lote ---
+# Un docente puede llevarse 30-40 ejemplares para un grupo. /api/prestamos/lote
+# registra todos en una sola petición: una lectura para localizar los libros, un
+# $inc por título (no por ejemplar), insert_many de préstamos y devoluciones en
+# una transacción y un solo correo de resumen por usuario. Cada elemento recibe
+# su propio resultado; los que no alcanzan ejemplar no detienen a los demás.
+PRESTAMOS_LOTE_MAX = int(os.getenv('PRESTAMOS_LOTE_MAX', '200'))
+
+def resolver_libros_lote(libros, session=None):
+    """Localiza con una sola consulta los libros [(isbn, titulo), ...] del lote.
+    Devuelve {(isbn, titulo): doc de Inventario} con la misma preferencia que
+    consultas_libro_inventario (ISBN normalizado, ISBN capturado, título)."""
+    isbns = {str(isbn) for isbn, _ in libros if isbn}
+    normalizados = {normalizar_isbn(isbn) for isbn in isbns} - {''}
+    crudos = isbns | {isbn.replace('-', '').replace(' ', '').strip() for isbn in isbns}
+    titulos = {titulo for _, titulo in libros if titulo}
+    condiciones = []
+    if normalizados:
+        condiciones.append({"isbn_normalizado": {"$in": sorted(normalizados)}})
+    if crudos:
+        condiciones.append({"ISBN": {"$in": sorted(crudos)}})
+    if titulos:
+        condiciones.append({"TÍTULO": {"$in": sorted(titulos)}})
+    if not condiciones:
+        return {}
+    por_campo = {"isbn_normalizado": {}, "ISBN": {}, "TÍTULO": {}}
+    for doc in inventario.find({"$or": condiciones},
+                               {"DISPONIBLES": 1, "isbn_normalizado": 1, "ISBN": 1, "TÍTULO": 1},
+                               session=session):
+        for campo, indice in por_campo.items():
+            if doc.get(campo) not in (None, ''):
+                indice.setdefault(str(doc[campo]), doc)
+    encontrados = {}
+    for isbn, titulo in set(libros):
+        doc = None
+        if isbn:
+            isbn = str(isbn)
+            doc = (por_campo["isbn_normalizado"].get(normalizar_isbn(isbn)) or por_campo["ISBN"].get(isbn)
+                   or por_campo["ISBN"].get(isbn.replace('-', '').replace(' ', '').strip()))
+        if not doc and titulo:
+            doc = por_campo["TÍTULO"].get(titulo)
+        if doc:
+            encontrados[(isbn, titulo)] = doc
+    return encontrados
+
+def apartar_ejemplares(libro_doc, cantidad, session=None, intentos=3):
+    """Descuenta hasta cantidad ejemplares de un libro con un solo $inc condicional.
+    Si otro préstamo cambió DISPONIBLES entre la lectura y la escritura, vuelve a
+    leer y reintenta. Devuelve cuántos ejemplares se apartaron."""
+    disponibles = libro_doc.get("DISPONIBLES") or 0
+    for _ in range(intentos):
+        tomar = min(cantidad, max(0, disponibles))
+        if tomar <= 0:
+            return 0
+        apartado = inventario.find_one_and_update(
+            {"_id": libro_doc["_id"], "DISPONIBLES": {"$gte": tomar}}, {"$inc": {"DISPONIBLES": -tomar}},
+            projection={"DISPONIBLES": 1}, return_document=ReturnDocument.AFTER, session=session)
+        if apartado:
+            ajustar_libros_estanteria(apartado["DISPONIBLES"] + tomar, apartado["DISPONIBLES"], session=session)
+            return tomar
+        actual = inventario.find_one({"_id": libro_doc["_id"]}, {"DISPONIBLES": 1}, session=session)
+        disponibles = (actual or {}).get("DISPONIBLES") or 0
+    return 0
+
+def _elementos_lote(datos, campo):
+    """Lista de elementos del lote; los campos del nivel superior (p. ej. el
+    docente) sirven de valor por omisión para cada elemento"""
+    elementos = datos.get(campo)
+    if not isinstance(elementos, list) or not elementos:
+        return None, (jsonify({"success": False, "error": f"'{campo}' debe ser una lista no vacía"}), 400)
+    if len(elementos) > PRESTAMOS_LOTE_MAX:
+        return None, (jsonify({"success": False, "error": f"Máximo {PRESTAMOS_LOTE_MAX} elementos por lote"}), 400)
+    return elementos, None
+
+@app.route('/api/prestamos/lote', methods=['POST'])
+def registrar_prestamos_lote():
+    """Registra varios préstamos: {"prestamos": [{...como registrar_prestamo}], ...comunes}"""
+    datos = request.get_json() or {}
+    elementos, error = _elementos_lote(datos, "prestamos")
+    if error:
+        return error
+    comunes = {k: v for k, v in datos.items() if k != "prestamos"}
+    # un elemento que no es objeto se rechaza por sí solo en vez de tomar los datos comunes
+    docs = [documento_prestamo(dict(comunes, **e)) if isinstance(e, dict) else None for e in elementos]
+    libros = [(d["libro"]["isbn"], d["libro"]["titulo"]) if d else (None, None) for d in docs]
+
+    def registrar(session):
+        encontrados = resolver_libros_lote(libros, session=session)
+        # agrupar por título del inventario: un $inc por libro
+        por_libro = {}
+        for i, libro in enumerate(libros):
+            if docs[i] and libro in encontrados:
+                por_libro.setdefault(encontrados[libro]["_id"], []).append(i)
+        sin_ejemplar = set()
+        disponibles = {}
+        for libro_id, indices in por_libro.items():
+            libro_doc = next(encontrados[libros[i]] for i in indices)
+            apartados = apartar_ejemplares(libro_doc, len(indices), session=session)
+            sin_ejemplar.update(indices[apartados:])
+            disponibles[libro_id] = apartados
+
+        resultados, nuevos, nuevas_devoluciones = [], [], []
+        for i, doc in enumerate(docs):
+            if doc is None:
+                resultados.append({"indice": i, "success": False, "error": "Cada préstamo debe ser un objeto"})
+                continue
+            if not doc["libro"]["titulo"] and not doc["libro"]["isbn"]:
+                resultados.append({"indice": i, "success": False, "error": "Libro requerido"})
+                continue
+            if i in sin_ejemplar:
+                resultados.append({"indice": i, "success": False,
+                                   "error": f'No hay ejemplares disponibles de "{doc["libro"]["titulo"] or doc["libro"]["isbn"]}"'})
+                continue
+            prestamo_id = ObjectId()
+            nuevos.append(dict(doc, _id=prestamo_id))
+            nuevas_devoluciones.append(dict(doc, libro=dict(doc["libro"]), prestamo_id=str(prestamo_id)))
+            resultados.append({"indice": i, "success": True, "prestamo_id": str(prestamo_id)})
+        if nuevos:
+            prestamos.insert_many(nuevos, session=session)
+            devoluciones.insert_many(nuevas_devoluciones, session=session)
+        return resultados, nuevos
+
+    try:
+        resultados, nuevos = en_transaccion(registrar)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    for fecha in {d["fecha_inicio"] for d in nuevos}:
+        invalidar_reporte_mensual(fecha)
+
+    # un correo de resumen por usuario (ya confirmada la transacción)
+    por_correo = {}
+    for doc in nuevos:
+        if doc["correo"]:
+            por_correo.setdefault(doc["correo"], []).append(doc)
+    for correo, docs_usuario in por_correo.items():
+        lista = "\n".join(f'- "{d["libro"]["titulo"]}" (ISBN: {d["libro"]["isbn"]}), devolver a más tardar el {d["fecha_devolucion"]}'
+                          for d in docs_usuario)
+        cuerpo = f"""Estimado/a {docs_usuario[0]["nombre"]},
+
+Has adquirido {len(docs_usuario)} préstamo(s):
+
+{lista}
+
+Fecha de préstamo: {docs_usuario[0]["fecha_inicio"]}
+Recibirás recordatorios cuando falten 3, 2 y 1 día para la fecha de vencimiento.
+
+Saludos,
+Biblioteca CECyT 19 "Leona Vicario"
+IPN"""
+        asunto = f"✅ Has adquirido {len(docs_usuario)} préstamo(s) - Biblioteca CECyT 19"
+        enviar_correo(correo, asunto, cuerpo, clave=f"prestamos:{docs_usuario[0]['_id']}")
+
+    return jsonify({
+        "success": True,
+        "registrados": len(nuevos),
+        "rechazados": len(resultados) - len(nuevos),
+        "resultados": resultados,
+        "prestamos_hoy": contar_prestamos_hoy(),
+        "libros_estanteria": contar_libros_estanteria()
+    })
+
+@app.route('/api/prestamos/lote/devolver', methods=['POST'])
+def devolver_prestamos_lote():
+    """Devuelve varios préstamos: {"prestamo_ids": [...], "pagar_multas": false}.
+    Igual que devolver_prestamo: la multa pendiente de cada préstamo se informa en
+    su resultado y sólo se marca como pagada con pagar_multas=true."""
+    datos = request.get_json() or {}
+    ids, error = _elementos_lote(datos, "prestamo_ids")
+    if error:
+        return error
+    pagar_multas = datos.get("pagar_multas") is True
+    validos = [i for i in ids if isinstance(i, str) and i]
+    claves = [filtro_por_id(i)["_id"] for i in validos]
+
+    def devolver(session):
+        encontrados = {str(p["_id"]): p for p in prestamos.find(
+            {"_id": {"$in": claves}}, {"libro": 1, "fecha_inicio": 1}, session=session)}
+        if not encontrados:
+            return encontrados, {}
+        pendientes = {}
+        for multa in multas.find({"prestamo_id": {"$in": list(encontrados)}, "estado": "Pendiente"},
+                                 {"prestamo_id": 1, "monto": 1}, session=session):
+            pendientes.setdefault(multa["prestamo_id"], multa)
+        if pagar_multas and pendientes:
+            multas.update_many(
+                {"_id": {"$in": [m["_id"] for m in pendientes.values()]}},
+                {"$set": {"estado": "Pagada", "fecha_pago": datetime.now(ZONA_MEXICO)}},
+                session=session
+            )
+        prestamos.delete_many({"_id": {"$in": [p["_id"] for p in encontrados.values()]}}, session=session)
+        devoluciones.delete_many({"prestamo_id": {"$in": list(encontrados)}}, session=session)
+        libros = [((p.get("libro") or {}).get("isbn"), (p.get("libro") or {}).get("titulo"))
+                  for p in encontrados.values()]
+        libros_doc = resolver_libros_lote(libros, session=session)
+        por_libro = {}
+        for libro in libros:
+            if libro in libros_doc:
+                por_libro.setdefault(libros_doc[libro]["_id"], [libros_doc[libro], 0])[1] += 1
+        if por_libro:
+            inventario.bulk_write([UpdateOne({"_id": libro_id}, {"$inc": {"DISPONIBLES": n}})
+                                   for libro_id, (_, n) in por_libro.items()], session=session)
+            for libro_doc, n in por_libro.values():
+                antes = libro_doc.get("DISPONIBLES") or 0
+                ajustar_libros_estanteria(antes, antes + n, session=session)
+        return encontrados, pendientes
+
+    try:
+        encontrados, pendientes = en_transaccion(devolver)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    for fecha in {p.get("fecha_inicio") for p in encontrados.values()}:
+        invalidar_reporte_mensual(fecha)
+    resultados = []
+    for i, pid in enumerate(ids):
+        if not isinstance(pid, str) or not pid:
+            resultados.append({"indice": i, "prestamo_id": pid, "success": False,
+                               "error": "Cada elemento debe ser el id de un préstamo"})
+            continue
+        resultado = {"indice": i, "prestamo_id": pid, "success": pid in encontrados}
+        if not resultado["success"]:
+            resultado["error"] = "Préstamo no encontrado"
+        elif pid in pendientes:
+            resultado["multa"] = {"monto": pendientes[pid].get("monto", 0),
+                                  "estado": "Pagada" if pagar_multas else "Pendiente"}
+        resultados.append(resultado)
+    return jsonify({
+        "success": True,
+        "devueltos": len(encontrados),
+        "multas_pendientes": 0 if pagar_multas else len(pendientes),
+        "multas_pagadas": len(pendientes) if pagar_multas else 0,
+        "resultados": resultados,
+        "libros_estanteria": contar_libros_estanteria()
+    })
+
 @app.route('/api/prestamos', methods=['GET'])
 def api_prestamos():
-    # Verificar y actualizar préstamos vencidos antes de listar
-    verificar_y_actualizar_prestamos_vencidos()
-    
+    # Sólo lectura: los cambios de estado los hace la tarea programada "vencimientos"
     items = []
     # Incluir préstamos activos y vencidos (no devueltos)
     for doc in prestamos.find({"estado": {"$ne": "Devuelto"}}, {"_id": 0}).sort("created_at", -1):
@@ -1823,25 +2931,15 @@ def api_prestamos():
 
 @app.route('/api/multas', methods=['GET'])
 def api_multas():
-    # Actualizar multas pendientes con días de retraso actuales
-    multas_pendientes = multas.find({"estado": "Pendiente"})
-    for multa in multas_pendientes:
-        prestamo_id = multa.get("prestamo_id", "")
-        fecha_dev = multa.get("fecha_devolucion", "")
-        if fecha_dev:
-            dias_retraso = calcular_dias_retraso(fecha_dev)
-            monto = calcular_multa(dias_retraso)
-            multas.update_one(
-                {"_id": multa["_id"]},
-                {"$set": {
-                    "dias_retraso": dias_retraso,
-                    "monto": monto,
-                    "updated_at": datetime.now(timezone.utc)
-                }}
-            )
-    
+    # Sólo lectura: los valores guardados los mantiene recalcular_multas(); aquí se
+    # muestran los días de retraso al día sin escribir en la base de datos
     items = []
     for doc in multas.find({"estado": "Pendiente"}, {"_id": 0}).sort("created_at", -1):
+        dias_retraso = doc.get("dias_retraso", 0)
+        monto = doc.get("monto", 0)
+        if doc.get("fecha_devolucion"):
+            dias_retraso = calcular_dias_retraso(doc["fecha_devolucion"])
+            monto = calcular_multa(dias_retraso)
         items.append({
             "prestamo_id": doc.get("prestamo_id", ""),
             "tipo": doc.get("tipo", ""),
@@ -1850,8 +2948,8 @@ def api_multas():
             "correo": doc.get("correo", ""),
             "libro": doc.get("libro", {}),
             "fecha_devolucion": doc.get("fecha_devolucion", ""),
-            "dias_retraso": doc.get("dias_retraso", 0),
-            "monto": doc.get("monto", 0),
+            "dias_retraso": dias_retraso,
+            "monto": monto,
             "estado": doc.get("estado", "Pendiente")
         })
     return jsonify({"multas": items})
@@ -1860,86 +2958,31 @@ def api_multas():
 def liberar_prestamo_vencido():
     """Libera un préstamo vencido (similar a eliminar pero para vencidos)"""
     datos = request.get_json() or {}
+    prestamo_id = datos.get('prestamo_id')
     isbn = datos.get('isbn') or (datos.get('libro') or {}).get('isbn') or ''
+    titulo = (datos.get('libro') or {}).get('titulo') or ''
     identificador = datos.get('id') or datos.get('boleta') or ''
     fecha_inicio = datos.get('fecha_inicio')
 
-    query = {"estado": "Vencido"}
-    if isbn:
-        query["libro.isbn"] = isbn
-    if identificador:
+    # sólo el préstamo indicado: por su id, o por libro y usuario juntos
+    query = filtro_prestamos_vencidos()
+    if prestamo_id:
+        query.update(filtro_por_id(prestamo_id))
+    elif identificador and (isbn or titulo):
         query["id"] = str(identificador)
-    if fecha_inicio:
-        query["fecha_inicio"] = fecha_inicio
-    
-    prestamo = prestamos.find_one(query)
-    if not prestamo:
-        return jsonify({"success": False, "error": "Préstamo vencido no encontrado"}), 404
-    
+        if isbn:
+            query["libro.isbn"] = isbn
+        else:
+            query["libro.titulo"] = titulo
+        if fecha_inicio:
+            query["fecha_inicio"] = fecha_inicio
+    else:
+        return jsonify({"success": False, "error": "Indica el préstamo (prestamo_id, o ISBN y usuario)"}), 400
+
     try:
-        # Eliminar préstamo
-        prestamos.delete_one({"_id": prestamo["_id"]})
-        
-        # Eliminar multa asociada si existe
-        tz_mexico = pytz.timezone('America/Mexico_City')
-        multas.update_one(
-            {"prestamo_id": str(prestamo["_id"]), "estado": "Pendiente"},
-            {"$set": {"estado": "Pagada", "fecha_pago": datetime.now(tz_mexico)}}
-        )
-        
-        # Eliminar de devoluciones si existe
-        devoluciones.delete_many({
-            "$or": [
-                {"prestamo_id": str(prestamo["_id"])},
-                {"libro.isbn": prestamo.get('libro', {}).get('isbn', '')},
-                {"id": prestamo.get('id', '')},
-                {"libro.isbn": isbn, "id": str(identificador)}
-            ]
-        })
-        
-        # Incrementar disponibles en inventario
-        isbn_buscar = isbn or prestamo.get('libro', {}).get('isbn', '')
-        titulo_buscar = prestamo.get('libro', {}).get('titulo', '')
-        
-        encontrado = None
-        if isbn_buscar:
-            isbn_clean = isbn_buscar.replace('-', '').replace(' ', '').strip()
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"ISBN": isbn_buscar}, {"Isbn": isbn_buscar}, {"isbn": isbn_buscar},
-                    {"ISBN": isbn_clean}, {"Isbn": isbn_clean}, {"isbn": isbn_clean}
-                ]
-            })
-        if not encontrado and titulo_buscar:
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"TÍTULO": titulo_buscar}, {"TITULO": titulo_buscar},
-                    {"Titulo": titulo_buscar}, {"titulo": titulo_buscar}
-                ]
-            })
-        if encontrado:
-            cur_val = None
-            for k in ("DISPONIBLES","Disponibles","disponible","DISPONIBLE","Disponible"):
-                if k in encontrado and encontrado.get(k) not in (None, ""):
-                    try:
-                        cur_val = int(encontrado.get(k))
-                        break
-                    except Exception:
-                        cur_val = None
-            if cur_val is None:
-                try:
-                    tmp = obtener_disponibles(encontrado)
-                    if isinstance(tmp, int):
-                        cur_val = tmp
-                    elif isinstance(tmp, str) and tmp.isdigit():
-                        cur_val = int(tmp)
-                except Exception:
-                    cur_val = None
-            if cur_val is None:
-                cur_val = 0
-            nuevo = cur_val + 1
-            inventario.update_one({"_id": encontrado["_id"]}, {"$set": {"DISPONIBLES": nuevo}})
-        
+        resultado = devolver_prestamo([query], pagar_multa=True)
+        if not resultado["prestamo"]:
+            return jsonify({"success": False, "error": "Préstamo vencido no encontrado"}), 404
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1956,290 +2999,330 @@ def liberar_multa():
     
     query = {}
     if multa_id:
-        try:
-            query = {"_id": ObjectId(multa_id)}
-        except Exception:
-            query = {"_id": multa_id}
+        query = filtro_por_id(multa_id)
     elif prestamo_id:
         query = {"prestamo_id": str(prestamo_id), "estado": "Pendiente"}
     
-    multa = multas.find_one(query)
+    multa = multas.find_one(query, {"prestamo_id": 1, "libro": 1, "id": 1})
     if not multa:
         return jsonify({"success": False, "error": "Multa no encontrada"}), 404
     
+    # préstamo asociado: por su _id y, en multas antiguas sin ObjectId válido,
+    # por libro y usuario entre los vencidos
+    filtros = []
+    prestamo_id_multa = multa.get("prestamo_id", "")
+    if prestamo_id_multa:
+        if ObjectId.is_valid(prestamo_id_multa):
+            filtros.append({"_id": ObjectId(prestamo_id_multa)})
+        else:
+            filtros.append({"libro.isbn": (multa.get("libro") or {}).get("isbn", ""),
+                            "id": multa.get("id", ""), "estado": "Vencido"})
+
     try:
-        # Marcar multa como pagada
-        tz_mexico = pytz.timezone('America/Mexico_City')
-        multas.update_one(
-            {"_id": multa["_id"]},
-            {"$set": {"estado": "Pagada", "fecha_pago": datetime.now(tz_mexico)}}
-        )
-        
-        # Eliminar préstamo asociado si existe
-        prestamo_id_obj = multa.get("prestamo_id", "")
-        prestamo_eliminado = False
-        if prestamo_id_obj:
-            try:
-                prestamo_obj_id = ObjectId(prestamo_id_obj)
-                result = prestamos.delete_one({"_id": prestamo_obj_id})
-                prestamo_eliminado = result.deleted_count > 0
-            except Exception:
-                # Intentar buscar por otros campos
-                result = prestamos.delete_one({
-                    "libro.isbn": multa.get("libro", {}).get("isbn", ""),
-                    "id": multa.get("id", ""),
-                    "estado": "Vencido"
-                })
-                prestamo_eliminado = result.deleted_count > 0
-        
-        # Eliminar de devoluciones si existe
-        if prestamo_eliminado or prestamo_id_obj:
-            devoluciones.delete_many({
-                "$or": [
-                    {"prestamo_id": str(prestamo_id_obj)},
-                    {"libro.isbn": multa.get("libro", {}).get("isbn", "")},
-                    {"id": multa.get("id", "")}
-                ]
-            })
-        
-        # Incrementar disponibles en inventario
-        isbn_buscar = multa.get('libro', {}).get('isbn', '')
-        titulo_buscar = multa.get('libro', {}).get('titulo', '')
-        
-        encontrado = None
-        if isbn_buscar:
-            isbn_clean = isbn_buscar.replace('-', '').replace(' ', '').strip()
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"ISBN": isbn_buscar}, {"Isbn": isbn_buscar}, {"isbn": isbn_buscar},
-                    {"ISBN": isbn_clean}, {"Isbn": isbn_clean}, {"isbn": isbn_clean}
-                ]
-            })
-        if not encontrado and titulo_buscar:
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"TÍTULO": titulo_buscar}, {"TITULO": titulo_buscar},
-                    {"Titulo": titulo_buscar}, {"titulo": titulo_buscar}
-                ]
-            })
-        if encontrado:
-            cur_val = None
-            for k in ("DISPONIBLES","Disponibles","disponible","DISPONIBLE","Disponible"):
-                if k in encontrado and encontrado.get(k) not in (None, ""):
-                    try:
-                        cur_val = int(encontrado.get(k))
-                        break
-                    except Exception:
-                        cur_val = None
-            if cur_val is None:
-                try:
-                    tmp = obtener_disponibles(encontrado)
-                    if isinstance(tmp, int):
-                        cur_val = tmp
-                    elif isinstance(tmp, str) and tmp.isdigit():
-                        cur_val = int(tmp)
-                except Exception:
-                    cur_val = None
-            if cur_val is None:
-                cur_val = 0
-            nuevo = cur_val + 1
-            inventario.update_one({"_id": encontrado["_id"]}, {"$set": {"DISPONIBLES": nuevo}})
-        
+        # si el préstamo ya se había devuelto sólo se marca la multa como pagada
+        devolver_prestamo(filtros, multa={"_id": multa["_id"]})
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/sitio', methods=['GET'])
 def api_sitio():
-    """Lista todos los registros de entrada al sitio"""
-    # Verificar y limpiar registros antiguos (más de 1 mes) antes de listar
-    limpiar_registros_antiguos()
-    
-    # Obtener fecha actual en zona horaria de México
-    tz_mexico = pytz.timezone('America/Mexico_City')
-    ahora = datetime.now(tz_mexico)
-    fecha_hoy = ahora.strftime('%Y-%m-%d')
-    
-    # Actualizar registros antiguos que no tengan los campos "eliminado" o "reiniciado"
-    sitio.update_many(
-        {"eliminado": {"$exists": False}},
-        {"$set": {"eliminado": False}}
-    )
-    sitio.update_many(
-        {"reiniciado": {"$exists": False}},
-        {"$set": {"reiniciado": False}}
-    )
-    
-    # Contar alumnos que ingresaron hoy (7am - 10pm) - incluye eliminados en el conteo
-    # Usar un enfoque simple: contar todos los alumnos del día y filtrar por hora
-    contador_dia = 0
-    
-    # Obtener todos los registros de alumnos del día
-    # El contador cuenta TODOS los registros (incluyendo eliminados individualmente)
-    # Solo se excluyen los que fueron reiniciados (tienen reiniciado: True)
-    registros_hoy = list(sitio.find({
-        "tipo": "alumno",
-        "fecha": fecha_hoy,
-        "reiniciado": {"$ne": True}  # No contar los que fueron reiniciados
-    }))
-    
-    for doc in registros_hoy:
-        fecha_completa = doc.get("fecha_completa")
-        hora_entrada_str = doc.get("hora_entrada", "")
-        
-        # Verificar si está en el rango 7am-10pm
-        en_rango = False
-        
-        # Intentar usar fecha_completa primero
-        if fecha_completa and isinstance(fecha_completa, datetime):
-            try:
-                # Normalizar timezone
-                if fecha_completa.tzinfo is None:
-                    fecha_completa = tz_mexico.localize(fecha_completa)
-                else:
-                    fecha_completa = fecha_completa.astimezone(tz_mexico)
-                
-                # Verificar rango 7am-10pm
-                hora_registro = fecha_completa.hour
-                if 7 <= hora_registro <= 22:
-                    en_rango = True
-            except Exception as e:
-                # Si falla, intentar con hora_entrada
-                pass
-        
-        # Si no se pudo con fecha_completa, usar hora_entrada string
-        if not en_rango and hora_entrada_str:
-            try:
-                partes_hora = hora_entrada_str.split(':')
-                if partes_hora:
-                    hora_int = int(partes_hora[0])
-                    if 7 <= hora_int <= 22:
-                        en_rango = True
-            except:
-                pass
-        
-        # Si no hay información de hora, contar igual (por seguridad, mejor contar de más)
-        if not en_rango:
-            # Si no tenemos información de hora, contar igual
-            en_rango = True
-        
-        if en_rango:
-            contador_dia += 1
+    """Lista todos los registros de entrada al sitio (sólo lectura)"""
+    # La retención la hace la tarea programada limpieza_sitio y los campos
+    # eliminado/reiniciado de registros antiguos los completa migrar_sitio.py
+    # El cursor permite seguir después con /api/sitio/cambios o /api/sitio/eventos
+    cursor = datetime.now(timezone.utc)
     
     items = []
     # Obtener registros NO eliminados y NO reiniciados, ordenados por fecha más reciente
-    # No usar proyección para obtener todos los campos
     for doc in sitio.find({
         "eliminado": {"$ne": True},
         "reiniciado": {"$ne": True},
         "tipo": {"$ne": "resumen_reinicio"}  # No mostrar los resúmenes de reinicio
-    }).sort("fecha_completa", -1).limit(500):
-        tipo = doc.get("tipo", "")
-        nombre = doc.get("nombre", "")
-        fecha = doc.get("fecha", "")
-        hora_entrada = doc.get("hora_entrada", "")
-        turno = doc.get("turno", "")
-        observaciones = doc.get("observaciones", [])
-        registro_id = str(doc.get("_id", ""))
-        
-        # Obtener identificador según tipo
-        identificador = ""
-        grupo = ""
-        if tipo == "alumno":
-            identificador = doc.get("boleta", "")
-            grupo = doc.get("grupo", "")
-        else:
-            identificador = doc.get("no_empleado", "")
-            grupo = doc.get("ocupacion", "")
-        
-        items.append({
-            "_id": registro_id,
-            "tipo": tipo,
-            "nombre": nombre,
-            "identificador": identificador,
-            "grupo": grupo,
-            "turno": turno,
-            "fecha": fecha,
-            "hora_entrada": hora_entrada,
-            "observaciones": observaciones
-        })
+    }, PROYECCION_SITIO).sort("fecha_completa", -1).limit(500):
+        items.append(fila_sitio(doc))
     
     return jsonify({
         "registros": items,
-        "contador_dia": contador_dia
+        "contador_dia": contador_dia_sitio(),
+        "cursor": _cursor_sitio(cursor)
     })
 
-def limpiar_registros_antiguos():
-    """Elimina registros de la colección Sitio que tengan más de 1 mes.
-    El día 30 de cada mes, guarda un resumen diario y limpia los registros."""
+def fila_sitio(doc):
+    """Fila de la tabla de Sitio a partir de un documento de la colección"""
+    tipo = doc.get("tipo", "")
+    # Obtener identificador según tipo
+    if tipo == "alumno":
+        identificador, grupo = doc.get("boleta", ""), doc.get("grupo", "")
+    else:
+        identificador, grupo = doc.get("no_empleado", ""), doc.get("ocupacion", "")
+    return {
+        "_id": str(doc.get("_id", "")),
+        "tipo": tipo,
+        "nombre": doc.get("nombre", ""),
+        "identificador": identificador,
+        "grupo": grupo,
+        "turno": doc.get("turno", ""),
+        "fecha": doc.get("fecha", ""),
+        "hora_entrada": doc.get("hora_entrada", ""),
+        "observaciones": doc.get("observaciones", [])
+    }
+
+def contador_dia_sitio():
+    """Alumnos que ingresaron hoy desde el último reinicio (incluye los eliminados
+    de la tabla): una lectura del contador diario (ver contar_entrada_sitio)"""
+    fecha_hoy = datetime.now(pytz.timezone('America/Mexico_City')).strftime('%Y-%m-%d')
+    return (contador_sitio_dia(fecha_hoy).get("en_contador") or {}).get("alumno", 0)
+
+# --- Cambios de Sitio (feed, long-poll y SSE) ---
+# Toda escritura sobre una fila de Sitio pone actualizado_at (indexado). Las
+# terminales cargan /api/sitio una vez y después piden sólo lo que cambió desde
+# su cursor: filas nuevas o editadas en "cambios" y las que salen de la tabla
+# (eliminadas, reiniciadas o archivadas) en "eliminados". La consulta repite un
+# margen de SITIO_CAMBIOS_SOLAPE segundos porque los relojes de los procesos no
+# están perfectamente alineados; el cliente aplica los cambios por _id, así que
+# repetir una fila no tiene efecto. Una fila que llega tarde dentro del margen
+# (escrita por un proceso con el reloj atrasado) no mueve el cursor: quien espera
+# cambios recuerda qué filas del margen ya entregó para notar las nuevas. Si el servidor es un replica set, un change
+# stream despierta a los clientes en espera en cuanto hay cambios; si no, se
+# revisa cada SITIO_EVENTOS_INTERVALO segundos.
+SITIO_CAMBIOS_SOLAPE = 2
+SITIO_CAMBIOS_LIMITE = 500
+SITIO_EVENTOS_INTERVALO = float(os.getenv('SITIO_EVENTOS_INTERVALO', '2'))
+# con workers síncronos de gunicorn una conexión larga ocupa un worker: el flujo
+# SSE se cierra antes del timeout y EventSource se reconecta con Last-Event-ID
+SITIO_EVENTOS_DURACION = int(os.getenv('SITIO_EVENTOS_DURACION', '25'))
+TIPOS_OCULTOS_SITIO = ("resumen_reinicio", "resumen_mensual")
+
+_cambios_sitio = threading.Condition()
+_version_cambios_sitio = [0]
+_flujo_cambios_sitio = {"hilo": None, "activo": False}
+
+def avisar_cambio_sitio():
+    """Despierta a los clientes de este proceso que esperan cambios"""
+    with _cambios_sitio:
+        _version_cambios_sitio[0] += 1
+        _cambios_sitio.notify_all()
+
+def _vigilar_cambios_sitio():
+    """Hilo de fondo: convierte el change stream de Sitio en avisos locales"""
+    while True:
+        try:
+            with sitio.watch([{"$project": {"_id": 1}}]) as flujo:
+                _flujo_cambios_sitio["activo"] = True
+                for _ in flujo:
+                    avisar_cambio_sitio()
+        except (NotImplementedError, OperationFailure) as e:
+            # 40573: los change streams sólo existen en replica sets
+            print(f"[SITIO] Change streams no disponibles ({e}); se revisa cada {SITIO_EVENTOS_INTERVALO} s")
+            _flujo_cambios_sitio["activo"] = False
+            return
+        except Exception as e:
+            _flujo_cambios_sitio["activo"] = False
+            print(f"[SITIO] Change stream interrumpido: {e}")
+            time.sleep(5)
+
+def _iniciar_vigilancia_sitio():
+    with _cambios_sitio:
+        if _flujo_cambios_sitio["hilo"] is None:
+            _flujo_cambios_sitio["hilo"] = threading.Thread(target=_vigilar_cambios_sitio, daemon=True)
+            _flujo_cambios_sitio["hilo"].start()
+
+def _cursor_sitio(valor):
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def _leer_cursor_sitio(texto):
+    """Cursor ISO 8601 o el ObjectId de la última fila vista; None si no es válido"""
+    if not texto:
+        return None
+    if ObjectId.is_valid(texto):
+        return ObjectId(texto).generation_time
     try:
-        tz_mexico = pytz.timezone('America/Mexico_City')
-        ahora = datetime.now(tz_mexico)
-        
-        # Si es día 30, guardar resumen mensual y limpiar
-        if ahora.day == 30:
-            print(f"[SITIO] Día 30 detectado. Guardando resumen mensual y limpiando registros...")
-            
-            # Calcular rango del mes actual
-            inicio_mes = ahora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            fin_mes = ahora.replace(day=30, hour=23, minute=59, second=59, microsecond=999999)
-            
-            # Obtener todos los registros del mes (incluyendo eliminados para el conteo)
-            registros_mes = list(sitio.find({
-                "fecha_completa": {"$gte": inicio_mes, "$lte": fin_mes}
-            }))
-            
-            # Agrupar por día y contar alumnos (7am-10pm)
-            resumen_por_dia = {}
-            for reg in registros_mes:
-                fecha_reg = reg.get("fecha", "")
-                tipo_reg = reg.get("tipo", "")
-                hora_entrada = reg.get("hora_entrada", "")
-                fecha_completa = reg.get("fecha_completa")
-                
-                if not fecha_reg or tipo_reg != "alumno":
-                    continue
-                
-                # Verificar si está en el rango 7am-10pm
-                if fecha_completa:
-                    hora = fecha_completa.hour
-                    if 7 <= hora <= 22:  # 7am a 10pm
-                        if fecha_reg not in resumen_por_dia:
-                            resumen_por_dia[fecha_reg] = 0
-                        resumen_por_dia[fecha_reg] += 1
-            
-            # Guardar resumen en la colección (crear documento de resumen)
-            if resumen_por_dia:
-                resumen_doc = {
-                    "tipo": "resumen_mensual",
-                    "mes": ahora.month,
-                    "año": ahora.year,
-                    "fecha_creacion": ahora,
-                    "resumen_por_dia": resumen_por_dia,
-                    "total_dias": len(resumen_por_dia),
-                    "total_alumnos": sum(resumen_por_dia.values())
-                }
-                sitio.insert_one(resumen_doc)
-                print(f"[SITIO] Resumen mensual guardado: {len(resumen_por_dia)} días, {sum(resumen_por_dia.values())} alumnos totales")
-            
-            # Eliminar todos los registros del mes (ya tenemos el resumen)
-            resultado = sitio.delete_many({
-                "fecha_completa": {"$gte": inicio_mes, "$lte": fin_mes},
-                "tipo": {"$ne": "resumen_mensual"}  # No eliminar los resúmenes
-            })
-            if resultado.deleted_count > 0:
-                print(f"[SITIO] Eliminados {resultado.deleted_count} registros del mes (resumen guardado)")
+        valor = datetime.fromisoformat(texto.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+def cambios_sitio(desde, vistos=None):
+    """Filas de Sitio modificadas desde el cursor desde (datetime con zona).
+    vistos: conjunto de (_id, actualizado_at) ya entregados; se actualiza con las
+    filas devueltas y una fila del margen de solape que no estaba en él también
+    cuenta como cambio."""
+    proyeccion = dict(PROYECCION_SITIO, eliminado=1, reiniciado=1, expira_at=1, actualizado_at=1)
+    docs = list(sitio.find({"actualizado_at": {"$gte": desde - timedelta(seconds=SITIO_CAMBIOS_SOLAPE)}},
+                           proyeccion).sort("actualizado_at", 1).limit(SITIO_CAMBIOS_LIMITE))
+    cambios, eliminados = [], []
+    ultimo = desde
+    nuevas_en_margen = False
+    for doc in docs:
+        fecha = doc["actualizado_at"].replace(tzinfo=timezone.utc)
+        ultimo = max(ultimo, fecha)
+        if doc.get("tipo") in TIPOS_OCULTOS_SITIO:
+            continue
+        if vistos is not None and (doc["_id"], fecha) not in vistos:
+            vistos.add((doc["_id"], fecha))
+            nuevas_en_margen = nuevas_en_margen or fecha <= desde
+        if doc.get("eliminado") or doc.get("reiniciado") or doc.get("expira_at"):
+            eliminados.append(str(doc["_id"]))
         else:
-            # Limpieza normal: eliminar registros de más de 1 mes
-            fecha_limite = ahora - timedelta(days=30)
-            resultado = sitio.delete_many({
-                "fecha_completa": {"$lt": fecha_limite},
-                "tipo": {"$ne": "resumen_mensual"}  # No eliminar los resúmenes
-            })
-            if resultado.deleted_count > 0:
-                print(f"[SITIO] Eliminados {resultado.deleted_count} registros antiguos (más de 1 mes)")
+            cambios.append(fila_sitio(doc))
+    # un reinicio puede tocar más filas que el límite: mejor recargar la tabla
+    recargar = len(docs) >= SITIO_CAMBIOS_LIMITE
+    if vistos is not None:
+        margen = ultimo - timedelta(seconds=SITIO_CAMBIOS_SOLAPE)
+        vistos.difference_update([clave for clave in vistos if clave[1] < margen])
+    return {
+        "cambios": cambios,
+        "eliminados": eliminados,
+        "recargar": recargar,
+        # False si sólo se repitió el margen de solape ya entregado
+        "hay_cambios": recargar or ultimo > desde or nuevas_en_margen,
+        "cursor": _cursor_sitio(ultimo),
+        "contador_dia": contador_dia_sitio()
+    }
+
+def esperar_cambios_sitio(desde, segundos, vistos=None):
+    """Devuelve los cambios en cuanto los haya, o vacíos al cumplirse el plazo.
+    Sin vistos (long-poll) se supone que el cliente ya tiene las filas del margen
+    que existen al empezar la espera."""
+    _iniciar_vigilancia_sitio()
+    if vistos is None:
+        vistos = set()
+        cambios_sitio(desde, vistos)
+    limite = time.monotonic() + segundos
+    while True:
+        with _cambios_sitio:
+            version = _version_cambios_sitio[0]
+        resultado = cambios_sitio(desde, vistos)
+        restante = limite - time.monotonic()
+        if resultado["hay_cambios"] or restante <= 0:
+            return resultado
+        espera = restante if _flujo_cambios_sitio["activo"] else min(restante, SITIO_EVENTOS_INTERVALO)
+        with _cambios_sitio:
+            _cambios_sitio.wait_for(lambda: _version_cambios_sitio[0] != version, timeout=espera)
+
+@app.route('/api/sitio/cambios', methods=['GET'])
+def api_sitio_cambios():
+    """Cambios desde ?desde=<cursor> (el de /api/sitio o de la respuesta anterior).
+    Con ?esperar=N (máx. 25) la respuesta espera hasta N segundos a que haya cambios."""
+    desde = _leer_cursor_sitio(request.args.get('desde', ''))
+    if desde is None:
+        return jsonify({"success": False, "error": "Cursor 'desde' inválido"}), 400
+    esperar = max(0, min(request.args.get('esperar', 0, type=int), 25))
+    if esperar:
+        return jsonify(esperar_cambios_sitio(desde, esperar))
+    return jsonify(cambios_sitio(desde))
+
+@app.route('/api/sitio/eventos', methods=['GET'])
+def api_sitio_eventos():
+    """Server-Sent Events con los cambios de Sitio (evento "cambios", id = cursor)"""
+    desde = _leer_cursor_sitio(request.headers.get('Last-Event-ID') or request.args.get('desde', ''))
+    if desde is None:
+        return jsonify({"success": False, "error": "Cursor 'desde' inválido"}), 400
+
+    def generar(desde):
+        yield "retry: 3000\n\n"
+        # al conectar se envía el margen de solape completo: puede traer filas que
+        # llegaron tarde antes de la reconexión; el cliente descarta las repetidas
+        vistos = set()
+        fin = time.monotonic() + SITIO_EVENTOS_DURACION
+        while time.monotonic() < fin:
+            resultado = esperar_cambios_sitio(desde, max(0, fin - time.monotonic()), vistos)
+            desde = _leer_cursor_sitio(resultado["cursor"])
+            if resultado["hay_cambios"]:
+                yield f"id: {resultado['cursor']}\nevent: cambios\ndata: {json.dumps(resultado, default=str)}\n\n"
+            else:
+                yield ": sin cambios\n\n"
+
+    return Response(stream_with_context(generar(desde)), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Retención de Sitio ---
+# Las entradas con más de SITIO_RETENCION_DIAS días se archivan una vez por día
+# de registro: el contador de SitioDiario de ese día queda cerrado (es el
+# agregado por día y hora que se conserva para las estadísticas), las filas se
+# escriben a DIRECTORIO_ARCHIVO_SITIO/AAAA/AAAA-MM-DD[-n].jsonl.gz y se marcan
+# con expira_at. El índice TTL sobre expira_at las borra; una fila sin archivar
+# nunca caduca.
+def _escribir_archivo_sitio(fecha_str, docs):
+    """Escribe las filas de un día a un archivo JSONL comprimido nuevo y devuelve su ruta.
+    Si el día ya tiene archivo (ejecución anterior) se crea una parte -2, -3, ..."""
+    directorio = os.path.join(DIRECTORIO_ARCHIVO_SITIO, fecha_str[:4])
+    os.makedirs(directorio, exist_ok=True)
+    ruta, parte = os.path.join(directorio, f"{fecha_str}.jsonl.gz"), 1
+    while os.path.exists(ruta):
+        parte += 1
+        ruta = os.path.join(directorio, f"{fecha_str}-{parte}.jsonl.gz")
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with gzip.open(temporal, 'wt', encoding='utf-8') as f:
+        for doc in docs:
+            f.write(json_util.dumps(doc, ensure_ascii=False) + "\n")
+    os.replace(temporal, ruta)
+    return ruta
+
+def _archivar_dia_sitio(fecha_str, docs):
+    """Cierra el agregado del día, archiva sus filas y las deja listas para el TTL"""
+    if fecha_str and not sitio_diario.find_one({"_id": fecha_str}, {"_id": 1}):
+        reconstruir_sitio_diario(fecha_str)  # día anterior al contador (y sin migrar)
+    ruta = _escribir_archivo_sitio(fecha_str or "sin_fecha", docs)
+    if fecha_str:
+        sitio_diario.update_one({"_id": fecha_str}, {"$set": {"cerrado": True}, "$addToSet": {"archivos": ruta}})
+    ahora = datetime.now(timezone.utc)
+    ids = [d["_id"] for d in docs]
+    for i in range(0, len(ids), 1000):
+        sitio.update_many({"_id": {"$in": ids[i:i + 1000]}}, {"$set": {"expira_at": ahora, "actualizado_at": ahora}})
+    avisar_cambio_sitio()
+    return ruta
+
+def limpiar_registros_antiguos():
+    """Tarea limpieza_sitio: archiva, día por día, las entradas de Sitio con más
+    de SITIO_RETENCION_DIAS días y devuelve cuántas filas archivó. Los errores
+    llegan a ejecutar_tarea, que los guarda en ultimo_error; los días ya
+    archivados no se repiten en la siguiente ejecución."""
+    fecha_limite = datetime.now(timezone.utc) - timedelta(days=SITIO_RETENCION_DIAS)
+    filtro = {"fecha_completa": {"$lt": fecha_limite}, "expira_at": {"$exists": False},
+              "tipo": {"$ne": "resumen_mensual"}}
+    archivados, dia, docs = 0, None, []
+    try:
+        for doc in sitio.find(filtro).sort("fecha_completa", 1):
+            fecha_str = doc.get("fecha") or a_hora_mexico(doc["fecha_completa"]).strftime('%Y-%m-%d')
+            if docs and fecha_str != dia:
+                _archivar_dia_sitio(dia, docs)
+                archivados += len(docs)
+                docs = []
+            dia = fecha_str
+            docs.append(doc)
+        if docs:
+            _archivar_dia_sitio(dia, docs)
+            archivados += len(docs)
     except Exception as e:
-        print(f"[SITIO] Error limpiando registros antiguos: {e}")
+        print(f"[SITIO] Error archivando registros antiguos ({archivados} ya archivados): {e}")
+        raise
+    if archivados:
+        print(f"[SITIO] Archivados {archivados} registros de más de {SITIO_RETENCION_DIAS} días en {DIRECTORIO_ARCHIVO_SITIO}")
+    return archivados
+
+def migrar_sitio(aplicar=False):
+    """Migración única de Sitio: completa eliminado/reiniciado en los registros
+    antiguos y reconstruye SitioDiario de cada día con entradas.
+    Con aplicar=False sólo cuenta lo que se haría."""
+    reporte = {
+        "sin_eliminado": sitio.count_documents({"eliminado": {"$exists": False}}),
+        "sin_reiniciado": sitio.count_documents({"reiniciado": {"$exists": False}}),
+        "dias": sorted(f for f in sitio.distinct("fecha", {"tipo": {"$in": list(TIPOS_ENTRADA_SITIO)},
+                                                          "expira_at": {"$exists": False}}) if f),
+    }
+    # los días ya archivados conservan su agregado: sus filas ya no están completas
+    cerrados = set(sitio_diario.distinct("_id", {"cerrado": True}))
+    reporte["dias"] = [f for f in reporte["dias"] if f not in cerrados]
+    if aplicar:
+        sitio.update_many({"eliminado": {"$exists": False}}, {"$set": {"eliminado": False}})
+        sitio.update_many({"reiniciado": {"$exists": False}}, {"$set": {"reiniciado": False}})
+        for fecha_str in reporte["dias"]:
+            reconstruir_sitio_diario(fecha_str)
+    return reporte
 
 @app.route('/api/sitio/eliminar', methods=['POST'])
 def eliminar_registro_sitio():
@@ -2260,8 +3343,9 @@ def eliminar_registro_sitio():
         
         resultado = sitio.update_one(
             {"_id": obj_id},
-            {"$set": {"eliminado": True}}
+            {"$set": {"eliminado": True, "actualizado_at": datetime.now(timezone.utc)}}
         )
+        avisar_cambio_sitio()
         
         if resultado.modified_count > 0:
             return jsonify({"success": True, "message": "Registro eliminado de la tabla"})
@@ -2280,50 +3364,14 @@ def reiniciar_contador_sitio():
         ahora = datetime.now(tz_mexico)
         fecha_hoy = ahora.strftime('%Y-%m-%d')
         
-        # PRIMERO: Contar el total actual de alumnos del día (antes de reiniciar)
-        # Contar todos los alumnos del día que NO fueron reiniciados previamente
-        total_antes_reinicio = 0
-        registros_antes = list(sitio.find({
-            "tipo": "alumno",
-            "fecha": fecha_hoy,
-            "reiniciado": {"$ne": True}
-        }))
-        
-        for doc in registros_antes:
-            fecha_completa = doc.get("fecha_completa")
-            hora_entrada_str = doc.get("hora_entrada", "")
-            
-            # Verificar si está en el rango 7am-10pm
-            en_rango = False
-            
-            if fecha_completa and isinstance(fecha_completa, datetime):
-                try:
-                    if fecha_completa.tzinfo is None:
-                        fecha_completa = tz_mexico.localize(fecha_completa)
-                    else:
-                        fecha_completa = fecha_completa.astimezone(tz_mexico)
-                    
-                    hora_registro = fecha_completa.hour
-                    if 7 <= hora_registro <= 22:
-                        en_rango = True
-                except:
-                    pass
-            
-            if not en_rango and hora_entrada_str:
-                try:
-                    partes_hora = hora_entrada_str.split(':')
-                    if partes_hora:
-                        hora_int = int(partes_hora[0])
-                        if 7 <= hora_int <= 22:
-                            en_rango = True
-                except:
-                    pass
-            
-            if not en_rango:
-                en_rango = True  # Por seguridad
-            
-            if en_rango:
-                total_antes_reinicio += 1
+        # PRIMERO: Tomar el total actual y dejar el contador del día en 0 en una
+        # sola operación (una entrada simultánea cuenta en uno u otro, no se pierde)
+        antes = sitio_diario.find_one_and_update(
+            {"_id": fecha_hoy},
+            {"$set": {f"en_contador.{t}": 0 for t in TIPOS_ENTRADA_SITIO}},
+            upsert=True, return_document=ReturnDocument.BEFORE
+        )
+        total_antes_reinicio = ((antes or {}).get("en_contador") or {}).get("alumno", 0)
         
         # SEGUNDO: Guardar el total en la base de datos
         registro_reinicio = {
@@ -2343,8 +3391,9 @@ def reiniciar_contador_sitio():
                 "tipo": {"$in": ["alumno", "docente"]},
                 "reiniciado": {"$ne": True}  # Solo los que no fueron reiniciados
             },
-            {"$set": {"reiniciado": True}}
+            {"$set": {"reiniciado": True, "actualizado_at": ahora}}
         )
+        avisar_cambio_sitio()
         
         return jsonify({
             "success": True,
@@ -2366,68 +3415,30 @@ def ajedrez_buscar_usuario():
         return jsonify({"encontrado": False, "error": "ID requerido"}), 400
     
     if tipo == 'alumno':
-        # Buscar alumno
-        query = {
-            "$or": [
-                {"Boleta": id_buscar},
-                {"boleta": id_buscar}
-            ]
-        }
-        if id_buscar.isdigit():
-            try:
-                query["$or"].append({"Boleta": int(id_buscar)})
-                query["$or"].append({"boleta": int(id_buscar)})
-            except Exception:
-                pass
-        
-        doc = alumnos.find_one(query, {"_id": 0})
-        if not doc:
+        alumno = resolver_identidad('alumno', id_buscar)
+        if not alumno:
             return jsonify({"encontrado": False})
-        
-        def pick(doc, keys):
-            for k in keys:
-                if k in doc and doc[k] not in (None, ''):
-                    return doc[k]
-            return ''
-        
         return jsonify({
             "encontrado": True,
             "tipo": "alumno",
-            "nombre": pick(doc, ["Nombre","nombre","Nombre Del Alumno:\n(Completo)"]),
-            "id": pick(doc, ["Boleta","boleta"]),
-            "grupo": pick(doc, ["Grupo","grupo"]),
-            "carga": pick(doc, ["Carga","carga","Tipo de Carga(Horario)\n(MEDIA, MINIMA o COMPLETA)"]),
-            "correo": pick(doc, ["Correo","correo","Email","email"])
+            "nombre": alumno["Nombre"],
+            "id": alumno["Boleta"],
+            "grupo": alumno["Grupo"],
+            "carga": alumno["Carga"],
+            "correo": alumno["Correo"]
         })
     else:
-        # Buscar docente
-        query = {
-            "$or": [
-                {"No Empleado": id_buscar},
-                {"NoEmpleado": id_buscar},
-                {"no_empleado": id_buscar},
-                {"noEmpleado": id_buscar}
-            ]
-        }
-        if id_buscar.isdigit():
-            try:
-                query["$or"].append({"No Empleado": int(id_buscar)})
-                query["$or"].append({"NoEmpleado": int(id_buscar)})
-            except Exception:
-                pass
-        
-        doc = db["Docentes"].find_one(query, {"_id": 0})
-        if not doc:
+        docente = resolver_identidad('docente', id_buscar)
+        if not docente:
             return jsonify({"encontrado": False})
-        
         return jsonify({
             "encontrado": True,
             "tipo": "docente",
-            "nombre": doc.get("Nombre Completo", "") or doc.get("Nombre", "") or doc.get("nombre", ""),
-            "id": doc.get("No Empleado", "") or doc.get("NoEmpleado", "") or doc.get("no_empleado", "") or doc.get("noEmpleado", ""),
-            "grupo": doc.get("Ocupación \n(Docente u otro)", "") or doc.get("Ocupacion", "") or doc.get("ocupacion", "") or doc.get("Cargo", "") or doc.get("cargo", ""),
-            "carga": doc.get("Turno", "") or doc.get("turno", ""),
-            "correo": doc.get("Correo", "") or doc.get("correo", "")
+            "nombre": docente["Nombre"],
+            "id": docente["NoEmpleado"],
+            "grupo": docente["Ocupacion"],
+            "carga": docente["Turno"],
+            "correo": docente["Correo"]
         })
 
 @app.route('/api/ajedrez/iniciar', methods=['POST'])
@@ -2444,20 +3455,25 @@ def ajedrez_iniciar():
     if not nombre or not id_usuario:
         return jsonify({"success": False, "error": "Nombre e ID requeridos"}), 400
     
+    tz_mexico = pytz.timezone('America/Mexico_City')
+    ahora = datetime.now(tz_mexico)
+    
+    # Un contador vencido que el barrido aún no marca no cuenta como activo
+    finalizar_contadores_ajedrez({"id": str(id_usuario)}, ahora)
+    
     # Verificar si ya tiene un contador activo
     contador_activo = ajedrez.find_one({
         "id": str(id_usuario),
         "estado": "activo"
-    })
+    }, {"_id": 1})
     
     if contador_activo:
         return jsonify({"success": False, "error": "El usuario ya tiene un contador activo"}), 400
     
-    # Crear registro con contador de 40 minutos (2400 segundos)
-    tz_mexico = pytz.timezone('America/Mexico_City')
-    ahora = datetime.now(tz_mexico)
+    # Crear registro con contador de 40 minutos (2400 segundos); el tiempo
+    # restante se calcula siempre desde tiempo_fin (ver fila_ajedrez)
     tiempo_inicio = ahora
-    tiempo_fin = ahora + timedelta(minutes=40)
+    tiempo_fin = ahora + timedelta(minutes=AJEDREZ_MINUTOS)
     
     registro = {
         "tipo": tipo,
@@ -2468,16 +3484,16 @@ def ajedrez_iniciar():
         "correo": correo,
         "tiempo_inicio": tiempo_inicio,
         "tiempo_fin": tiempo_fin,
-        "tiempo_restante_segundos": 2400,  # 40 minutos en segundos
         "estado": "activo",
         "created_at": ahora
     }
     
     try:
         ajedrez.insert_one(registro)
+        avisar_cambio_ajedrez()
         return jsonify({
             "success": True,
-            "tiempo_restante_segundos": 2400,
+            "tiempo_restante_segundos": AJEDREZ_MINUTOS * 60,
             "tiempo_fin": tiempo_fin.isoformat()
         })
     except Exception as e:
@@ -2485,68 +3501,141 @@ def ajedrez_iniciar():
 
 @app.route('/api/ajedrez', methods=['GET'])
 def api_ajedrez():
-    """Lista todos los contadores activos de ajedrez"""
-    items = []
-    ahora = datetime.now(timezone.utc)
+    """Lista todos los contadores activos de ajedrez (sólo lectura)"""
+    return jsonify({"contadores": list(contadores_ajedrez_activos().values())})
+
+def _fecha_utc(valor):
+    """datetime (naive = UTC) o texto ISO como datetime en UTC; None si no se puede leer"""
+    if isinstance(valor, str):
+        try:
+            valor = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(valor, datetime):
+        return None
+    return valor.replace(tzinfo=timezone.utc) if valor.tzinfo is None else valor.astimezone(timezone.utc)
+
+def fila_ajedrez(doc, ahora):
+    """Fila de un contador con el tiempo restante calculado desde tiempo_fin"""
+    tiempo_fin = _fecha_utc(doc.get("tiempo_fin"))
+    estado = doc.get("estado", "activo")
+    if tiempo_fin:
+        segundos_restantes = max(0, int((tiempo_fin - ahora).total_seconds()))
+        # vencido aunque el barrido todavía no lo haya marcado
+        if estado == "activo" and tiempo_fin <= ahora:
+            estado = "finalizado"
+    else:
+        segundos_restantes = doc.get("tiempo_restante_segundos", 0)
     
-    for doc in ajedrez.find({"estado": "activo"}, {"_id": 0}).sort("tiempo_inicio", -1):
-        tiempo_fin = doc.get("tiempo_fin")
-        
-        # Convertir tiempo_fin a datetime con timezone si es necesario
-        if tiempo_fin:
-            if isinstance(tiempo_fin, str):
-                try:
-                    tiempo_fin = datetime.fromisoformat(tiempo_fin.replace('Z', '+00:00'))
-                except Exception:
-                    tiempo_fin = None
-            elif isinstance(tiempo_fin, datetime):
-                # Si es datetime pero sin timezone, agregar UTC
-                if tiempo_fin.tzinfo is None:
-                    tiempo_fin = tiempo_fin.replace(tzinfo=timezone.utc)
-        
-        if tiempo_fin:
-            # Calcular tiempo restante
-            diferencia = tiempo_fin - ahora
-            segundos_restantes = max(0, int(diferencia.total_seconds()))
-            
-            # Actualizar en la base de datos
-            ajedrez.update_one(
-                {"id": doc.get("id"), "estado": "activo"},
-                {"$set": {"tiempo_restante_segundos": segundos_restantes}}
-            )
-            
-            # Si llegó a 0, marcar como finalizado
-            if segundos_restantes == 0:
-                ajedrez.update_one(
-                    {"id": doc.get("id"), "estado": "activo"},
-                    {"$set": {"estado": "finalizado", "fecha_finalizacion": ahora}}
-                )
-                estado = "finalizado"
-            else:
-                estado = "activo"
-        else:
-            segundos_restantes = doc.get("tiempo_restante_segundos", 0)
-            estado = doc.get("estado", "activo")
-        
-        # Formatear tiempo
-        minutos = segundos_restantes // 60
-        segundos = segundos_restantes % 60
-        tiempo_formato = f"{minutos:02d}:{segundos:02d}"
-        
-        items.append({
-            "tipo": doc.get("tipo", ""),
-            "nombre": doc.get("nombre", ""),
-            "id": doc.get("id", ""),
-            "grupo": doc.get("grupo", ""),
-            "carga": doc.get("carga", ""),
-            "correo": doc.get("correo", ""),
-            "tiempo_restante_segundos": segundos_restantes,
-            "tiempo_formato": tiempo_formato,
-            "estado": estado,
-            "tiempo_inicio": doc.get("tiempo_inicio", "").isoformat() if isinstance(doc.get("tiempo_inicio"), datetime) else str(doc.get("tiempo_inicio", ""))
-        })
+    # Formatear tiempo
+    minutos = segundos_restantes // 60
+    segundos = segundos_restantes % 60
     
-    return jsonify({"contadores": items})
+    return {
+        "tipo": doc.get("tipo", ""),
+        "nombre": doc.get("nombre", ""),
+        "id": doc.get("id", ""),
+        "grupo": doc.get("grupo", ""),
+        "carga": doc.get("carga", ""),
+        "correo": doc.get("correo", ""),
+        "tiempo_restante_segundos": segundos_restantes,
+        "tiempo_formato": f"{minutos:02d}:{segundos:02d}",
+        "estado": estado,
+        "tiempo_fin": tiempo_fin.isoformat() if tiempo_fin else None,
+        "tiempo_inicio": doc.get("tiempo_inicio", "").isoformat() if isinstance(doc.get("tiempo_inicio"), datetime) else str(doc.get("tiempo_inicio", ""))
+    }
+
+def contadores_ajedrez_activos():
+    """{id: fila} de los contadores con estado activo, en el orden de /api/ajedrez"""
+    ahora = datetime.now(timezone.utc)
+    return {doc.get("id", ""): fila_ajedrez(doc, ahora)
+            for doc in ajedrez.find({"estado": "activo"}, {"_id": 0}).sort("tiempo_inicio", -1)}
+
+# --- Barrido y eventos de ajedrez ---
+# Leer los contadores no escribe nada: el tiempo restante sale de tiempo_fin.
+# El barrido (tarea programada "ajedrez") marca como finalizados los vencidos
+# con un solo update_many sobre un índice parcial de los activos. Las pantallas
+# abiertas reciben los cambios por /api/ajedrez/eventos (SSE): inicio,
+# reinicio, fin de tiempo, terminado y eliminado, cada uno con la lista
+# completa de contadores (son pocos).
+AJEDREZ_MINUTOS = 40
+AJEDREZ_EVENTOS_INTERVALO = float(os.getenv('AJEDREZ_EVENTOS_INTERVALO', '2'))
+AJEDREZ_EVENTOS_DURACION = int(os.getenv('AJEDREZ_EVENTOS_DURACION', '25'))
+AJEDREZ_BARRIDO_INTERVALO = int(os.getenv('AJEDREZ_BARRIDO_INTERVALO', '60'))  # segundos
+
+_cambios_ajedrez = threading.Condition()
+_version_cambios_ajedrez = [0]
+
+def avisar_cambio_ajedrez():
+    """Despierta a los flujos de eventos de este proceso"""
+    with _cambios_ajedrez:
+        _version_cambios_ajedrez[0] += 1
+        _cambios_ajedrez.notify_all()
+
+def finalizar_contadores_ajedrez(filtro=None, ahora=None):
+    """Marca como finalizados los contadores activos ya vencidos; devuelve cuántos"""
+    ahora = ahora or datetime.now(timezone.utc)
+    resultado = ajedrez.update_many(
+        dict(filtro or {}, estado="activo", tiempo_fin={"$lte": ahora}),
+        {"$set": {"estado": "finalizado", "fecha_finalizacion": ahora}}
+    )
+    if resultado.modified_count:
+        avisar_cambio_ajedrez()
+    return resultado.modified_count
+
+def eventos_ajedrez(anteriores, actuales):
+    """Eventos entre dos estados {id: fila}: (evento, id)"""
+    eventos = []
+    for id_usuario, fila in actuales.items():
+        previa = anteriores.get(id_usuario)
+        if previa is None:
+            eventos.append(("iniciado", id_usuario))
+        elif previa["tiempo_fin"] != fila["tiempo_fin"]:
+            eventos.append(("reiniciado", id_usuario))
+        elif previa["estado"] != fila["estado"] and fila["estado"] == "finalizado":
+            eventos.append(("finalizado", id_usuario))
+    for id_usuario, previa in anteriores.items():
+        if id_usuario in actuales:
+            continue
+        doc = ajedrez.find_one({"id": id_usuario}, {"estado": 1}, sort=[("tiempo_inicio", -1)])
+        if doc is None:
+            eventos.append(("eliminado", id_usuario))
+        elif doc.get("estado") == "terminado":
+            eventos.append(("terminado", id_usuario))
+        elif previa["estado"] != "finalizado":
+            eventos.append(("finalizado", id_usuario))
+        else:
+            eventos.append(("retirado", id_usuario))  # el barrido guardó un fin ya mostrado
+    return eventos
+
+@app.route('/api/ajedrez/eventos', methods=['GET'])
+def api_ajedrez_eventos():
+    """Server-Sent Events con los cambios de los contadores de ajedrez"""
+    def generar():
+        yield "retry: 3000\n\n"
+        actuales = contadores_ajedrez_activos()
+        yield f"event: contadores\ndata: {json.dumps({'contadores': list(actuales.values())})}\n\n"
+        fin = time.monotonic() + AJEDREZ_EVENTOS_DURACION
+        while time.monotonic() < fin:
+            with _cambios_ajedrez:
+                version = _version_cambios_ajedrez[0]
+            # despertar justo cuando vence el próximo contador
+            ahora = datetime.now(timezone.utc)
+            vencimientos = [(_fecha_utc(f["tiempo_fin"]) - ahora).total_seconds()
+                            for f in actuales.values() if f["estado"] == "activo" and f["tiempo_fin"]]
+            espera = min([AJEDREZ_EVENTOS_INTERVALO, fin - time.monotonic()] + [max(0.05, v) for v in vencimientos])
+            with _cambios_ajedrez:
+                _cambios_ajedrez.wait_for(lambda: _version_cambios_ajedrez[0] != version, timeout=max(0, espera))
+            anteriores, actuales = actuales, contadores_ajedrez_activos()
+            eventos = eventos_ajedrez(anteriores, actuales)
+            for evento, id_usuario in eventos:
+                datos = {"evento": evento, "id": id_usuario, "contadores": list(actuales.values())}
+                yield f"event: {evento}\ndata: {json.dumps(datos)}\n\n"
+            if not eventos:
+                yield ": sin cambios\n\n"
+
+    return Response(stream_with_context(generar()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/api/ajedrez/terminar', methods=['POST'])
 def ajedrez_terminar():
@@ -2563,6 +3652,7 @@ def ajedrez_terminar():
     )
     
     if resultado.modified_count > 0:
+        avisar_cambio_ajedrez()
         return jsonify({"success": True})
     else:
         return jsonify({"success": False, "error": "Contador no encontrado o ya terminado"}), 404
@@ -2577,23 +3667,23 @@ def ajedrez_reiniciar():
         return jsonify({"success": False, "error": "ID requerido"}), 400
     
     ahora = datetime.now(timezone.utc)
-    tiempo_fin = ahora + timedelta(minutes=40)
+    tiempo_fin = ahora + timedelta(minutes=AJEDREZ_MINUTOS)
     
     resultado = ajedrez.update_one(
         {"id": str(id_usuario), "estado": {"$in": ["activo", "finalizado"]}},
         {"$set": {
             "tiempo_inicio": ahora,
             "tiempo_fin": tiempo_fin,
-            "tiempo_restante_segundos": 2400,
             "estado": "activo",
             "fecha_finalizacion": None
-        }}
+        }, "$unset": {"tiempo_restante_segundos": ""}}
     )
     
     if resultado.modified_count > 0:
+        avisar_cambio_ajedrez()
         return jsonify({
             "success": True,
-            "tiempo_restante_segundos": 2400,
+            "tiempo_restante_segundos": AJEDREZ_MINUTOS * 60,
             "tiempo_fin": tiempo_fin.isoformat()
         })
     else:
@@ -2611,10 +3701,88 @@ def ajedrez_eliminar():
     resultado = ajedrez.delete_one({"id": str(id_usuario)})
     
     if resultado.deleted_count > 0:
+        avisar_cambio_ajedrez()
         return jsonify({"success": True})
     else:
         return jsonify({"success": False, "error": "Registro no encontrado"}), 404
 
+# --- Datos del reporte mensual ---
+# La parte que depende del mes (adquisiciones, préstamos y usuarios atendidos) se
+# calcula con dos agregaciones y se guarda en caché por (mes, año). Cada cambio
+# que afecta a un mes incrementa Contadores/{_id: "reporte:AAAA-MM"}.version (y
+# "reporte" para cambios que afectan a todos), así que la caché de cualquier
+# proceso se invalida sin necesidad de avisarle. Las existencias e inscritos
+# son lecturas O(1) y se leen siempre al momento.
+REPORTE_CACHE_MAX = 120
+_cache_reporte = {}
+_cache_reporte_lock = threading.Lock()
+
+def _clave_version_reporte(mes, año):
+    return f"reporte:{año}-{mes:02d}"
+
+def invalidar_reporte_mensual(fecha=None):
+    """Marca como obsoletos los datos del mes de fecha ('AAAA-MM-DD' o datetime);
+    sin fecha, los de todos los meses"""
+    if fecha is None:
+        clave = "reporte"
+    else:
+        try:
+            fecha = _como_fecha(fecha)
+            clave = _clave_version_reporte(fecha.month, fecha.year)
+        except (ValueError, TypeError):
+            clave = "reporte"
+    try:
+        contadores.update_one({"_id": clave}, {"$inc": {"version": 1}}, upsert=True)
+    except Exception as e:
+        print(f"[REPORTE] Error invalidando caché del reporte: {e}")
+
+def _version_reporte(mes, año):
+    docs = contadores.find({"_id": {"$in": ["reporte", _clave_version_reporte(mes, año)]}}, {"version": 1})
+    return tuple(sorted((d["_id"], d.get("version", 0)) for d in docs))
+
+def _calcular_datos_mes(inicio_mes, fin_mes):
+    """Adquisiciones y préstamos del mes calculados por MongoDB"""
+    adquisiciones = list(inventario.aggregate([
+        {"$match": {"created_at": {"$gte": inicio_mes, "$lt": fin_mes}}},
+        # $sum ignora valores no numéricos (DISPONIBLES sin migrar)
+        {"$group": {"_id": None, "titulos": {"$sum": 1}, "volumenes": {"$sum": "$DISPONIBLES"}}}
+    ]))
+    # fecha_inicio es texto 'AAAA-MM-DD', así que el rango se compara como texto
+    prestamos_mes = list(prestamos.aggregate([
+        {"$match": {"fecha_inicio": {"$gte": inicio_mes.strftime("%Y-%m-%d"), "$lt": fin_mes.strftime("%Y-%m-%d")}}},
+        {"$facet": {
+            "total": [{"$count": "n"}],
+            "usuarios": [
+                {"$group": {"_id": {"$ifNull": ["$id", "$identificador"]}}},
+                {"$match": {"_id": {"$nin": ["", None]}}},
+                {"$count": "n"}
+            ]
+        }}
+    ]))
+    facet = prestamos_mes[0] if prestamos_mes else {}
+    return {
+        "adquisiciones_titulos": adquisiciones[0]["titulos"] if adquisiciones else 0,
+        "adquisiciones_volumenes": adquisiciones[0]["volumenes"] if adquisiciones else 0,
+        "prestamos": facet["total"][0]["n"] if facet.get("total") else 0,
+        "usuarios_unicos": facet["usuarios"][0]["n"] if facet.get("usuarios") else 0,
+    }
+
+def datos_mes_reporte(mes, año):
+    """Datos del mes desde la caché si ningún cambio la invalidó"""
+    inicio_mes = datetime(año, mes, 1, tzinfo=timezone.utc)
+    fin_mes = datetime(año + 1, 1, 1, tzinfo=timezone.utc) if mes == 12 else datetime(año, mes + 1, 1, tzinfo=timezone.utc)
+    version = _version_reporte(mes, año)
+    with _cache_reporte_lock:
+        guardado = _cache_reporte.get((mes, año))
+    if guardado and guardado[0] == version:
+        return guardado[1]
+    datos_mes = _calcular_datos_mes(inicio_mes, fin_mes)
+    with _cache_reporte_lock:
+        if len(_cache_reporte) >= REPORTE_CACHE_MAX:
+            _cache_reporte.pop(next(iter(_cache_reporte)))
+        _cache_reporte[(mes, año)] = (version, datos_mes)
+    return datos_mes
+
 def generar_datos_reporte_mensual(mes=None, año=None):
     """Genera los datos del reporte mensual desde MongoDB"""
     if mes is None:
@@ -2622,54 +3790,18 @@ def generar_datos_reporte_mensual(mes=None, año=None):
     if año is None:
         año = datetime.now().year
     
-    # Calcular rango de fechas del mes
-    inicio_mes = datetime(año, mes, 1, tzinfo=timezone.utc)
-    if mes == 12:
-        fin_mes = datetime(año + 1, 1, 1, tzinfo=timezone.utc)
-    else:
-        fin_mes = datetime(año, mes + 1, 1, tzinfo=timezone.utc)
-    
     datos = {}
+    datos_mes = datos_mes_reporte(mes, año)
     
     # 1. ACERVO BIBLIOGRÁFICO - LIBROS
-    # EXISTENCIA TOTAL (títulos y volúmenes)
-    total_titulos = inventario.count_documents({})
-    total_volumenes = 0
-    for doc in inventario.find({}):
-        disponibles = obtener_disponibles(doc)
-        if disponibles:
-            try:
-                num = int(str(disponibles).replace(',', '').split()[0])
-                total_volumenes += num
-            except:
-                pass
-    
-    datos['acervo_existencia_titulos'] = total_titulos
-    datos['acervo_existencia_volumenes'] = total_volumenes
-    
-    # ADQUISICIONES del mes (libros registrados en el mes)
-    # Nota: Si no tienes campo created_at, esto contará 0. Puedes ajustar según tu estructura
-    adquisiciones_titulos = 0
-    adquisiciones_volumenes = 0
-    try:
-        adquisiciones_titulos = inventario.count_documents({
-            "created_at": {"$gte": inicio_mes, "$lt": fin_mes}
-        })
-        for doc in inventario.find({"created_at": {"$gte": inicio_mes, "$lt": fin_mes}}):
-            disponibles = obtener_disponibles(doc)
-            if disponibles:
-                try:
-                    num = int(str(disponibles).replace(',', '').split()[0])
-                    adquisiciones_volumenes += num
-                except:
-                    pass
-    except Exception:
-        # Si no existe el campo created_at, asumimos 0 adquisiciones
-        adquisiciones_titulos = 0
-        adquisiciones_volumenes = 0
+    # EXISTENCIA TOTAL (títulos y volúmenes): metadatos de la colección y contador
+    # materializado de U -> EXIST (no los DISPONIBLES en estantería)
+    datos['acervo_existencia_titulos'] = inventario.estimated_document_count()
+    datos['acervo_existencia_volumenes'] = contar_existencia_volumenes()
     
-    datos['acervo_adquisiciones_titulos'] = adquisiciones_titulos
-    datos['acervo_adquisiciones_volumenes'] = adquisiciones_volumenes
+    # ADQUISICIONES del mes (libros registrados en el mes, según created_at)
+    datos['acervo_adquisiciones_titulos'] = datos_mes['adquisiciones_titulos']
+    datos['acervo_adquisiciones_volumenes'] = datos_mes['adquisiciones_volumenes']
     
     # 2. MATERIALES CONSULTADOS
     # MATERIALES CONSULTADOS EN SALA (préstamos que se consultaron en sala)
@@ -2679,14 +3811,8 @@ def generar_datos_reporte_mensual(mes=None, año=None):
     materiales_sala_volumenes = 0
     
     # PRÉSTAMOS A DOMICILIO del mes
-    prestamos_mes = prestamos.find({
-        "fecha_inicio": {"$gte": inicio_mes.strftime("%Y-%m-%d"), "$lt": fin_mes.strftime("%Y-%m-%d")}
-    })
-    prestamos_domicilio_titulos = 0
-    prestamos_domicilio_volumenes = 0
-    for p in prestamos_mes:
-        prestamos_domicilio_titulos += 1
-        prestamos_domicilio_volumenes += 1
+    prestamos_domicilio_titulos = datos_mes['prestamos']
+    prestamos_domicilio_volumenes = datos_mes['prestamos']
     
     datos['materiales_sala_titulos'] = materiales_sala_titulos
     datos['materiales_sala_volumenes'] = materiales_sala_volumenes
@@ -2696,31 +3822,21 @@ def generar_datos_reporte_mensual(mes=None, año=None):
     datos['total_materiales_consultados_volumenes'] = materiales_sala_volumenes + prestamos_domicilio_volumenes
     
     # 3. SERVICIOS BIBLIOTECARIOS
-    # USUARIOS ATENDIDOS (usuarios que usaron la biblioteca en el mes)
-    usuarios_atendidos_hombres = 0
-    usuarios_atendidos_mujeres = 0
-    
-    # Contar usuarios únicos que tuvieron préstamos en el mes
-    usuarios_unicos = set()
-    for p in prestamos.find({
-        "fecha_inicio": {"$gte": inicio_mes.strftime("%Y-%m-%d"), "$lt": fin_mes.strftime("%Y-%m-%d")}
-    }):
-        usuario_id = p.get("id") or p.get("identificador") or ""
-        if usuario_id:
-            usuarios_unicos.add(usuario_id)
+    # USUARIOS ATENDIDOS (usuarios únicos que tuvieron préstamos en el mes)
+    usuarios_unicos = datos_mes['usuarios_unicos']
     
     # Contar por género (necesitarías tener un campo de género en alumnos/docentes)
     # Por ahora, asumimos distribución 50/50 o puedes ajustar según tus datos
-    usuarios_atendidos_hombres = len(usuarios_unicos) // 2
-    usuarios_atendidos_mujeres = len(usuarios_unicos) - usuarios_atendidos_hombres
+    usuarios_atendidos_hombres = usuarios_unicos // 2
+    usuarios_atendidos_mujeres = usuarios_unicos - usuarios_atendidos_hombres
     
     datos['usuarios_atendidos_hombres'] = usuarios_atendidos_hombres
     datos['usuarios_atendidos_mujeres'] = usuarios_atendidos_mujeres
-    datos['usuarios_atendidos_total'] = len(usuarios_unicos)
+    datos['usuarios_atendidos_total'] = usuarios_unicos
     
     # USUARIOS INSCRITOS A LA BIBLIOTECA (total de alumnos y docentes)
-    total_alumnos = alumnos.count_documents({})
-    total_docentes = db["Docentes"].count_documents({})
+    total_alumnos = alumnos.estimated_document_count()
+    total_docentes = db["Docentes"].estimated_document_count()
     total_inscritos = total_alumnos + total_docentes
     
     # Distribución por género (asumiendo 50/50 si no tienes el campo)
@@ -2747,10 +3863,161 @@ def generar_datos_reporte_mensual(mes=None, año=None):
     datos['personal_apoyo_administrativos_mujeres'] = 0
     datos['personal_otros_hombres'] = 0
     datos['personal_otros_mujeres'] = 0
+    datos['personal_total_hombres'] = 0
+    datos['personal_total_mujeres'] = 0
     datos['personal_total'] = 0
     
     return datos
 
+# --- Plantilla del reporte mensual (RMIBI) ---
+# El .xls se convierte una sola vez a .xlsx conservando formato (fuentes, rellenos,
+# bordes, alineación, formatos numéricos, celdas combinadas, anchos y altos). Del
+# .xlsx resultante se guarda en memoria cada parte del zip y la hoja RMIBI MENSUAL
+# se trocea alrededor de las celdas del mapa CELDAS_RMIBI, así que generar un
+# reporte sólo vuelve a escribir esas celdas y empaquetar el zip.
+PLANTILLA_REPORTE = os.getenv('PLANTILLA_REPORTE', "Reporte AGOSTO ( 18-29 ) (1).xls")
+HOJA_RMIBI = "RMIBI MENSUAL"
+MESES_REPORTE = ['', 'ENERO', 'FEBRERO', 'MARZO', 'ABRIL', 'MAYO', 'JUNIO',
+                 'JULIO', 'AGOSTO', 'SEPTIEMBRE', 'OCTUBRE', 'NOVIEMBRE', 'DICIEMBRE']
+
+# celda de la hoja RMIBI MENSUAL -> clave de generar_datos_reporte_mensual()
+CELDAS_RMIBI = {
+    "C15": "mes_nombre", "H15": "año",
+    # ACERVO BIBLIOGRÁFICO - LIBROS (títulos, volúmenes)
+    "C20": "acervo_existencia_titulos", "D20": "acervo_existencia_volumenes",
+    "C21": "acervo_adquisiciones_titulos", "D21": "acervo_adquisiciones_volumenes",
+    # MATERIALES CONSULTADOS - LIBROS
+    "C26": "materiales_sala_titulos", "D26": "materiales_sala_volumenes",
+    "C27": "prestamos_domicilio_titulos", "D27": "prestamos_domicilio_volumenes",
+    "C28": "total_materiales_consultados_titulos", "D28": "total_materiales_consultados_volumenes",
+    # SERVICIOS BIBLIOTECARIOS (hombres, mujeres y total)
+    "C38": "usuarios_atendidos_hombres", "D38": "usuarios_atendidos_mujeres",
+    "E38": "usuarios_inscritos_hombres", "F38": "usuarios_inscritos_mujeres",
+    "C39": "usuarios_atendidos_total", "E39": "usuarios_inscritos_total",
+    # PERSONAL ADSCRITO A LA BIBLIOTECA (hombres, mujeres)
+    "C50": "personal_directivo_hombres", "D50": "personal_directivo_mujeres",
+    "E50": "personal_procesos_tecnicos_hombres", "F50": "personal_procesos_tecnicos_mujeres",
+    "G50": "personal_servicios_publico_hombres", "H50": "personal_servicios_publico_mujeres",
+    "I50": "personal_apoyo_bibliotecarios_hombres", "J50": "personal_apoyo_bibliotecarios_mujeres",
+    "K50": "personal_administrativo_hombres", "L50": "personal_administrativo_mujeres",
+    "M50": "personal_apoyo_administrativos_hombres", "N50": "personal_apoyo_administrativos_mujeres",
+    "O50": "personal_otros_hombres", "P50": "personal_otros_mujeres",
+    "Q50": "personal_total_hombres", "R50": "personal_total_mujeres", "S50": "personal_total",
+}
+
+_plantilla_reporte = None
+_plantilla_reporte_lock = threading.Lock()
+
+_BORDES_XLS = {1: "thin", 2: "medium", 3: "dashed", 4: "dotted", 5: "thick", 6: "double", 7: "hair",
+               8: "mediumDashed", 9: "dashDot", 10: "mediumDashDot", 11: "dashDotDot",
+               12: "mediumDashDotDot", 13: "slantDashDot"}
+_ALINEACION_XLS = {1: "left", 2: "center", 3: "right", 4: "fill", 5: "justify", 6: "centerContinuous", 7: "distributed"}
+_ALINEACION_V_XLS = {0: "top", 1: "center", 2: "bottom", 3: "justify", 4: "distributed"}
+
+def _color_xls(libro, indice):
+    rgb = libro.colour_map.get(indice)
+    return "FF%02X%02X%02X" % rgb if rgb else None
+
+def _estilo_xls(libro, xf_index, cache):
+    """Objetos de estilo de openpyxl equivalentes a un XF del .xls"""
+    if xf_index in cache:
+        return cache[xf_index]
+    xf = libro.xf_list[xf_index]
+    fuente = libro.font_list[xf.font_index]
+    borde = xf.border
+    lado = lambda estilo, color: Side(style=_BORDES_XLS.get(estilo), color=_color_xls(libro, color)) if estilo else Side()
+    relleno = PatternFill()
+    if xf.background.fill_pattern == 1 and _color_xls(libro, xf.background.pattern_colour_index):
+        relleno = PatternFill("solid", fgColor=_color_xls(libro, xf.background.pattern_colour_index))
+    estilo = {
+        "font": Font(name=fuente.name, size=fuente.height / 20, bold=bool(fuente.bold), italic=bool(fuente.italic),
+                     underline="single" if fuente.underline_type else None, color=_color_xls(libro, fuente.colour_index)),
+        "fill": relleno,
+        "border": Border(left=lado(borde.left_line_style, borde.left_colour_index),
+                         right=lado(borde.right_line_style, borde.right_colour_index),
+                         top=lado(borde.top_line_style, borde.top_colour_index),
+                         bottom=lado(borde.bottom_line_style, borde.bottom_colour_index)),
+        "alignment": Alignment(horizontal=_ALINEACION_XLS.get(xf.alignment.hor_align),
+                               vertical=_ALINEACION_V_XLS.get(xf.alignment.vert_align),
+                               wrap_text=bool(xf.alignment.text_wrapped)),
+        "number_format": libro.format_map[xf.format_key].format_str if xf.format_key in libro.format_map else "General",
+    }
+    cache[xf_index] = estilo
+    return estilo
+
+def convertir_plantilla_xls(ruta):
+    """Convierte la plantilla .xls a un libro de openpyxl conservando su formato"""
+    libro = xlrd.open_workbook(ruta, formatting_info=True)
+    wb = Workbook()
+    wb.remove(wb.active)
+    for hoja in libro.sheets():
+        ws = wb.create_sheet(hoja.name)
+        estilos = {}
+        for r in range(hoja.nrows):
+            for c in range(hoja.ncols):
+                tipo = hoja.cell_type(r, c)
+                valor = hoja.cell_value(r, c)
+                if tipo == xlrd.XL_CELL_DATE:
+                    valor = xlrd.xldate_as_datetime(valor, libro.datemode)
+                elif tipo == xlrd.XL_CELL_NUMBER and valor == int(valor):
+                    valor = int(valor)
+                elif tipo not in (xlrd.XL_CELL_TEXT, xlrd.XL_CELL_NUMBER, xlrd.XL_CELL_BOOLEAN):
+                    valor = None
+                celda = ws.cell(row=r + 1, column=c + 1, value=valor)
+                for atributo, objeto in _estilo_xls(libro, hoja.cell_xf_index(r, c), estilos).items():
+                    setattr(celda, atributo, objeto)
+        for c, info in hoja.colinfo_map.items():
+            ws.column_dimensions[get_column_letter(c + 1)].width = info.width / 256
+        for r, info in hoja.rowinfo_map.items():
+            ws.row_dimensions[r + 1].height = info.height / 20
+        for rlo, rhi, clo, chi in hoja.merged_cells:
+            ws.merge_cells(start_row=rlo + 1, end_row=rhi, start_column=clo + 1, end_column=chi)
+    return wb
+
+def _preparar_plantilla_reporte():
+    """Convierte la plantilla (una vez) y trocea la hoja RMIBI alrededor de las celdas del mapa"""
+    if not os.path.exists(PLANTILLA_REPORTE):
+        raise FileNotFoundError(f"Template no encontrado: {PLANTILLA_REPORTE}")
+    if PLANTILLA_REPORTE.lower().endswith(".xlsx"):
+        wb = load_workbook(PLANTILLA_REPORTE)
+    else:
+        wb = convertir_plantilla_xls(PLANTILLA_REPORTE)
+    if HOJA_RMIBI not in wb.sheetnames:
+        raise ValueError(f"La plantilla no tiene la hoja '{HOJA_RMIBI}'")
+    hoja = wb[HOJA_RMIBI]
+    for ref in CELDAS_RMIBI:
+        if hoja[ref].value is None:
+            hoja[ref].value = 0  # para que la celda aparezca en el XML
+    buffer = BytesIO()
+    wb.save(buffer)
+    # openpyxl guarda la hoja n (empezando en 1) como xl/worksheets/sheet{n}.xml
+    nombre_hoja = f"xl/worksheets/sheet{wb.sheetnames.index(HOJA_RMIBI) + 1}.xml"
+    with zipfile.ZipFile(buffer) as z:
+        # se conservan los ZipInfo (con su fecha) para que el mismo contenido dé los mismos bytes
+        partes = [(info, z.read(info.filename)) for info in z.infolist()]
+    xml = next(contenido for info, contenido in partes if info.filename == nombre_hoja).decode("utf-8")
+    patron = re.compile(r'<c r="(%s)"(?: s="(\d+)")?(?: t="\w+")?(?:/>|>.*?</c>)' % "|".join(CELDAS_RMIBI), re.S)
+    trozos, ranuras, inicio = [], [], 0
+    for m in patron.finditer(xml):
+        trozos.append(xml[inicio:m.start()])
+        ranuras.append((m.group(1), f' s="{m.group(2)}"' if m.group(2) else ""))
+        inicio = m.end()
+    trozos.append(xml[inicio:])
+    return {"partes": partes, "hoja": nombre_hoja, "trozos": trozos, "ranuras": ranuras}
+
+def obtener_plantilla_reporte():
+    global _plantilla_reporte
+    if _plantilla_reporte is None:
+        with _plantilla_reporte_lock:
+            if _plantilla_reporte is None:
+                _plantilla_reporte = _preparar_plantilla_reporte()
+    return _plantilla_reporte
+
+def _celda_xml(ref, estilo, valor):
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return f'<c r="{ref}"{estilo}><v>{valor}</v></c>'
+    return f'<c r="{ref}"{estilo} t="inlineStr"><is><t>{escape_xml(str(valor))}</t></is></c>'
+
 def generar_reporte_excel(mes=None, año=None):
     """Genera el archivo Excel del reporte mensual"""
     if mes is None:
@@ -2758,131 +4025,82 @@ def generar_reporte_excel(mes=None, año=None):
     if año is None:
         año = datetime.now().year
     
-    # Leer el template
-    template_path = "Reporte AGOSTO ( 18-29 ) (1).xls"
-    if not os.path.exists(template_path):
-        raise FileNotFoundError(f"Template no encontrado: {template_path}")
-    
-    try:
-        # Leer todas las hojas (pandas puede leer .xls con xlrd)
-        excel_file = pd.ExcelFile(template_path, engine='xlrd')
-    except Exception as e:
-        # Si falla con xlrd, intentar con openpyxl (para .xlsx) o sin engine
-        try:
-            excel_file = pd.ExcelFile(template_path)
-        except Exception as e2:
-            raise FileNotFoundError(f"Error al leer el archivo Excel: {e2}")
+    plantilla = obtener_plantilla_reporte()
     
     # Obtener datos del mes
-    datos = generar_datos_reporte_mensual(mes, año)
+    datos = dict(generar_datos_reporte_mensual(mes, año), mes_nombre=MESES_REPORTE[mes], año=año)
     
-    # Nombres de meses en español
-    meses_espanol = ['', 'ENERO', 'FEBRERO', 'MARZO', 'ABRIL', 'MAYO', 'JUNIO',
-                     'JULIO', 'AGOSTO', 'SEPTIEMBRE', 'OCTUBRE', 'NOVIEMBRE', 'DICIEMBRE']
-    mes_nombre = meses_espanol[mes]
+    piezas = [plantilla["trozos"][0]]
+    for (ref, estilo), trozo in zip(plantilla["ranuras"], plantilla["trozos"][1:]):
+        piezas.append(_celda_xml(ref, estilo, datos.get(CELDAS_RMIBI[ref], 0)))
+        piezas.append(trozo)
     
-    # Crear un nuevo archivo en memoria
     output = BytesIO()
     try:
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Procesar cada hoja
-            for sheet_name in excel_file.sheet_names:
-                try:
-                    # Leer la hoja (intentar con xlrd primero para .xls)
-                    try:
-                        df = pd.read_excel(template_path, sheet_name=sheet_name, header=None, engine='xlrd')
-                    except:
-                        df = pd.read_excel(template_path, sheet_name=sheet_name, header=None)
-                    
-                    # Verificar que el DataFrame tenga suficientes filas y columnas
-                    num_filas = len(df)
-                    num_cols = len(df.columns) if num_filas > 0 else 0
-                    
-                    # Actualizar datos en la hoja "RMIBI MENSUAL"
-                    if sheet_name == "RMIBI MENSUAL" and num_filas > 48 and num_cols > 18:
-                        # Actualizar mes y año (línea 14)
-                        if num_filas > 14 and num_cols > 6:
-                            if pd.notna(df.iloc[14, 1]) and "MES:" in str(df.iloc[14, 1]):
-                                df.iloc[14, 2] = mes_nombre
-                            if pd.notna(df.iloc[14, 5]) and "Año:" in str(df.iloc[14, 5]):
-                                df.iloc[14, 6] = año
-                        
-                        # ACERVO BIBLIOGRÁFICO - EXISTENCIA TOTAL (línea 19)
-                        if num_filas > 19 and num_cols > 3:
-                            df.iloc[19, 2] = datos['acervo_existencia_titulos']  # Títulos
-                            df.iloc[19, 3] = datos['acervo_existencia_volumenes']  # Volúmenes
-                        
-                        # ACERVO BIBLIOGRÁFICO - ADQUISICIONES (línea 20)
-                        if num_filas > 20 and num_cols > 3:
-                            df.iloc[20, 2] = datos['acervo_adquisiciones_titulos']  # Títulos
-                            df.iloc[20, 3] = datos['acervo_adquisiciones_volumenes']  # Volúmenes
-                        
-                        # MATERIALES CONSULTADOS EN SALA (línea 25)
-                        if num_filas > 25 and num_cols > 3:
-                            df.iloc[25, 2] = datos['materiales_sala_titulos']
-                            df.iloc[25, 3] = datos['materiales_sala_volumenes']
-                        
-                        # PRÉSTAMOS A DOMICILIO (línea 26)
-                        if num_filas > 26 and num_cols > 3:
-                            df.iloc[26, 2] = datos['prestamos_domicilio_titulos']
-                            df.iloc[26, 3] = datos['prestamos_domicilio_volumenes']
-                        
-                        # TOTAL DE MATERIALES CONSULTADOS (línea 27)
-                        if num_filas > 27 and num_cols > 3:
-                            df.iloc[27, 2] = datos['total_materiales_consultados_titulos']
-                            df.iloc[27, 3] = datos['total_materiales_consultados_volumenes']
-                        
-                        # USUARIOS ATENDIDOS (línea 36)
-                        if num_filas > 36 and num_cols > 5:
-                            df.iloc[36, 2] = datos['usuarios_atendidos_hombres']
-                            df.iloc[36, 3] = datos['usuarios_atendidos_mujeres']
-                            # USUARIOS INSCRITOS (línea 36, columnas 4-5)
-                            df.iloc[36, 4] = datos['usuarios_inscritos_hombres']
-                            df.iloc[36, 5] = datos['usuarios_inscritos_mujeres']
-                        
-                        # PERSONAL ADSCRITO (línea 48)
-                        if num_filas > 48 and num_cols > 18:
-                            # Directivo
-                            df.iloc[48, 2] = datos['personal_directivo_hombres']
-                            df.iloc[48, 3] = datos['personal_directivo_mujeres']
-                            # Procesos Técnicos
-                            df.iloc[48, 4] = datos['personal_procesos_tecnicos_hombres']
-                            df.iloc[48, 5] = datos['personal_procesos_tecnicos_mujeres']
-                            # Servicios al Público
-                            df.iloc[48, 6] = datos['personal_servicios_publico_hombres']
-                            df.iloc[48, 7] = datos['personal_servicios_publico_mujeres']
-                            # Apoyo Bibliotecarios
-                            if num_cols > 11:
-                                df.iloc[48, 10] = datos['personal_apoyo_bibliotecarios_hombres']
-                                df.iloc[48, 11] = datos['personal_apoyo_bibliotecarios_mujeres']
-                            # Administrativo
-                            if num_cols > 13:
-                                df.iloc[48, 12] = datos['personal_administrativo_hombres']
-                                df.iloc[48, 13] = datos['personal_administrativo_mujeres']
-                            # Apoyo Administrativos
-                            if num_cols > 15:
-                                df.iloc[48, 14] = datos['personal_apoyo_administrativos_hombres']
-                                df.iloc[48, 15] = datos['personal_apoyo_administrativos_mujeres']
-                            # Otros
-                            if num_cols > 17:
-                                df.iloc[48, 16] = datos['personal_otros_hombres']
-                                df.iloc[48, 17] = datos['personal_otros_mujeres']
-                            # Total
-                            if num_cols > 18:
-                                df.iloc[48, 18] = datos['personal_total']
-                    
-                    # Escribir la hoja
-                    df.to_excel(writer, sheet_name=sheet_name, index=False, header=False)
-                except Exception as e:
-                    print(f"[REPORTE] Error al procesar hoja '{sheet_name}': {e}")
-                    # Continuar con la siguiente hoja
-                    continue
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as z:
+            for info, contenido in plantilla["partes"]:
+                if info.filename == plantilla["hoja"]:
+                    contenido = "".join(piezas).encode("utf-8")
+                z.writestr(info, contenido)
     except Exception as e:
         raise Exception(f"Error al generar el reporte Excel: {e}")
     
     output.seek(0)
     return output
 
+# --- Archivo de reportes mensuales ---
+# reportes_mensuales/Reporte_RMIBI_<MES>_<AÑO>.xlsx más un .json con el sha256 del
+# contenido, la fecha de generación y la versión de datos del mes (ver
+# invalidar_reporte_mensual). Un mes cerrado se sirve desde disco con ETag y
+# Last-Modified mientras su versión de datos no cambie; el mes en curso se genera
+# al momento.
+DIRECTORIO_REPORTES = os.getenv('DIRECTORIO_REPORTES', "reportes_mensuales")
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def nombre_reporte(mes, año):
+    # Usar .xlsx porque openpyxl genera archivos Excel modernos
+    return f"Reporte_RMIBI_{MESES_REPORTE[mes]}_{año}.xlsx"
+
+def mes_cerrado(mes, año):
+    hoy = datetime.now(pytz.timezone('America/Mexico_City')).date()
+    return (año, mes) < (hoy.year, hoy.month)
+
+def archivar_reporte(mes, año):
+    """Genera el reporte del mes y lo guarda en el archivo junto con sus metadatos"""
+    os.makedirs(DIRECTORIO_REPORTES, exist_ok=True)
+    version = _version_reporte(mes, año)
+    contenido = generar_reporte_excel(mes, año).getvalue()
+    ruta = os.path.join(DIRECTORIO_REPORTES, nombre_reporte(mes, año))
+    meta = {
+        "mes": mes,
+        "año": año,
+        "sha256": hashlib.sha256(contenido).hexdigest(),
+        "bytes": len(contenido),
+        "generado": datetime.now(timezone.utc).isoformat(),
+        "version_datos": [list(v) for v in version]
+    }
+    # escribir a un temporal y renombrar para que nunca se sirva un archivo a medias
+    for destino, datos_archivo in ((ruta, contenido), (ruta[:-5] + ".json", json.dumps(meta).encode('utf-8'))):
+        temporal = f"{destino}.{os.getpid()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(datos_archivo)
+        os.replace(temporal, destino)
+    return dict(meta, ruta=ruta)
+
+def reporte_archivado(mes, año):
+    """Metadatos del reporte archivado si sigue vigente; None si falta o está obsoleto"""
+    ruta = os.path.join(DIRECTORIO_REPORTES, nombre_reporte(mes, año))
+    try:
+        with open(ruta[:-5] + ".json", encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(ruta):
+        return None
+    if [list(v) for v in _version_reporte(mes, año)] != meta.get("version_datos"):
+        return None
+    return dict(meta, ruta=ruta)
+
 @app.route('/api/informes/datos', methods=['GET'])
 def api_informes_datos():
     """Obtiene los datos del reporte para mostrar en la tabla"""
@@ -2932,7 +4150,7 @@ def api_informes_datos():
 
 @app.route('/api/informes/descargar', methods=['GET'])
 def api_informes_descargar():
-    """Genera y descarga el reporte Excel"""
+    """Genera y descarga el reporte Excel (meses cerrados desde reportes_mensuales/)"""
     mes = request.args.get('mes', type=int)
     año = request.args.get('año', type=int)
     
@@ -2940,59 +4158,66 @@ def api_informes_descargar():
         mes = datetime.now().month
     if año is None:
         año = datetime.now().year
+    if not 1 <= mes <= 12:
+        return jsonify({"success": False, "error": "Mes inválido"}), 400
     
     try:
-        output = generar_reporte_excel(mes, año)
-        meses_espanol = ['', 'ENERO', 'FEBRERO', 'MARZO', 'ABRIL', 'MAYO', 'JUNIO',
-                         'JULIO', 'AGOSTO', 'SEPTIEMBRE', 'OCTUBRE', 'NOVIEMBRE', 'DICIEMBRE']
-        # Usar .xlsx porque openpyxl genera archivos Excel modernos
-        filename = f"Reporte_RMIBI_{meses_espanol[mes]}_{año}.xlsx"
+        if mes_cerrado(mes, año):
+            # Mes cerrado: servir el archivo (generándolo una sola vez si falta)
+            meta = reporte_archivado(mes, año) or archivar_reporte(mes, año)
+            return send_file(
+                os.path.abspath(meta["ruta"]),
+                mimetype=MIMETYPE_XLSX,
+                as_attachment=True,
+                download_name=nombre_reporte(mes, año),
+                etag=meta["sha256"],
+                last_modified=datetime.fromisoformat(meta["generado"]),
+                conditional=True,
+                max_age=3600
+            )
         
+        output = generar_reporte_excel(mes, año)
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=MIMETYPE_XLSX,
             as_attachment=True,
-            download_name=filename
+            download_name=nombre_reporte(mes, año),
+            etag=hashlib.sha256(output.getvalue()).hexdigest(),
+            conditional=True
         )
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
-def generar_reporte_mensual_automatico():
-    """Genera el reporte mensual automáticamente el día 28 de cada mes"""
+def generar_reporte_mensual_automatico(mes=None, año=None):
+    """Genera el reporte mensual automáticamente el día 28 de cada mes.
+    Con mes y año explícitos (ejecución programada o de recuperación) lo genera siempre.
+    Los errores se propagan para que ejecutar_tarea los guarde en ultimo_error."""
     hoy = datetime.now()
-    if hoy.day == 28:
-        mes = hoy.month
-        año = hoy.year
+    if mes is not None or hoy.day == 28:
+        mes = mes or hoy.month
+        año = año or hoy.year
         try:
-            # Generar el reporte
-            output = generar_reporte_excel(mes, año)
-            
-            # Guardar el reporte en una carpeta de reportes
-            reportes_dir = "reportes_mensuales"
-            if not os.path.exists(reportes_dir):
-                os.makedirs(reportes_dir)
-            
-            meses_espanol = ['', 'ENERO', 'FEBRERO', 'MARZO', 'ABRIL', 'MAYO', 'JUNIO',
-                             'JULIO', 'AGOSTO', 'SEPTIEMBRE', 'OCTUBRE', 'NOVIEMBRE', 'DICIEMBRE']
-            # Usar .xlsx porque openpyxl genera archivos Excel modernos
-            filename = f"{reportes_dir}/Reporte_RMIBI_{meses_espanol[mes]}_{año}.xlsx"
-            
-            with open(filename, 'wb') as f:
-                f.write(output.getvalue())
-            
-            print(f"[REPORTE] Reporte mensual generado automáticamente: {filename}")
+            meta = archivar_reporte(mes, año)
         except Exception as e:
-            print(f"[REPORTE] Error al generar reporte automático: {e}")
+            print(f"[REPORTE] Error al generar reporte automático de {mes:02d}/{año}: {e}")
+            raise
+        print(f"[REPORTE] Reporte mensual generado automáticamente: {meta['ruta']}")
 
 @app.route('/api/verificar_vencimientos', methods=['POST'])
 def verificar_vencimientos():
-    """Endpoint manual para verificar vencimientos y enviar correos"""
+    """Endpoint manual para verificar vencimientos y enviar correos. Pasa por el
+    bloqueo de Tareas: si otro proceso ya está ejecutando una tarea, no se repite."""
     try:
-        verificar_y_actualizar_prestamos_vencidos()
-        enviar_recordatorios_diarios()
-        enviar_recordatorios_multas()
-        limpiar_registros_antiguos()  # También limpiar registros antiguos
-        return jsonify({"success": True, "message": "Verificación completada"})
+        resultados = {}
+        for nombre in ("vencimientos", "recordatorios", "limpieza_sitio"):
+            adelantar_tarea(nombre)
+            ejecutada = ejecutar_tarea(nombre)
+            doc = tareas.find_one({"_id": nombre}) or {}
+            resultados[nombre] = {"ejecutada": ejecutada, "error": doc.get("ultimo_error") if ejecutada else None}
+        errores = [f"{nombre}: {r['error']}" for nombre, r in resultados.items() if r["error"]]
+        if errores:
+            return jsonify({"success": False, "error": "; ".join(errores), "tareas": resultados}), 500
+        return jsonify({"success": True, "message": "Verificación completada", "tareas": resultados})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -3006,25 +4231,11 @@ def eliminar_prestamo():
     fecha_inicio = datos.get('fecha_inicio')
 
     # construir query para localizar préstamo activo
-    query = {}
+    filtros = []
     if prestamo_id:
-        try:
-            query = {"_id": ObjectId(prestamo_id)}
-        except Exception:
-            query = {"_id": prestamo_id}
+        filtros.append(filtro_por_id(prestamo_id))
     else:
-        # Buscar por ISBN y ID principalmente
-        query = {"estado": {"$ne": "Devuelto"}}  # No devueltos
-        if isbn:
-            query["libro.isbn"] = isbn
-        if identificador:
-            query["id"] = str(identificador)
-        if fecha_inicio:
-            query["fecha_inicio"] = fecha_inicio
-
-    prestamo = prestamos.find_one(query)
-    if not prestamo:
-        # intentar sin estado estricto pero manteniendo ISBN e ID
+        # Buscar por ISBN y ID principalmente; si no aparece, sin estado estricto
         alt = {}
         if isbn:
             alt["libro.isbn"] = isbn
@@ -3032,152 +4243,209 @@ def eliminar_prestamo():
             alt["id"] = str(identificador)
         if fecha_inicio:
             alt["fecha_inicio"] = fecha_inicio
-        if alt:
-            prestamo = prestamos.find_one(alt)
-        if not prestamo:
-            return jsonify({"success": False, "error": "Préstamo no encontrado"}), 404
+        if not alt:
+            return jsonify({"success": False, "error": "Indica el préstamo a eliminar"}), 400
+        filtros = [dict(alt, estado={"$ne": "Devuelto"}), alt]
 
     try:
-        # Eliminar el préstamo físicamente de la colección
-        prestamos.delete_one({"_id": prestamo["_id"]})
-        
-        # Eliminar de devoluciones si existe
-        devoluciones.delete_many({
-            "$or": [
-                {"prestamo_id": str(prestamo["_id"])},
-                {"libro.isbn": prestamo.get('libro', {}).get('isbn', '')},
-                {"id": prestamo.get('id', '')},
-                {"libro.isbn": isbn, "id": str(identificador)}
-            ]
-        })
-
-        # incrementar disponibles en inventario (buscar por ISBN, fallback por título)
-        encontrado = None
-        isbn_buscar = isbn or prestamo.get('libro', {}).get('isbn','')
-        titulo_buscar = prestamo.get('libro', {}).get('titulo','')
-        
-        # Buscar por ISBN con múltiples variantes (con y sin guiones)
-        if isbn_buscar:
-            # Normalizar ISBN removiendo guiones y espacios
-            isbn_clean = isbn_buscar.replace('-', '').replace(' ', '').strip()
-            # Buscar con diferentes formatos de campo y variaciones del ISBN
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"ISBN": isbn_buscar},
-                    {"Isbn": isbn_buscar},
-                    {"isbn": isbn_buscar},
-                    {"ISBN": isbn_clean},
-                    {"Isbn": isbn_clean},
-                    {"isbn": isbn_clean},
-                    {"ISBN": {"$regex": f"^{isbn_buscar.replace('-', '[- ]?')}$", "$options": "i"}}
-                ]
-            })
-        
-        # Si no se encontró por ISBN, buscar por título
-        if not encontrado and titulo_buscar:
-            encontrado = inventario.find_one({
-                "$or": [
-                    {"TÍTULO": titulo_buscar},
-                    {"TITULO": titulo_buscar},
-                    {"Titulo": titulo_buscar},
-                    {"titulo": titulo_buscar},
-                    {"TÍTULO": {"$regex": titulo_buscar, "$options": "i"}}
-                ]
-            })
-
-        incremented = None
-        if encontrado:
-            cur_val = None
-            for k in ("DISPONIBLES","Disponibles","disponible","DISPONIBLE","Disponible"):
-                if k in encontrado and encontrado.get(k) not in (None, ""):
-                    try:
-                        cur_val = int(encontrado.get(k))
-                        break
-                    except Exception:
-                        cur_val = None
-            if cur_val is None:
-                try:
-                    tmp = obtener_disponibles(encontrado)
-                    if isinstance(tmp, int):
-                        cur_val = tmp
-                    elif isinstance(tmp, str) and tmp.isdigit():
-                        cur_val = int(tmp)
-                except Exception:
-                    cur_val = None
-            if cur_val is None:
-                cur_val = 0
-            nuevo = cur_val + 1
-            inventario.update_one({"_id": encontrado["_id"]}, {"$set": {"DISPONIBLES": nuevo}})
-            incremented = nuevo
-
-        # recalcular contadores (mismo método que /api/dashboard)
-        start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1)
-        try:
-            prestamos_hoy = prestamos.count_documents({"created_at": {"$gte": start, "$lt": end}})
-        except Exception:
-            prestamos_hoy = 0
-
-        libros_en_estanteria = 0
-        for doc in inventario.find({}):
-            v = None
-            if "DISPONIBLES" in doc and doc.get("DISPONIBLES") not in (None, ""):
-                try:
-                    v = int(doc.get("DISPONIBLES"))
-                except Exception:
-                    v = None
-            if v is None:
-                for k in ("Disponibles","disponibles","DISPONIBLE","Disponible"):
-                    if k in doc and doc.get(k) not in (None, ""):
-                        try:
-                            v = int(doc.get(k)); break
-                        except Exception:
-                            v = None
-            if v is None:
-                try:
-                    tmp = obtener_disponibles(doc)
-                    if isinstance(tmp, int):
-                        v = tmp
-                    elif isinstance(tmp, str) and tmp.isdigit():
-                        v = int(tmp)
-                except Exception:
-                    v = None
-            if isinstance(v, int) and v > 0:
-                libros_en_estanteria += v
+        resultado = devolver_prestamo(filtros)
+        if not resultado["prestamo"]:
+            return jsonify({"success": False, "error": "Préstamo no encontrado"}), 404
 
         return jsonify({
             "success": True,
-            "prestamos_hoy": prestamos_hoy,
-            "libros_estanteria": libros_en_estanteria,
-            "incremented_disponibles": incremented
+            "prestamos_hoy": contar_prestamos_hoy(),
+            "libros_estanteria": contar_libros_estanteria(),
+            "incremented_disponibles": resultado["disponibles"]
         })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
     
-def tarea_periodica():
-    """Tarea que se ejecuta periódicamente para verificar vencimientos, enviar correos y limpiar registros antiguos"""
-    # Esperar 1 hora antes de la primera ejecución para evitar envíos al iniciar
-    print("[TAREA PERIÓDICA] Esperando 1 hora antes de la primera verificación...")
-    time.sleep(3600)  # Esperar 1 hora (3600 segundos)
-    
+# --- Planificador de tareas ---
+# Cada tarea tiene un documento en la colección Tareas con su próxima ejecución,
+# la última ejecución y su resultado. Todos los procesos (workers de gunicorn,
+# réplicas) corren el planificador, pero una tarea sólo se ejecuta en el proceso
+# que consigue reclamar su documento con find_one_and_update: el bloqueo caduca
+# en bloqueo_hasta, así que si ese proceso muere otro la retoma. Si el servidor
+# estuvo apagado cuando tocaba una ejecución, se hace una sola ejecución de
+# recuperación al arrancar y la siguiente se programa a partir de ahí.
+PLANIFICADOR_TICK = int(os.getenv('PLANIFICADOR_TICK', '30'))  # segundos entre revisiones
+PLANIFICADOR_ID = f"{socket.gethostname()}:{os.getpid()}"
+ZONA_MEXICO = pytz.timezone('America/Mexico_City')
+_hay_tareas = threading.Event()
+
+def _tarea_recordatorios(programada):
+    enviar_recordatorios_diarios()
+    enviar_recordatorios_multas()
+
+def _tarea_vencimientos(programada):
+    verificar_y_actualizar_prestamos_vencidos()
+    recalcular_multas()
+
+def _tarea_contadores(programada):
+    reconciliar_libros_estanteria()
+    reconciliar_existencia_volumenes()
+    reconciliar_total_alumnos()
+
+def _tarea_reporte_mensual(programada):
+    # la fecha programada (no la de hoy) decide el mes, para que una ejecución
+    # de recuperación después del día 28 genere el reporte que faltó
+    local = programada.astimezone(ZONA_MEXICO)
+    generar_reporte_mensual_automatico(local.month, local.year)
+
+# nombre -> (programación, función(programada), segundos de bloqueo)
+# programación: {"cada": segundos} | {"hora": "HH:MM"} diaria | {"dia": d, "hora": "HH:MM"} mensual
+TAREAS_PROGRAMADAS = {
+    "vencimientos": ({"cada": VENCIMIENTOS_INTERVALO}, _tarea_vencimientos, 600),
+    "recordatorios": ({"hora": os.getenv('HORA_RECORDATORIOS', '08:00')}, _tarea_recordatorios, 1800),
+    "limpieza_sitio": ({"hora": "23:30"}, lambda programada: limpiar_registros_antiguos(), 600),
+    "ajedrez": ({"cada": AJEDREZ_BARRIDO_INTERVALO}, lambda programada: finalizar_contadores_ajedrez(), 60),
+    "contadores": ({"hora": "03:00"}, _tarea_contadores, 600),
+    "reporte_mensual": ({"dia": 28, "hora": "20:00"}, _tarea_reporte_mensual, 1800),
+}
+
+def siguiente_ejecucion(programacion, desde):
+    """Primera ejecución estrictamente posterior a desde (datetime con zona); devuelve UTC"""
+    if "cada" in programacion:
+        return (desde + timedelta(seconds=programacion["cada"])).astimezone(timezone.utc)
+    hora, minuto = (int(x) for x in programacion["hora"].split(":"))
+    local = desde.astimezone(ZONA_MEXICO)
+    dia = local.date()
+    while True:
+        if "dia" not in programacion or dia.day == programacion["dia"]:
+            candidata = ZONA_MEXICO.localize(datetime(dia.year, dia.month, dia.day, hora, minuto))
+            if candidata > local:
+                return candidata.astimezone(timezone.utc)
+        dia += timedelta(days=1)
+
+def registrar_tareas():
+    """Crea el documento de cada tarea y reprograma las que cambiaron de programación"""
+    ahora = datetime.now(timezone.utc)
+    for nombre, (programacion, _, _) in TAREAS_PROGRAMADAS.items():
+        tareas.update_one(
+            {"_id": nombre},
+            {"$setOnInsert": {"programacion": programacion, "ejecuciones": 0,
+                              "proxima_ejecucion": siguiente_ejecucion(programacion, ahora)}},
+            upsert=True
+        )
+        tareas.update_one(
+            {"_id": nombre, "programacion": {"$ne": programacion}},
+            {"$set": {"programacion": programacion,
+                      "proxima_ejecucion": siguiente_ejecucion(programacion, ahora)}}
+        )
+
+def reclamar_tarea(nombre, bloqueo):
+    """Toma la tarea si ya le toca y nadie más la está ejecutando; None si no"""
+    ahora = datetime.now(timezone.utc)
+    return tareas.find_one_and_update(
+        {"_id": nombre, "proxima_ejecucion": {"$lte": ahora},
+         "$or": [{"bloqueo_hasta": None}, {"bloqueo_hasta": {"$lte": ahora}}]},
+        {"$set": {"lider": PLANIFICADOR_ID, "bloqueo_hasta": ahora + timedelta(seconds=bloqueo)}},
+        return_document=ReturnDocument.AFTER
+    )
+
+def adelantar_tarea(nombre):
+    """Programa la tarea para ya; el bloqueo sigue decidiendo quién la ejecuta"""
+    programacion = TAREAS_PROGRAMADAS[nombre][0]
+    tareas.update_one(
+        {"_id": nombre},
+        {"$set": {"proxima_ejecucion": datetime.now(timezone.utc)},
+         "$setOnInsert": {"programacion": programacion, "ejecuciones": 0}},
+        upsert=True
+    )
+
+def ejecutar_tarea(nombre):
+    """Ejecuta la tarea si este proceso consigue reclamarla; devuelve True si la ejecutó"""
+    programacion, funcion, bloqueo = TAREAS_PROGRAMADAS[nombre]
+    doc = reclamar_tarea(nombre, bloqueo)
+    if not doc:
+        return False
+    programada = doc["proxima_ejecucion"]
+    if programada.tzinfo is None:
+        programada = programada.replace(tzinfo=timezone.utc)
+    inicio = datetime.now(timezone.utc)
+    if (inicio - programada).total_seconds() > max(PLANIFICADOR_TICK * 2, 60):
+        print(f"[TAREAS] {nombre}: ejecución atrasada desde {programada.astimezone(ZONA_MEXICO):%Y-%m-%d %H:%M}")
+    error = None
+    try:
+        funcion(programada)
+    except Exception as e:
+        error = str(e)
+        print(f"[TAREAS] {nombre}: error: {e}")
+    fin = datetime.now(timezone.utc)
+    tareas.update_one(
+        {"_id": nombre, "lider": PLANIFICADOR_ID},
+        {"$set": {"ultima_ejecucion": inicio, "ultima_programada": programada,
+                  "ultima_duracion": round((fin - inicio).total_seconds(), 3),
+                  "ultimo_error": error, "bloqueo_hasta": None,
+                  "proxima_ejecucion": siguiente_ejecucion(programacion, fin)},
+         "$inc": {"ejecuciones": 1}}
+    )
+    return True
+
+def planificador():
+    """Hilo de fondo: revisa cada PLANIFICADOR_TICK segundos qué tareas tocan"""
     while True:
         try:
-            print("[TAREA PERIÓDICA] Ejecutando verificación periódica...")
-            # Verificar préstamos vencidos y crear/actualizar multas
-            verificar_y_actualizar_prestamos_vencidos()
-            # Enviar recordatorios diarios
-            enviar_recordatorios_diarios()
-            # Enviar recordatorios de multas
-            enviar_recordatorios_multas()
-            # Limpiar registros de sitio con más de 1 mes
-            limpiar_registros_antiguos()
-            # Generar reporte mensual automáticamente el día 28
-            generar_reporte_mensual_automatico()
-            print("[TAREA PERIÓDICA] Verificación completada. Próxima ejecución en 24 horas.")
+            registrar_tareas()
+            break
         except Exception as e:
-            print(f"[TAREA PERIÓDICA] Error: {e}")
-        # Esperar 24 horas (86400 segundos) antes de ejecutar nuevamente
-        time.sleep(86400)
+            print(f"[TAREAS] Error registrando tareas: {e}")
+            time.sleep(PLANIFICADOR_TICK)
+    while True:
+        for nombre in TAREAS_PROGRAMADAS:
+            try:
+                ejecutar_tarea(nombre)
+            except Exception as e:
+                print(f"[TAREAS] Error en el planificador ({nombre}): {e}")
+        _hay_tareas.wait(PLANIFICADOR_TICK)
+        _hay_tareas.clear()
+
+def _fecha_iso(valor):
+    if not valor:
+        return None
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor.astimezone(ZONA_MEXICO).isoformat()
+
+@app.route('/api/tareas', methods=['GET'])
+def api_tareas():
+    """Estado de las tareas programadas"""
+    lista = []
+    for doc in tareas.find({"_id": {"$in": list(TAREAS_PROGRAMADAS)}}):
+        lista.append({
+            "nombre": doc["_id"],
+            "programacion": doc.get("programacion"),
+            "proxima_ejecucion": _fecha_iso(doc.get("proxima_ejecucion")),
+            "ultima_ejecucion": _fecha_iso(doc.get("ultima_ejecucion")),
+            "ultima_duracion": doc.get("ultima_duracion"),
+            "ultimo_error": doc.get("ultimo_error"),
+            "ejecuciones": doc.get("ejecuciones", 0),
+            "en_ejecucion": bool(doc.get("bloqueo_hasta")),
+            "lider": doc.get("lider")
+        })
+    return jsonify({"success": True, "tareas": lista})
+
+@app.route('/api/tareas/<nombre>/ejecutar', methods=['POST'])
+def api_ejecutar_tarea(nombre):
+    """Adelanta la próxima ejecución de una tarea a ahora; la corre el planificador"""
+    if nombre not in TAREAS_PROGRAMADAS:
+        return jsonify({"success": False, "error": "Tarea no encontrada"}), 404
+    adelantar_tarea(nombre)
+    _hay_tareas.set()
+    return jsonify({"success": True, "message": f"Tarea {nombre} programada para ejecutarse ahora"})
+
+# Crear índices al cargar la aplicación sin bloquear el arranque si MongoDB tarda
+if os.getenv('CREAR_INDICES_AL_INICIAR', 'true').lower() == 'true':
+    threading.Thread(target=asegurar_indices, daemon=True).start()
+
+# Envío de correos en segundo plano desde la bandeja de salida
+if os.getenv('DESPACHAR_CORREOS', 'true').lower() == 'true':
+    threading.Thread(target=despachador_correos, daemon=True).start()
+
+# Tareas programadas: vencimientos, recordatorios, limpieza de Sitio, contadores y reporte mensual
+if os.getenv('PLANIFICADOR_TAREAS', 'true').lower() == 'true':
+    threading.Thread(target=planificador, daemon=True).start()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Genera en reportes_mensuales/ los reportes RMIBI de todos los meses cerrados,
+en paralelo con un pool de procesos. Los meses ya archivados y vigentes se omiten.
+
+Uso:
+    python archivar_reportes.py                         # desde el primer préstamo hasta el mes pasado
+    python archivar_reportes.py --desde 2025-01 --hasta 2025-12
+    python archivar_reportes.py --procesos 4 --forzar   # regenerar aunque estén vigentes
+"""
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+# los procesos del pool importan app: que no arranquen hilos de fondo
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+
+
+def meses_entre(desde, hasta):
+    año, mes = desde
+    while (año, mes) <= hasta:
+        yield mes, año
+        año, mes = (año + 1, 1) if mes == 12 else (año, mes + 1)
+
+
+def archivar(mes, año):
+    from app import archivar_reporte
+    return archivar_reporte(mes, año)
+
+
+def leer_mes(texto):
+    fecha = datetime.strptime(texto, '%Y-%m')
+    return fecha.year, fecha.month
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--desde', type=leer_mes, help='primer mes (AAAA-MM)')
+    parser.add_argument('--hasta', type=leer_mes, help='último mes (AAAA-MM)')
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--forzar', action='store_true')
+    args = parser.parse_args()
+
+    from app import prestamos, reporte_archivado, mes_cerrado
+
+    hoy = datetime.now()
+    hasta = args.hasta or ((hoy.year - 1, 12) if hoy.month == 1 else (hoy.year, hoy.month - 1))
+    desde = args.desde
+    if desde is None:
+        primero = prestamos.find_one({"fecha_inicio": {"$nin": ["", None]}}, {"fecha_inicio": 1},
+                                     sort=[("fecha_inicio", 1)])
+        desde = leer_mes(primero["fecha_inicio"][:7]) if primero else hasta
+
+    pendientes = [(mes, año) for mes, año in meses_entre(desde, hasta)
+                  if mes_cerrado(mes, año) and (args.forzar or not reporte_archivado(mes, año))]
+    print(f"Meses por generar: {len(pendientes)} (procesos: {args.procesos})")
+
+    # spawn: cada proceso abre su propia conexión a MongoDB en lugar de heredarla
+    contexto = multiprocessing.get_context('spawn')
+    errores = 0
+    with ProcessPoolExecutor(max_workers=args.procesos, mp_context=contexto) as pool:
+        futuros = {pool.submit(archivar, mes, año): (mes, año) for mes, año in pendientes}
+        for futuro in as_completed(futuros):
+            mes, año = futuros[futuro]
+            try:
+                meta = futuro.result()
+                print(f"   {año}-{mes:02d}: {meta['ruta']} ({meta['bytes']} bytes, sha256 {meta['sha256'][:12]})")
+            except Exception as e:
+                errores += 1
+                print(f"   {año}-{mes:02d}: ERROR {e}")
+
+    raise SystemExit(1 if errores else 0)
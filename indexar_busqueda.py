@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Calcula las claves de búsqueda (busqueda_clave / busqueda_ngramas) de Inventario,
+Alumnos y Docentes. Ejecutar una vez tras actualizar y después de cada importación masiva."""
+import os
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+from app import inventario, alumnos, db, reindexar_busqueda
+
+for nombre, coleccion, tipo in (("Inventario", inventario, "libro"),
+                                ("Alumnos", alumnos, "alumno"),
+                                ("Docentes", db["Docentes"], "docente")):
+    total = reindexar_busqueda(coleccion, tipo)
+    print(f"[BUSQUEDA] {nombre}: {total} documentos indexados")
+
+print("[BUSQUEDA] Indexación finalizada")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Crea los índices de MongoDB declarados en app.INDICES y verifica con explain()
+que las consultas críticas no hagan COLLSCAN.
+
+Uso:
+    python indices.py              # crear índices y verificar
+    python indices.py --verificar  # sólo verificar
+"""
+import os
+import sys
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+from app import asegurar_indices, verificar_indices
+
+if '--verificar' not in sys.argv:
+    for coleccion, nombre in asegurar_indices():
+        print(f"   {coleccion}: {nombre}")
+
+print('\nVerificación de planes de consulta:')
+fallas = 0
+for r in verificar_indices():
+    if r.get('error'):
+        estado = f"ERROR ({r['error']})"
+        fallas += 1
+    elif r['collscan']:
+        estado = 'COLLSCAN'
+        fallas += 1
+    else:
+        estado = 'OK ' + ' > '.join(r['etapas'])
+    print(f"   {r['coleccion']:<13} {r['filtro']} {r.get('orden', '')} -> {estado}")
+
+sys.exit(1 if fallas else 0)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Migra la colección Inventario al esquema canónico
+(TÍTULO/AUTOR/EDITORIAL/ISBN/EDICIÓN/ESTANTE/DISPONIBLES entero).
+
+Uso:
+    python migrar_inventario.py            # dry-run: sólo muestra el reporte
+    python migrar_inventario.py --aplicar  # escribe los cambios por lotes
+"""
+import os
+import sys
+from pprint import pprint
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+from app import migrar_inventario
+
+aplicar = '--aplicar' in sys.argv
+reporte = migrar_inventario(aplicar=aplicar)
+
+print('MODO:', 'APLICAR' if aplicar else 'DRY-RUN (sin cambios)')
+print(f"Documentos revisados: {reporte['total']}")
+print(f"Ya en esquema canónico: {reporte['ya_canonicos']}")
+print(f"Por migrar: {reporte['a_migrar']}")
+print(f"Sin DISPONIBLES legible (quedan en 0): {reporte['sin_disponibles']}")
+if reporte['claves_eliminadas']:
+    print('Claves antiguas que se eliminan:')
+    for clave, n in sorted(reporte['claves_eliminadas'].items()):
+        print(f"   {clave!r}: {n}")
+if reporte['ejemplos']:
+    print('Ejemplos:')
+    for ejemplo in reporte['ejemplos']:
+        pprint(ejemplo)
+if aplicar:
+    print(f"Documentos modificados: {reporte['escritos']}")
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Migración única de la colección Sitio: completa los campos eliminado y
+reiniciado de los registros antiguos y reconstruye los contadores diarios
+(SitioDiario) de los días anteriores al contador.
+
+Uso:
+    python migrar_sitio.py            # dry-run: sólo muestra el reporte
+    python migrar_sitio.py --aplicar  # escribe los cambios
+"""
+import os
+import sys
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+from app import migrar_sitio
+
+aplicar = '--aplicar' in sys.argv
+reporte = migrar_sitio(aplicar=aplicar)
+
+print('MODO:', 'APLICAR' if aplicar else 'DRY-RUN (sin cambios)')
+print(f"Registros sin 'eliminado': {reporte['sin_eliminado']}")
+print(f"Registros sin 'reiniciado': {reporte['sin_reiniciado']}")
+print(f"Días con entradas: {len(reporte['dias'])}"
+      + (f" ({reporte['dias'][0]} a {reporte['dias'][-1]})" if reporte['dias'] else ''))
+if aplicar:
+    print('Contadores diarios reconstruidos.')
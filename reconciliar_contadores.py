@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reconstruye los contadores materializados desde cero y muestra la deriva encontrada"""
+import os
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+from app import reconciliar_libros_estanteria, reconciliar_existencia_volumenes, reconciliar_total_alumnos
+
+for nombre, reconciliar in (("libros_estanteria", reconciliar_libros_estanteria),
+                            ("existencia_volumenes", reconciliar_existencia_volumenes),
+                            ("alumnos", reconciliar_total_alumnos)):
+    resultado = reconciliar()
+    print(f"{nombre}: guardado={resultado['anterior']} calculado={resultado['calculado']} "
+          f"diferencia={resultado['diferencia']}")
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Configuración común de las pruebas: app importada contra mongomock, sin hilos
+de fondo (índices, correos, planificador) y con la base vacía en cada prueba."""
+import os
+import sys
+
+import mongomock
+import pymongo
+import pytest
+
+os.environ['CREAR_INDICES_AL_INICIAR'] = 'false'
+os.environ['DESPACHAR_CORREOS'] = 'false'
+os.environ['PLANIFICADOR_TAREAS'] = 'false'
+pymongo.MongoClient = mongomock.MongoClient
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as aplicacion  # noqa: E402
+
+
+@pytest.fixture
+def app_mod():
+    for nombre in aplicacion.db.list_collection_names():
+        aplicacion.db.drop_collection(nombre)
+    aplicacion.invalidar_cache_busqueda()
+    return aplicacion
+
+
+@pytest.fixture
+def cliente(app_mod):
+    return app_mod.app.test_client()
+
+
+@pytest.fixture
+def libro(app_mod):
+    """Inserta un libro en Inventario con los campos de búsqueda y deja el contador al día"""
+    def crear(titulo, isbn, disponibles):
+        doc = {"TÍTULO": titulo, "ISBN": isbn, "DISPONIBLES": disponibles}
+        doc.update(app_mod.campos_busqueda("libro", doc))
+        app_mod.inventario.insert_one(doc)
+        app_mod.reconciliar_libros_estanteria()
+        return doc
+    return crear
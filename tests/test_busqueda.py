@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def motores(app_mod, monkeypatch):
+    """Sustituye los índices de MongoDB por IndiceBusquedaMemoria"""
+    motores = {"libros": app_mod.IndiceBusquedaMemoria("libro"),
+               "alumnos": app_mod.IndiceBusquedaMemoria("alumno")}
+    for nombre, motor in motores.items():
+        monkeypatch.setitem(app_mod.indices_busqueda, nombre, motor)
+    return motores
+
+
+def _indexar_libros(motores, titulos, isbn="978-0-7475-3269-9"):
+    for i, titulo in enumerate(titulos):
+        motores["libros"].indexar({"_id": i}, {"TÍTULO": titulo, "ISBN": isbn, "AUTOR": "Rowling"})
+
+
+def _titulos(app_mod, q, **kwargs):
+    return [d["TÍTULO"] for d in app_mod.buscar_catalogo(q, ("libros",), **kwargs)["libros"]["items"]]
+
+
+def test_ranking_exacto_prefijo_frase_palabras(app_mod, motores):
+    _indexar_libros(motores, ["Potter contra Harry", "El Harry Potter anotado",
+                              "Harry Potter y la piedra", "Harry Potter"])
+    assert _titulos(app_mod, "Harry Potter") == ["Harry Potter", "Harry Potter y la piedra",
+                                                  "El Harry Potter anotado", "Potter contra Harry"]
+
+
+def test_busqueda_ignora_acentos_y_mayusculas(app_mod, motores):
+    _indexar_libros(motores, ["Cien años de soledad"])
+    assert _titulos(app_mod, "CIEN ANOS") == ["Cien años de soledad"]
+
+
+def test_titulos_por_inicio_de_palabra(app_mod, motores):
+    _indexar_libros(motores, ["Harry Potter"])
+    assert _titulos(app_mod, "pott") == ["Harry Potter"]
+    assert _titulos(app_mod, "otter") == []
+
+
+@pytest.mark.parametrize("fragmento", ["7475", "0-7475-32", "9780747532699", "699"])
+def test_isbn_por_fragmento_intermedio(app_mod, motores, fragmento):
+    _indexar_libros(motores, ["Harry Potter"])
+    assert _titulos(app_mod, fragmento) == ["Harry Potter"]
+
+
+def test_boleta_por_fragmento_intermedio(app_mod, motores):
+    motores["alumnos"].indexar({"_id": 1}, {"Nombre": "Ana Pérez", "Boleta": "2023090123"})
+    resultado = app_mod.buscar_catalogo("0901", ("alumnos",))["alumnos"]
+    assert resultado["total"] == 1
+    assert resultado["items"][0]["Nombre"] == "Ana Pérez"
+    assert not any(k.startswith("busqueda_") for k in resultado["items"][0])
+
+
+def test_paginacion(app_mod, motores):
+    _indexar_libros(motores, [f"Álgebra {i}" for i in range(7)])
+    paginas = [app_mod.buscar_catalogo("algebra", ("libros",), page=p, page_size=3)["libros"] for p in (1, 2, 3)]
+    assert [p["total"] for p in paginas] == [7, 7, 7]
+    titulos = [d["TÍTULO"] for p in paginas for d in p["items"]]
+    assert titulos == [f"Álgebra {i}" for i in range(7)]
+
+
+def test_endpoint_limita_el_tamano_de_pagina(app_mod, cliente, motores):
+    _indexar_libros(motores, ["Harry Potter"])
+    datos = cliente.get("/api/buscar?q=harry&page_size=1000").get_json()
+    assert datos["page_size"] == app_mod.BUSQUEDA_PAGE_SIZE_MAX
+    assert datos["total_libros"] == 1 and datos["total_alumnos"] == 0
+    assert cliente.get("/api/buscar?q=").get_json() == {"libros": [], "alumnos": []}
+
+
+def test_cache_se_invalida_al_registrar_un_libro(app_mod, cliente, motores):
+    _indexar_libros(motores, ["Química 1"])
+    assert _titulos(app_mod, "quimica") == ["Química 1"]
+    motores["libros"].indexar({"_id": 99}, {"TÍTULO": "Química 2"})
+    # sin invalidar, la consulta repetida sale de la caché
+    assert _titulos(app_mod, "quimica") == ["Química 1"]
+    assert cliente.post("/api/registrar_libro", json={"TÍTULO": "Química 2", "DISPONIBLES": 1}).status_code == 200
+    assert _titulos(app_mod, "quimica") == ["Química 1", "Química 2"]
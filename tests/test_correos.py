@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def sendgrid(app_mod, monkeypatch):
+    monkeypatch.setattr(app_mod, "SENDGRID_API_KEY", "clave-de-prueba")
+    monkeypatch.setattr(app_mod, "MODO_PRUEBA", False)
+    app_mod.correos.create_index("clave", unique=True)
+    return app_mod
+
+
+def test_lote_repetido_no_detiene_los_bloques_restantes(sendgrid, monkeypatch):
+    monkeypatch.setattr(sendgrid, "SENDGRID_MAX_PERSONALIZACIONES", 1)
+    # sin claves de idempotencia el filtro previo no los omite: el bloque repetido
+    # choca con el índice único de clave
+    assert sendgrid.encolar_lote("Aviso", "Hola -nombre-", [("a@x.mx", {"-nombre-": "A"}, [])]) == 1
+    encolados = sendgrid.encolar_lote("Aviso", "Hola -nombre-", [("a@x.mx", {"-nombre-": "A"}, []),
+                                                                   ("b@x.mx", {"-nombre-": "B"}, ["b"])])
+    assert encolados == 1
+    assert sendgrid.correos.count_documents({}) == 2
+
+
+def test_lote_omite_destinatarios_ya_encolados(sendgrid):
+    destinatarios = [("a@x.mx", {}, ["a"]), ("b@x.mx", {}, ["b"]), ("", {}, ["c"])]
+    assert sendgrid.encolar_lote("Aviso", "Hola", destinatarios) == 2
+    assert sendgrid.encolar_lote("Aviso", "Hola", destinatarios) == 0
+    doc = sendgrid.correos.find_one()
+    assert sorted(doc["claves"]) == ["a", "b"]
+    assert len(doc["personalizaciones"]) == 2
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+def test_cursor_ida_y_vuelta(app_mod):
+    cursor = app_mod._codificar_cursor(["garcia lopez", "64b000000000000000000001"])
+    assert "=" not in cursor
+    assert app_mod._decodificar_cursor(cursor) == ("garcia lopez", "64b000000000000000000001")
+
+
+def test_cursor_con_clave_nula(app_mod):
+    cursor = app_mod._codificar_cursor([None, "abc"])
+    assert app_mod._decodificar_cursor(cursor) == (None, "abc")
+
+
+@pytest.mark.parametrize("valores", [1, {"a": 1}, [], ["a"], ["a", "b", "c"], [1, "x"], ["a", 5], ["a", ""]])
+def test_cursor_con_forma_invalida(app_mod, valores):
+    with pytest.raises(ValueError):
+        app_mod._decodificar_cursor(app_mod._codificar_cursor(valores))
+
+
+@pytest.mark.parametrize("cursor", ["MQ", "%%%", "no-es-json"])
+def test_cursor_ilegible(app_mod, cursor):
+    with pytest.raises(ValueError):
+        app_mod._decodificar_cursor(cursor)
+
+
+@pytest.mark.parametrize("ruta", ["/api/inventario", "/api/alumnos"])
+def test_listados_responden_400_con_cursor_invalido(cliente, ruta):
+    respuesta = cliente.get(ruta + "?cursor=MQ")
+    assert respuesta.status_code == 400
+    assert respuesta.get_json()["success"] is False
+
+
+def test_inventario_por_cursor_recorre_todo_sin_repetir(cliente, libro):
+    for i in range(7):
+        libro(f"Libro {i % 3}", f"978-{i}", 1)  # títulos repetidos: desempata el _id
+    vistos, cursor = [], ""
+    while True:
+        datos = cliente.get(f"/api/inventario?page_size=3&cursor={cursor}").get_json()
+        vistos.extend(fila["ISBN"] for fila in datos["inventario"])
+        cursor = datos["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(vistos) == sorted(f"978-{i}" for i in range(7))
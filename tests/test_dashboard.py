@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+
+def test_dashboard_usa_el_contador_de_alumnos(app_mod, cliente):
+    app_mod.alumnos.insert_many([{"Nombre": "Ana", "Boleta": "1"}, {"Nombre": "Luis", "Boleta": "2"}])
+    assert cliente.post("/api/registrar_alumno", json={"Nombre": "Eva", "Boleta": "3"}).get_json()["success"]
+    assert app_mod.contar_alumnos() == 3
+    # el dashboard lee el contador materializado, no cuenta la colección
+    app_mod.contadores.update_one({"_id": app_mod.CONTADOR_ALUMNOS}, {"$set": {"total": 41}})
+    assert cliente.get("/api/dashboard").get_json()["nuevos_usuarios"] == 41
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def alumno():
+    return {"tipo": "alumno", "id": "2023090123", "nombre": "Ana", "correo": ""}
+
+
+def _prestar(cliente, alumno, titulo, isbn):
+    return cliente.post("/api/registrar_prestamo", json=dict(alumno, libro={"titulo": titulo, "isbn": isbn}))
+
+
+def test_prestamo_descuenta_un_ejemplar(app_mod, cliente, libro, alumno):
+    libro("Álgebra", "978-607-1", 2)
+    respuesta = _prestar(cliente, alumno, "Álgebra", "9786071")
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()["nuevo_disponibles"] == 1
+    assert app_mod.prestamos.count_documents({}) == 1
+    assert app_mod.devoluciones.count_documents({}) == 1
+    assert respuesta.get_json()["libros_estanteria"] == app_mod.calcular_libros_estanteria() == 1
+
+
+def test_prestamo_sin_ejemplares_no_toma_otra_edicion(app_mod, cliente, libro, alumno):
+    libro("Álgebra", "978-607-1", 0)
+    libro("Álgebra", "978-607-2", 3)  # otra edición con el mismo título
+    respuesta = _prestar(cliente, alumno, "Álgebra", "978-607-1")
+    assert respuesta.status_code == 409
+    assert app_mod.inventario.find_one({"ISBN": "978-607-2"})["DISPONIBLES"] == 3
+    assert app_mod.prestamos.count_documents({}) == 0
+
+
+def test_prestamo_por_titulo_si_el_isbn_no_esta_catalogado(app_mod, cliente, libro, alumno):
+    libro("Álgebra", "978-607-1", 1)
+    assert _prestar(cliente, alumno, "Álgebra", "000").status_code == 200
+    assert app_mod.inventario.find_one()["DISPONIBLES"] == 0
+
+
+def _vencido(app_mod, identificador, isbn):
+    return app_mod.prestamos.insert_one({"id": identificador, "estado": "Vencido", "fecha_inicio": "2026-01-05",
+                                         "fecha_devolucion": "2026-01-12",
+                                         "libro": {"titulo": "Álgebra", "isbn": isbn}}).inserted_id
+
+
+def test_liberar_vencido_exige_identificar_el_prestamo(app_mod, cliente):
+    _vencido(app_mod, "1", "978-607-1")
+    for datos in ({}, {"isbn": "978-607-1"}, {"id": "1"}):
+        assert cliente.post("/api/liberar_prestamo_vencido", json=datos).status_code == 400
+    assert app_mod.prestamos.count_documents({}) == 1
+
+
+def test_liberar_vencido_sólo_toca_el_prestamo_indicado(app_mod, cliente, libro):
+    libro("Álgebra", "978-607-1", 0)
+    _vencido(app_mod, "1", "978-607-1")
+    otro = _vencido(app_mod, "2", "978-607-1")
+    app_mod.multas.insert_one({"prestamo_id": str(otro), "estado": "Pendiente", "monto": 10})
+    assert cliente.post("/api/liberar_prestamo_vencido", json={"isbn": "978-607-1", "id": "2"}).status_code == 200
+    assert [p["id"] for p in app_mod.prestamos.find()] == ["1"]
+    assert app_mod.multas.find_one()["estado"] == "Pagada"
+    assert app_mod.inventario.find_one()["DISPONIBLES"] == 1
+    respuesta = cliente.post("/api/liberar_prestamo_vencido", json={"prestamo_id": "000000000000000000000000"})
+    assert respuesta.status_code == 404
+
+
+def test_liberar_vencido_antes_de_que_corra_la_tarea(app_mod, cliente):
+    # vencido por fecha pero todavía con estado "Activo" (la tarea aún no lo marcó)
+    app_mod.prestamos.insert_one({"id": "3", "estado": "Activo", "fecha_inicio": "2026-01-05",
+                                  "fecha_devolucion": "2026-01-12", "libro": {"titulo": "Álgebra", "isbn": "1"}})
+    app_mod.prestamos.insert_one({"id": "3", "estado": "Activo", "fecha_inicio": "2026-01-05",
+                                  "fecha_devolucion": "2999-01-01", "libro": {"titulo": "Física", "isbn": "2"}})
+    assert cliente.post("/api/liberar_prestamo_vencido", json={"isbn": "2", "id": "3"}).status_code == 404
+    assert cliente.post("/api/liberar_prestamo_vencido", json={"isbn": "1", "id": "3"}).status_code == 200
+    assert [p["libro"]["isbn"] for p in app_mod.prestamos.find()] == ["2"]
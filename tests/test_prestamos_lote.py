@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+LIBRO_A = {"titulo": "Libro A", "isbn": "9786071"}
+
+
+@pytest.fixture
+def docente():
+    return {"tipo": "docente", "id": "900", "nombre": "Docente", "correo": ""}
+
+
+def _registrar(cliente, docente, prestamos):
+    respuesta = cliente.post("/api/prestamos/lote", json=dict(docente, prestamos=prestamos))
+    assert respuesta.status_code == 200
+    return respuesta.get_json()
+
+
+def test_lote_aparta_sólo_los_ejemplares_disponibles(app_mod, cliente, libro, docente):
+    libro("Libro A", "978-607-1", 2)
+    datos = _registrar(cliente, docente, [{"libro": LIBRO_A}] * 3)
+    assert datos["registrados"] == 2
+    assert [r["success"] for r in datos["resultados"]] == [True, True, False]
+    assert app_mod.inventario.find_one()["DISPONIBLES"] == 0
+    assert app_mod.prestamos.count_documents({}) == 2
+    assert app_mod.devoluciones.count_documents({}) == 2
+    assert datos["libros_estanteria"] == app_mod.calcular_libros_estanteria() == 0
+
+
+def test_lote_rechaza_elementos_que_no_son_objeto(app_mod, cliente, libro, docente):
+    libro("Libro A", "978-607-1", 5)
+    datos = _registrar(cliente, dict(docente, libro=LIBRO_A), [{"libro": LIBRO_A}, "Libro A", None])
+    assert datos["registrados"] == 1
+    assert [r["success"] for r in datos["resultados"]] == [True, False, False]
+    assert app_mod.inventario.find_one()["DISPONIBLES"] == 4
+
+
+def test_lote_valida_la_lista(cliente, docente):
+    assert cliente.post("/api/prestamos/lote", json=docente).status_code == 400
+    assert cliente.post("/api/prestamos/lote/devolver", json={"prestamo_ids": []}).status_code == 400
+
+
+def test_devolver_lote_regresa_ejemplares_e_informa_multas(app_mod, cliente, libro, docente):
+    libro("Libro A", "978-607-1", 3)
+    ids = [r["prestamo_id"] for r in _registrar(cliente, docente, [{"libro": LIBRO_A}] * 2)["resultados"]]
+    app_mod.multas.insert_one({"prestamo_id": ids[0], "estado": "Pendiente", "monto": 15})
+
+    respuesta = cliente.post("/api/prestamos/lote/devolver", json={"prestamo_ids": ids + ["no-existe", 7]})
+    datos = respuesta.get_json()
+    assert datos["devueltos"] == 2
+    assert datos["multas_pendientes"] == 1
+    resultados = datos["resultados"]
+    assert resultados[0]["multa"] == {"monto": 15, "estado": "Pendiente"}
+    assert "multa" not in resultados[1]
+    assert [r["success"] for r in resultados] == [True, True, False, False]
+    assert app_mod.inventario.find_one()["DISPONIBLES"] == 3
+    assert app_mod.prestamos.count_documents({}) == 0
+    assert app_mod.devoluciones.count_documents({}) == 0
+    assert app_mod.multas.find_one()["estado"] == "Pendiente"
+    assert datos["libros_estanteria"] == app_mod.calcular_libros_estanteria() == 3
+
+
+def test_devolver_lote_puede_pagar_las_multas(app_mod, cliente, libro, docente):
+    libro("Libro A", "978-607-1", 1)
+    prestamo_id = _registrar(cliente, docente, [{"libro": LIBRO_A}])["resultados"][0]["prestamo_id"]
+    app_mod.multas.insert_one({"prestamo_id": prestamo_id, "estado": "Pendiente", "monto": 20})
+
+    datos = cliente.post("/api/prestamos/lote/devolver",
+                         json={"prestamo_ids": [prestamo_id], "pagar_multas": True}).get_json()
+    assert datos["multas_pagadas"] == 1
+    assert datos["resultados"][0]["multa"]["estado"] == "Pagada"
+    assert app_mod.multas.find_one()["estado"] == "Pagada"
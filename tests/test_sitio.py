@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytz
+
+MEXICO = pytz.timezone('America/Mexico_City')
+
+
+def test_histograma_de_un_dia_sin_entradas(cliente):
+    respuesta = cliente.get("/api/sitio/histograma?fecha=2026-01-05")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()
+    assert datos["dias"] == 0
+    assert datos["por_dia"] == []
+    assert all(n == 0 for n in datos["totales"].values())
+    assert len(datos["horas"]) == 24
+
+
+def test_histograma_cuenta_por_hora_y_por_dia(app_mod, cliente):
+    app_mod.contar_entrada_sitio("alumno", MEXICO.localize(datetime(2026, 1, 5, 9, 15)))
+    app_mod.contar_entrada_sitio("alumno", MEXICO.localize(datetime(2026, 1, 5, 9, 40)))
+    app_mod.contar_entrada_sitio("alumno", MEXICO.localize(datetime(2026, 1, 7, 13, 0)))
+
+    un_dia = cliente.get("/api/sitio/histograma?fecha=2026-01-05").get_json()
+    assert un_dia["totales"]["alumno"] == 2
+    assert un_dia["horas"][9]["alumno"] == 2
+
+    rango = cliente.get("/api/sitio/histograma?desde=2026-01-05&hasta=2026-01-07").get_json()
+    assert rango["totales"]["alumno"] == 3
+    assert [d["fecha"] for d in rango["por_dia"]] == ["2026-01-05", "2026-01-07"]
+
+
+def test_histograma_rechaza_fechas_invalidas(cliente):
+    assert cliente.get("/api/sitio/histograma?desde=05/01/2026").status_code == 400
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone
+
+
+def _ahora():
+    return datetime.now(timezone.utc)
+
+
+def test_reclamar_tarea_sin_vencer(app_mod):
+    app_mod.tareas.insert_one({"_id": "contadores", "proxima_ejecucion": _ahora() + timedelta(hours=1)})
+    assert app_mod.reclamar_tarea("contadores", 60) is None
+
+
+def test_reclamar_tarea_bloquea_a_los_demas(app_mod):
+    app_mod.tareas.insert_one({"_id": "contadores", "proxima_ejecucion": _ahora() - timedelta(seconds=1)})
+    doc = app_mod.reclamar_tarea("contadores", 60)
+    assert doc["lider"] == app_mod.PLANIFICADOR_ID
+    assert doc["bloqueo_hasta"] > _ahora().replace(tzinfo=None)
+    assert app_mod.reclamar_tarea("contadores", 60) is None
+
+
+def test_reclamar_tarea_con_bloqueo_caducado(app_mod):
+    app_mod.tareas.insert_one({"_id": "contadores", "proxima_ejecucion": _ahora() - timedelta(minutes=5),
+                               "lider": "otro:1", "bloqueo_hasta": _ahora() - timedelta(seconds=1)})
+    assert app_mod.reclamar_tarea("contadores", 60)["lider"] == app_mod.PLANIFICADOR_ID
+
+
+def test_ejecutar_tarea_guarda_error_y_reprograma(app_mod, monkeypatch):
+    def fallar(programada):
+        raise RuntimeError("sin disco")
+    programacion, _, bloqueo = app_mod.TAREAS_PROGRAMADAS["contadores"]
+    monkeypatch.setitem(app_mod.TAREAS_PROGRAMADAS, "contadores", (programacion, fallar, bloqueo))
+    app_mod.adelantar_tarea("contadores")
+    assert app_mod.ejecutar_tarea("contadores") is True
+    doc = app_mod.tareas.find_one({"_id": "contadores"})
+    assert doc["ultimo_error"] == "sin disco"
+    assert doc["bloqueo_hasta"] is None
+    assert doc["ejecuciones"] == 1
+    assert doc["proxima_ejecucion"] > _ahora().replace(tzinfo=None)
+    assert app_mod.ejecutar_tarea("contadores") is False
+
+
+def test_verificar_vencimientos_respeta_el_bloqueo(app_mod, cliente, monkeypatch):
+    llamadas = []
+    for nombre in ("vencimientos", "recordatorios", "limpieza_sitio"):
+        programacion, _, bloqueo = app_mod.TAREAS_PROGRAMADAS[nombre]
+        monkeypatch.setitem(app_mod.TAREAS_PROGRAMADAS, nombre,
+                            (programacion, lambda programada, nombre=nombre: llamadas.append(nombre), bloqueo))
+    app_mod.tareas.insert_one({"_id": "vencimientos", "proxima_ejecucion": _ahora(),
+                               "lider": "otro:1", "bloqueo_hasta": _ahora() + timedelta(minutes=5)})
+    respuesta = cliente.post("/api/verificar_vencimientos")
+    assert respuesta.status_code == 200
+    tareas = respuesta.get_json()["tareas"]
+    assert tareas["vencimientos"]["ejecutada"] is False
+    assert tareas["recordatorios"]["ejecutada"] is True
+    assert llamadas == ["recordatorios", "limpieza_sitio"]
+
+
+def test_error_del_reporte_mensual_queda_en_la_tarea(app_mod, monkeypatch):
+    def fallar(mes, año):
+        raise OSError("plantilla no encontrada")
+    monkeypatch.setattr(app_mod, "archivar_reporte", fallar)
+    app_mod.adelantar_tarea("reporte_mensual")
+    assert app_mod.ejecutar_tarea("reporte_mensual") is True
+    assert app_mod.tareas.find_one({"_id": "reporte_mensual"})["ultimo_error"] == "plantilla no encontrada"